@@ -0,0 +1,83 @@
+"""Benchmark the float32 estimators of nimrls.ml against the current ones.
+
+Fits each estimator on an IPC-sized matrix (``N_ROWS`` samples x 6670 ROI
+pairs, 116 ROIs), each in a new process, and reports the fit time and the
+peak memory used during the fit (maximum resident set size above the one
+after creating the data, which includes the copies made by liblinear).
+
+Run as: python benchmarks/bench_float32.py [n_rows]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from nimrls.ml import (  # noqa
+    Float32LinearSVCHeuristicC, Float32LogisticRegressionHeuristicC,
+    Float32StandardScaler, LinearSVCHeuristicC, LogisticRegressionHeuristicC)
+from sklearn.preprocessing import StandardScaler  # noqa
+
+
+N_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+N_COLS = 116 * 115 // 2
+
+CASES = {
+    'zscore': (StandardScaler, {}, 'float64'),
+    'zscore32 (float64 in)': (Float32StandardScaler, {}, 'float64'),
+    'zscore32': (Float32StandardScaler, {}, 'float32'),
+    'linearsvchc': (
+        LinearSVCHeuristicC, {'penalty': 'l1', 'dual': False}, 'float64'),
+    'linearsvchc (float32 in)': (
+        LinearSVCHeuristicC, {'penalty': 'l1', 'dual': False}, 'float32'),
+    'linearsvchc32': (
+        Float32LinearSVCHeuristicC, {'penalty': 'l1'}, 'float32'),
+    'logithc': (
+        LogisticRegressionHeuristicC,
+        {'penalty': 'l1', 'solver': 'liblinear'}, 'float64'),
+    'logithc (float32 in)': (
+        LogisticRegressionHeuristicC,
+        {'penalty': 'l1', 'solver': 'liblinear'}, 'float32'),
+    'logithc32': (
+        Float32LogisticRegressionHeuristicC,
+        {'l1_ratio': 1., 'solver': 'saga'}, 'float32'),
+}
+
+
+def _maxrss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run(name, queue):
+    # Convergence and deprecation warnings would clutter the report
+    warnings.simplefilter('ignore')
+    klass, params, dtype = CASES[name]
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((N_ROWS, N_COLS), dtype=np.dtype(dtype))
+    y = (X[:, :10].sum(axis=1) + 3 * rng.standard_normal(N_ROWS)) > 0
+    model = klass(**params)
+    baseline = _maxrss()
+    t0 = time.perf_counter()
+    if hasattr(model, 'transform'):
+        model.fit_transform(X)
+    else:
+        model.fit(X, y)
+    queue.put((time.perf_counter() - t0, _maxrss() - baseline, X.nbytes))
+
+
+if __name__ == '__main__':
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{N_ROWS} x {N_COLS} matrix')
+    for name in CASES:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run, args=(name, queue))
+        process.start()
+        elapsed, peak, nbytes = queue.get()
+        process.join()
+        print(f'{name:<24} {nbytes / 2**20:8.0f} MiB data {elapsed:8.2f} s '
+              f'{peak / 2**20:8.0f} MiB peak')
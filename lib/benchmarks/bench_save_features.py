@@ -0,0 +1,54 @@
+"""Benchmark the bulk SQL writer of nimrls.io.
+
+Creates a table with ``N_ROWS`` rows and then upserts ``N_ROWS`` rows into
+it (half of them already present), reporting rows/second for each step.
+
+Run as: python benchmarks/bench_save_features.py [n_rows]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from nimrls.io import _to_table_name, _save_upsert, save_features  # noqa
+
+
+N_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+N_COLS = 10
+
+
+def _make_df(start, n_rows, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        rng.standard_normal((n_rows, N_COLS)),
+        columns=[f'roi_{i}' for i in range(N_COLS)])
+    df['subject'] = np.arange(start, start + n_rows) // 1000
+    df['timepoint'] = np.arange(start, start + n_rows) % 1000
+    return df.set_index(['subject', 'timepoint'])
+
+
+def _report(name, n_rows, elapsed):
+    print(f'{name:<18} {n_rows:>10} rows {elapsed:8.2f} s '
+          f'{n_rows / elapsed:12.0f} rows/s')
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    uri = f'sqlite:///{tmpdir}/bench.db'
+    df_new = _make_df(0, N_ROWS, seed=1)
+    df_upsert = _make_df(N_ROWS // 2, N_ROWS, seed=2)
+    table_name = _to_table_name('bench', 'atlas', 'mean')
+    engine = create_engine(uri, echo=False)
+
+    t0 = time.perf_counter()
+    save_features(df_new, uri, 'bench', 'atlas', 'mean')
+    _report('create', N_ROWS, time.perf_counter() - t0)
+
+    for upsert in ['ignore', 'update']:
+        t0 = time.perf_counter()
+        _save_upsert(df_upsert, table_name, engine, upsert=upsert)
+        _report(f'upsert ({upsert})', N_ROWS, time.perf_counter() - t0)
@@ -3,4 +3,7 @@ __version__ = '0.1.devgit'
 from . import logging
 from . import io
 from . import cv
-from . import ml
\ No newline at end of file
+from . import ml
+from . import connectivity
+from . import convert
+from . import fingerprint
\ No newline at end of file
@@ -0,0 +1,299 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from .logging import logger, raise_error
+
+
+def parse_roi(name):
+    """Get the hemisphere and network of a ROI from its name
+
+    Supports Schaefer (e.g. 'LH_Default_PFC_1') and Tian (e.g. 'HIP-rh')
+    names. Tian ROIs are assigned to the 'Subcortex' network.
+
+    Parameters
+    ----------
+    name : str
+        The ROI name.
+
+    Returns
+    -------
+    hemisphere : str
+        The hemisphere ('LH' or 'RH').
+    network : str
+        The network (e.g. 'Default', 'DorsAttn', 'Subcortex').
+    """
+    m = re.match(r'^(LH|RH)_([A-Za-z]+)_', name)
+    if m:
+        return m.group(1), m.group(2)
+    m = re.match(r'^[A-Za-z]+-(rh|lh)$', name)
+    if m:
+        return m.group(1).upper(), 'Subcortex'
+    raise_error(f'Unrecognized region pattern: {name}')
+
+
+def make_roi_table(names):
+    """Build the ROI table (name, hemisphere, network) of a list of ROIs
+
+    Parameters
+    ----------
+    names : list(str)
+        The ROI names, in matrix order.
+
+    Returns
+    -------
+    rois : pandas.DataFrame
+        The ROI table, one row per ROI in matrix order.
+    """
+    parsed = [parse_roi(x) for x in names]
+    return pd.DataFrame({
+        'name': list(names),
+        'hemisphere': [x[0] for x in parsed],
+        'network': [x[1] for x in parsed],
+    })
+
+
+class Connectivity:
+    """Connectivity of several samples, packed as upper triangles
+
+    Each sample (e.g. a timepoint) is stored as the upper triangle (without
+    the diagonal) of its ROI x ROI matrix, flattened in row-major order
+    (same order as ``np.triu_indices(n_rois, k=1)``). This is less than
+    half the size of the full matrices. The values keep their dtype unless
+    another one is requested (e.g. float32, to halve the size again at the
+    cost of precision). The ROIs are described
+    by a table with their name, hemisphere and network, which is used to
+    select blocks of the matrix without handling column names.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The packed connectivity (n_samples x n_rois * (n_rois - 1) / 2).
+    rois : pandas.DataFrame
+        The ROI table (see `make_roi_table`).
+    index : pandas.Index | None
+        The index of the samples (e.g. subject and timepoint). If None
+        (default), a RangeIndex.
+    dtype : str or numpy.dtype | None
+        The dtype of the packed data. If None (default), keep the dtype of
+        data (float64 if it is not floating point).
+    """
+
+    def __init__(self, data, rois, index=None, dtype=None):
+        data = np.asarray(data)
+        if dtype is None and not np.issubdtype(data.dtype, np.floating):
+            dtype = np.float64
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        n_rois = len(rois)
+        if data.ndim != 2 or data.shape[1] != n_rois * (n_rois - 1) // 2:
+            raise_error(
+                f'Data of shape {data.shape} is not the packed upper '
+                f'triangle of {n_rois} ROIs')
+        if index is None:
+            index = pd.RangeIndex(data.shape[0])
+        if len(index) != data.shape[0]:
+            raise_error('Index and data have a different number of samples')
+        self.data = data
+        self.rois = rois.reset_index(drop=True)
+        self.index = index
+
+    @property
+    def n_rois(self):
+        return len(self.rois)
+
+    @property
+    def pairs(self):
+        """The (row, column) ROI indices of each packed element"""
+        return np.triu_indices(self.n_rois, k=1)
+
+    @classmethod
+    def from_frame(cls, df, dtype=None):
+        """Pack a DataFrame with one 'roiA~roiB' column per ROI pair
+
+        Symmetric duplicates (b~a) and the diagonal (a~a) are dropped. The
+        ROIs are ordered as they first appear in the column names. Pairs
+        missing from the DataFrame are filled with NaN.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            The connectivity, one row per sample.
+        dtype : str or numpy.dtype | None
+            The dtype of the packed data. If None (default), the dtype of
+            the columns (at least float32).
+
+        Returns
+        -------
+        conn : Connectivity
+            The packed connectivity.
+        """
+        split = [x.split('~') for x in df.columns]
+        names = pd.unique(np.array(split).ravel())
+        rois = make_roi_table(names)
+        codes = pd.Index(names).get_indexer(np.array(split).ravel())
+        row, col = codes[0::2], codes[1::2]
+        keep = row != col
+        row, col = np.minimum(row, col)[keep], np.maximum(row, col)[keep]
+
+        if dtype is None:
+            dtype = np.result_type(np.float32, *df.dtypes)
+        n_rois = len(names)
+        # Position of (row, col) in the packed upper triangle
+        pos = row * n_rois - row * (row + 1) // 2 + col - row - 1
+        pos, first = np.unique(pos, return_index=True)
+        src = np.flatnonzero(keep)[first]
+
+        data = np.full(
+            (df.shape[0], n_rois * (n_rois - 1) // 2), np.nan, dtype=dtype)
+        data[:, pos] = df.iloc[:, src].to_numpy(dtype=dtype)
+        n_missing = data.shape[1] - len(pos)
+        if n_missing > 0:
+            logger.warning(f'{n_missing} ROI pairs missing, filled with NaN')
+        return cls(data, rois, index=df.index)
+
+    def labels(self):
+        """Get the network label of each ROI pair
+
+        The label is the upper-case network name for pairs within a
+        network and 'INTERNETWORK_<netA>_<netB>' for pairs between
+        networks.
+
+        Returns
+        -------
+        labels : numpy.ndarray of str
+            The label of each packed element.
+        """
+        row, col = self.pairs
+        network = self.rois['network'].to_numpy().astype(str)
+        net_a, net_b = network[row], network[col]
+        within = np.char.upper(net_a)
+        between = np.char.add(
+            np.char.add('INTERNETWORK_', net_a), np.char.add('_', net_b))
+        return np.where(net_a == net_b, within, between)
+
+    def select(self, within=None, between=None):
+        """Get a mask of the ROI pairs within or between networks
+
+        Parameters
+        ----------
+        within : str or list(str) | None
+            Select the pairs with both ROIs in one of these networks.
+        between : tuple(str, str) or list(tuple(str, str)) | None
+            Select the pairs with one ROI in each network of one of these
+            (unordered) network pairs.
+
+        Returns
+        -------
+        mask : numpy.ndarray of bool
+            The mask of the selected packed elements.
+        """
+        row, col = self.pairs
+        network = self.rois['network'].to_numpy()
+        net_a, net_b = network[row], network[col]
+        mask = np.zeros(len(row), dtype=bool)
+        if within is not None:
+            if isinstance(within, str):
+                within = [within]
+            mask |= (net_a == net_b) & np.isin(net_a, within)
+        if between is not None:
+            if isinstance(between, tuple):
+                between = [between]
+            for t_a, t_b in between:
+                mask |= ((net_a == t_a) & (net_b == t_b)) | (
+                    (net_a == t_b) & (net_b == t_a))
+        return mask
+
+    def to_frame(self, mask=None):
+        """Unpack into a DataFrame with one labelled column per ROI pair
+
+        Columns are named '<label>_<roiA>~<roiB>' (see `labels`), as used
+        in the decoder X_types.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray of bool | None
+            The packed elements to include. If None (default), all of them.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            The connectivity, one row per sample.
+        """
+        row, col = self.pairs
+        names = self.rois['name'].to_numpy().astype(str)
+        columns = np.char.add(
+            np.char.add(self.labels(), '_'),
+            np.char.add(np.char.add(names[row], '~'), names[col]))
+        data = self.data
+        if mask is not None:
+            columns = columns[mask]
+            data = data[:, mask]
+        return pd.DataFrame(data, columns=columns, index=self.index)
+
+    def to_matrix(self, sample):
+        """Unpack one sample into its symmetric ROI x ROI matrix
+
+        Parameters
+        ----------
+        sample : int
+            The position of the sample.
+
+        Returns
+        -------
+        matrix : numpy.ndarray
+            The matrix (n_rois x n_rois), with NaN in the diagonal.
+        """
+        row, col = self.pairs
+        matrix = np.full(
+            (self.n_rois, self.n_rois), np.nan, self.data.dtype)
+        matrix[row, col] = self.data[sample]
+        matrix[col, row] = self.data[sample]
+        return matrix
+
+    def save(self, fname):
+        """Save to a .npz file
+
+        Parameters
+        ----------
+        fname : str or pathlib.Path
+            The file name.
+        """
+        index = self.index.to_frame(index=False)
+        arrays = {'data': self.data}
+        # Object arrays would need pickle to be loaded, store strings
+        for x in self.rois.columns:
+            arrays[f'roi_{x}'] = self.rois[x].to_numpy().astype(str)
+        for x in index.columns:
+            t_values = index[x].to_numpy()
+            if t_values.dtype == object:
+                t_values = t_values.astype(str)
+            arrays[f'index_{x}'] = t_values
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """Load from a .npz file written by `save`
+
+        Parameters
+        ----------
+        fname : str or pathlib.Path
+            The file name.
+
+        Returns
+        -------
+        conn : Connectivity
+            The packed connectivity.
+        """
+        with np.load(fname) as npz:
+            rois = pd.DataFrame({
+                x[4:]: npz[x] for x in npz.files if x.startswith('roi_')})
+            index = pd.DataFrame({
+                x[6:]: npz[x] for x in npz.files if x.startswith('index_')})
+            data = npz['data']
+        if index.shape[1] == 1:
+            index = pd.Index(index.iloc[:, 0])
+        else:
+            index = pd.MultiIndex.from_frame(index)
+        return cls(data, rois, index=index)
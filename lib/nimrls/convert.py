@@ -0,0 +1,103 @@
+from argparse import ArgumentParser
+
+import numpy as np
+
+from .io import iter_features, save_features_parquet
+from .logging import logger, raise_error
+
+
+def hdf5_to_parquet(fname, feature_name, path,
+                    partition_col=('task', 'subject'), columns=None,
+                    dtype=None, compression='zstd',
+                    max_rows_per_group=10000):
+    """Convert a junifer HDF5 feature into a partitioned Parquet dataset
+
+    The HDF5 storage is read one subject at a time (see
+    `nimrls.io.iter_features`), so the whole feature is never loaded in
+    memory. The junifer element (e.g. subject, task) and row header (e.g.
+    timepoint) are stored as columns. The result can be read by
+    `nimrls.io.read_features_parquet`, which only opens the partitions of
+    the requested tasks and subjects. An existing dataset at ``path`` is
+    replaced.
+
+    Parameters
+    ----------
+    fname : str or pathlib.Path
+        The junifer HDF5 storage.
+    feature_name : str
+        The name of the feature (e.g. 'BOLD_IPC_Schaefer_fc').
+    path : str or pathlib.Path
+        The root directory of the dataset.
+    partition_col : list(str)
+        The element keys used to partition the dataset, in nesting order
+        (defaults to task and subject).
+    columns : str or list(str) | None
+        Regular expressions selecting the columns to convert. If None
+        (default), convert all the columns.
+    dtype : str | None
+        The dtype of the features (e.g. 'float32' to halve the size at the
+        cost of precision). If None (default), keep the stored dtype.
+    compression : str
+        The Parquet compression codec (defaults to 'zstd').
+    max_rows_per_group : int | None
+        The maximum number of rows of each Parquet row group (defaults to
+        10000).
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows converted.
+    """
+    partition_col = list(partition_col)
+    n_rows = 0
+    for t_df in iter_features(
+            fname, by='subject', columns=columns, feature_name=feature_name):
+        missing = [x for x in partition_col if x not in t_df.index.names]
+        if len(missing) > 0:
+            raise_error(
+                f'Partition columns {missing} are not element keys of '
+                f'{feature_name} ({list(t_df.index.names)})')
+        if dtype is not None:
+            t_df = t_df.astype(np.dtype(dtype), copy=False)
+        save_features_parquet(
+            t_df, path, partition_col=partition_col,
+            compression=compression, max_rows_per_group=max_rows_per_group,
+            overwrite=n_rows == 0)
+        n_rows += t_df.shape[0]
+        logger.info(f'Converted {n_rows} rows of {feature_name}')
+    return n_rows
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Convert a junifer HDF5 feature into a Parquet dataset '
+                    'partitioned by task and subject.')
+    parser.add_argument('fname', help='The junifer HDF5 storage.')
+    parser.add_argument('feature_name', help='The name of the feature.')
+    parser.add_argument('path', help='The root directory of the dataset.')
+    parser.add_argument(
+        '--partition', nargs='+', default=['task', 'subject'],
+        help='The element keys used to partition the dataset.')
+    parser.add_argument(
+        '--columns', nargs='+', default=None,
+        help='Regular expressions selecting the columns to convert.')
+    parser.add_argument(
+        '--dtype', default='none',
+        help='The dtype of the features (e.g. float32, defaults to "none" '
+             'to keep the stored dtype).')
+    parser.add_argument(
+        '--compression', default='zstd', help='The Parquet compression.')
+    parser.add_argument(
+        '--max-rows-per-group', type=int, default=10000,
+        help='The maximum number of rows of each row group.')
+    args = parser.parse_args(argv)
+    dtype = None if args.dtype.lower() == 'none' else args.dtype
+    hdf5_to_parquet(
+        args.fname, args.feature_name, args.path,
+        partition_col=args.partition, columns=args.columns, dtype=dtype,
+        compression=args.compression,
+        max_rows_per_group=args.max_rows_per_group)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,40 @@
-import numpy as np
+import hashlib
+import os
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import BaseCrossValidator, StratifiedKFold
+
+from .logging import logger, raise_error
 
 
 class DownsampledRepeatedStratifiedKFold(StratifiedKFold):
+    """Repeated stratified K-Fold on class-balanced subsamples
 
-    def split(self, X, y=None, groups=None):
-        for i in range(self.n_repeats):
-            idx_y0 = np.argwhere(~np.in1d(y, self.pos_labels)).ravel()
-            idx_y1 = np.argwhere(np.in1d(y, self.pos_labels)).ravel()
-
-            min_size = min(len(idx_y0), len(idx_y1))
-            n_samples = self.subsample_size
-            if n_samples == 'auto' or n_samples > min_size:
-                n_samples = min_size
-
-            idx0 = np.random.choice(idx_y0, size=n_samples)
-            idx1 = np.random.choice(idx_y1, size=n_samples)
-            idx = np.hstack((idx0, idx1))
-            np.random.shuffle(idx)
-            t_groups = groups[idx] if groups is not None else None
-            if isinstance(X, pd.DataFrame):
-                t_X = X.iloc[idx]
-            else:
-                t_X = X[idx]
-            return super().split(t_X, y[idx], groups=t_groups)
+    In each repeat, the same number of samples of each class (positive vs.
+    other labels) is drawn without replacement and split with a stratified
+    K-Fold. The returned indices refer to the rows of the original data;
+    the rows left out of a repeat are in neither its train nor test sets.
+
+    Parameters
+    ----------
+    n_splits : int
+        The number of folds of each repeat (defaults to 5).
+    n_repeats : int
+        The number of repeats (defaults to 10).
+    random_state : int or numpy.random.Generator | None
+        Seed of the subsampling and of the fold assignment. With an int,
+        every call to `split` gives the same folds. If None (default), they
+        differ between calls.
+    pos_labels : list | None
+        The labels of the positive class (defaults to [1]).
+    subsample_size : int or 'auto'
+        The number of samples drawn from each class in each repeat. If
+        'auto' (default) or larger than the smallest class, use the size of
+        the smallest class.
+    """
 
     def __init__(self, n_splits=5, n_repeats=10, random_state=None,
                  pos_labels=None, subsample_size='auto'):
@@ -37,4 +45,365 @@ class DownsampledRepeatedStratifiedKFold(StratifiedKFold):
         self.pos_labels = pos_labels
         self.subsample_size = subsample_size
         self.n_repeats = n_repeats
-        super().__init__(n_splits=n_splits, random_state=random_state)
\ No newline at end of file
+        super().__init__(n_splits=n_splits)
+        # The shuffling is done here, not in StratifiedKFold
+        self.random_state = random_state
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits * self.n_repeats
+
+    def split(self, X, y=None, groups=None):
+        if y is None:
+            raise_error('y is required to split by class')
+        y = np.asarray(y)
+        is_pos = np.isin(y, self.pos_labels)
+        idx_pos = np.flatnonzero(is_pos)
+        idx_neg = np.flatnonzero(~is_pos)
+
+        min_size = min(len(idx_neg), len(idx_pos))
+        n_samples = self.subsample_size
+        if n_samples == 'auto' or n_samples > min_size:
+            n_samples = min_size
+        if n_samples < self.n_splits:
+            raise_error(
+                f'Cannot split {n_samples} samples per class into '
+                f'{self.n_splits} folds')
+
+        rng = np.random.default_rng(self.random_state)
+        t_X = np.zeros((2 * n_samples, 1))
+        skf = StratifiedKFold(n_splits=self.n_splits)
+        for _ in range(self.n_repeats):
+            idx = np.concatenate([
+                rng.choice(idx_neg, size=n_samples, replace=False),
+                rng.choice(idx_pos, size=n_samples, replace=False)])
+            # Random order, so the non-shuffled folds are random too
+            idx = rng.permutation(idx)
+            for train, test in skf.split(t_X, is_pos[idx]):
+                yield idx[train], idx[test]
+
+
+class RepeatedStratifiedGroupKFold(StratifiedKFold):
+    """Repeated stratified K-Fold with non-overlapping groups
+
+    Each repeat assigns whole groups to folds so that the class
+    proportions of the folds are as close as possible, as
+    `sklearn.model_selection.StratifiedGroupKFold` with ``shuffle=True``.
+    The class counts of each group are computed once, and each repeat is a
+    greedy assignment over groups (not rows): groups are visited in random
+    order, the ones with the most unbalanced classes first, and each one is
+    added to the fold that minimises the spread of the class proportions
+    across folds (the smallest fold in case of ties).
+
+    Parameters
+    ----------
+    n_splits : int
+        The number of folds of each repeat (defaults to 5).
+    n_repeats : int
+        The number of repeats (defaults to 10).
+    random_state : int or numpy.random.Generator | None
+        Seed of the group order. With an int, every call to `split` gives
+        the same folds. If None (default), they differ between calls.
+    """
+
+    def __init__(self, n_splits=5, n_repeats=10, random_state=None):
+        self.n_repeats = n_repeats
+        super().__init__(n_splits=n_splits)
+        # The shuffling is done here, not in StratifiedKFold
+        self.random_state = random_state
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_splits * self.n_repeats
+
+    def split(self, X, y=None, groups=None):
+        if y is None or groups is None:
+            raise_error('y and groups are required to split')
+        _, y_inv = np.unique(np.asarray(y), return_inverse=True)
+        _, g_inv = np.unique(np.asarray(groups), return_inverse=True)
+        n_groups, n_classes = g_inv.max() + 1, y_inv.max() + 1
+        if n_groups < self.n_splits:
+            raise_error(
+                f'Cannot split {n_groups} groups into {self.n_splits} '
+                'folds')
+        # Class counts of each group, relative to the class totals
+        counts = np.bincount(
+            g_inv * n_classes + y_inv, minlength=n_groups * n_classes)
+        counts = counts.reshape(n_groups, n_classes)
+        props = counts / counts.sum(axis=0)
+        sizes = counts.sum(axis=1)
+        g_std = props.std(axis=1) if n_classes > 1 else np.zeros(n_groups)
+
+        rng = np.random.default_rng(self.random_state)
+        for _ in range(self.n_repeats):
+            order = rng.permutation(n_groups)
+            order = order[np.argsort(-g_std[order], kind='stable')]
+            g_fold = self._assign(order, props, sizes)
+            r_fold = g_fold[g_inv]
+            for i_fold in range(self.n_splits):
+                test = r_fold == i_fold
+                yield np.flatnonzero(~test), np.flatnonzero(test)
+
+    def _assign(self, order, props, sizes):
+        """Greedily assign the groups to folds, in the given order"""
+        # Plain Python: for a few folds and classes this is much faster
+        # than numpy calls on tiny arrays
+        k = self.n_splits
+        n_classes = props.shape[1]
+        classes = range(n_classes)
+        props = props.tolist()
+        sizes = sizes.tolist()
+        f_props = [[0.] * n_classes for _ in range(k)]
+        f_sum = [0.] * n_classes
+        f_sumsq = [0.] * n_classes
+        f_sizes = [0] * k
+        g_fold = np.empty(len(props), dtype=int)
+        for i_group in order.tolist():
+            t_props = props[i_group]
+            # Variance across folds of each class proportion, if the group
+            # is added to each fold. Only the sum of squares depends on
+            # the fold.
+            t_base = [
+                (f_sumsq[c] + t_props[c] ** 2) / k
+                - ((f_sum[c] + t_props[c]) / k) ** 2 for c in classes]
+            best_fold, best_cost = 0, None
+            for i_fold in range(k):
+                t_fold = f_props[i_fold]
+                t_cost = sum(
+                    max(t_base[c] + 2 * t_fold[c] * t_props[c] / k, 0.)
+                    ** .5 for c in classes)
+                if best_cost is None or t_cost < best_cost - 1e-12 or (
+                        t_cost <= best_cost + 1e-12
+                        and f_sizes[i_fold] < f_sizes[best_fold]):
+                    best_fold, best_cost = i_fold, t_cost
+
+            g_fold[i_group] = best_fold
+            t_fold = f_props[best_fold]
+            for c in classes:
+                f_sumsq[c] += 2 * t_fold[c] * t_props[c] + t_props[c] ** 2
+                t_fold[c] += t_props[c]
+                f_sum[c] += t_props[c]
+            f_sizes[best_fold] += sizes[i_group]
+        return g_fold
+
+
+class DownsampledGroupCV(BaseCrossValidator):
+    """Downsample the majority class by groups in the training folds
+
+    Wraps a group-aware splitter (e.g. `StratifiedGroupKFold` by subject or
+    `RepeatedStratifiedGroupKFold` by trial). In each training set, whole
+    downsampling groups (e.g. trials) with only majority class samples are
+    dropped at random until the majority class has about ``ratio`` times
+    as many samples as the minority class. Groups are never split, so no
+    group is both in the train and test sets, and the test sets are kept
+    as they are.
+
+    Parameters
+    ----------
+    cv : cross-validation generator
+        The group-aware splitter.
+    downsample_groups : array-like | None
+        The downsampling group of each row of the data passed to `split`
+        (e.g. the trial when splitting by subject). Each of them must be
+        within one split group. If None (default), use the split groups.
+    pos_labels : list | None
+        The labels of the positive class (defaults to [1]). The other
+        labels are the negative class.
+    ratio : float
+        The number of majority class samples kept per minority class
+        sample (defaults to 1).
+    random_state : int or numpy.random.Generator | None
+        Seed of the groups drawn. With an int, every call to `split` gives
+        the same folds. If None (default), they differ between calls.
+    """
+
+    def __init__(self, cv, downsample_groups=None, pos_labels=None,
+                 ratio=1., random_state=None):
+        if pos_labels is None:
+            pos_labels = [1]
+        if not isinstance(pos_labels, list):
+            pos_labels = [pos_labels]
+        self.cv = cv
+        self.downsample_groups = downsample_groups
+        self.pos_labels = pos_labels
+        self.ratio = ratio
+        self.random_state = random_state
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.cv.get_n_splits(X, y, groups)
+
+    def split(self, X, y=None, groups=None):
+        if y is None or groups is None:
+            raise_error('y and groups are required to split')
+        is_pos = np.isin(np.asarray(y), self.pos_labels)
+        t_groups = groups
+        if self.downsample_groups is not None:
+            t_groups = self.downsample_groups
+            if len(t_groups) != len(is_pos):
+                raise_error(
+                    f'{len(t_groups)} downsampling groups for '
+                    f'{len(is_pos)} samples')
+        _, g_inv = np.unique(np.asarray(t_groups), return_inverse=True)
+        rng = np.random.default_rng(self.random_state)
+        for train, test in self.cv.split(X, y, groups):
+            yield self._downsample(train, is_pos, g_inv, rng), test
+
+    def _downsample(self, train, is_pos, g_inv, rng):
+        t_pos = is_pos[train]
+        n_pos = t_pos.sum()
+        is_major = t_pos if n_pos > len(train) - n_pos else ~t_pos
+        n_minor = len(train) - is_major.sum()
+
+        # Groups with only majority class samples can be dropped
+        t_groups = g_inv[train]
+        n_rows = np.bincount(t_groups)
+        n_major = np.bincount(t_groups, weights=is_major)
+        candidates = np.flatnonzero((n_rows > 0) & (n_major == n_rows))
+        n_fixed = is_major.sum() - n_rows[candidates].sum()
+
+        n_keep = self.ratio * n_minor - n_fixed
+        candidates = rng.permutation(candidates)
+        n_cum = np.cumsum(n_rows[candidates])
+        keep = candidates[:np.searchsorted(n_cum, n_keep, side='right')]
+        drop = np.setdiff1d(candidates, keep)
+        return train[~np.isin(t_groups, drop)]
+
+
+def _update_cv_hash(content, cv):
+    # The repr of a splitter truncates its array parameters (e.g. the
+    # ``downsample_groups`` of DownsampledGroupCV), hash their values too
+    for name, value in sorted(vars(cv).items()):
+        if hasattr(value, 'split'):
+            _update_cv_hash(content, value)
+        elif isinstance(value, (np.ndarray, pd.Series, pd.Index, list)):
+            content.update(name.encode('utf-8'))
+            content.update(pd.util.hash_pandas_object(
+                pd.Series(np.asarray(value)), index=False).values)
+
+
+def _is_random(cv):
+    """Whether the splitter (or one it wraps) is seeded with None"""
+    for value in vars(cv).values():
+        if hasattr(value, 'split') and _is_random(value):
+            return True
+    return getattr(cv, 'random_state', 0) is None
+
+
+def split_key(cv, X, y, groups=None, n_rows=64):
+    """Get the key of a split: the splitter and a hash of the data
+
+    The data is fingerprinted by the row index and column names of ``X``
+    (if any), the values of ``n_rows`` evenly spaced rows of ``X``, ``y``
+    and ``groups``.
+
+    Parameters
+    ----------
+    cv : cross-validation generator
+        The splitter. Its repr (type and parameters, including the seed)
+        and the values of its array parameters are part of the key.
+    X : pandas.DataFrame or numpy.ndarray
+        The data.
+    y : array-like
+        The target.
+    groups : array-like | None
+        The groups (defaults to None).
+    n_rows : int
+        The number of rows of ``X`` whose values are hashed (defaults to
+        64).
+
+    Returns
+    -------
+    key : str
+        The hex digest of the key.
+    """
+    content = hashlib.blake2b(digest_size=16)
+    content.update(repr(cv).encode('utf-8'))
+    _update_cv_hash(content, cv)
+    content.update(str(np.shape(X)).encode('utf-8'))
+    if isinstance(X, pd.DataFrame):
+        content.update(
+            pd.util.hash_pandas_object(X.index, index=False).values)
+        content.update(pd.util.hash_pandas_object(
+            pd.Series(X.columns.astype(str)), index=False).values)
+    if len(X) > 0:
+        rows = np.unique(np.linspace(0, len(X) - 1, n_rows).astype(int))
+        if isinstance(X, pd.DataFrame):
+            sample = X.iloc[rows]
+        else:
+            sample = pd.DataFrame(np.asarray(X)[rows])
+        content.update(
+            pd.util.hash_pandas_object(sample, index=False).values)
+    for t_values in [y, groups]:
+        if t_values is not None:
+            t_values = pd.Series(np.asarray(t_values))
+            content.update(
+                pd.util.hash_pandas_object(t_values, index=False).values)
+    return content.hexdigest()
+
+
+def cached_split(cv, X, y, groups=None, cache_dir=None, fold=None):
+    """Split the data, saving the folds to disk to be reused
+
+    The train and test indices of all the folds are saved to
+    ``<cache_dir>/split_<key>.npz`` (see `split_key`). Later calls with the
+    same splitter and data (e.g. one job per fold, or other models) load
+    them instead of splitting again. Only the requested fold is read from
+    the file. Splitters seeded with ``random_state=None`` are not cached,
+    as each split is meant to be different.
+
+    Parameters
+    ----------
+    cv : cross-validation generator
+        The splitter.
+    X : pandas.DataFrame or numpy.ndarray
+        The data.
+    y : array-like
+        The target.
+    groups : array-like | None
+        The groups (defaults to None).
+    cache_dir : str or pathlib.Path | None
+        The directory of the cached splits. If None (default), do not
+        cache.
+    fold : int | None
+        The fold to return. If None (default), return all of them.
+
+    Returns
+    -------
+    folds : list(tuple(numpy.ndarray, numpy.ndarray)) or tuple
+        The (train, test) indices of each fold, or of the requested fold.
+    """
+    fname = None
+    if cache_dir is not None and _is_random(cv):
+        logger.info('Not caching the split of an unseeded splitter')
+    elif cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        fname = cache_dir / f'split_{split_key(cv, X, y, groups)}.npz'
+        if fname.exists():
+            logger.info(f'Loading split from {fname}')
+            with np.load(fname) as npz:
+                n_folds = int(npz['n_folds'])
+                if fold is not None:
+                    if not 0 <= fold < n_folds:
+                        raise_error(
+                            f'Fold {fold} out of range ({n_folds} folds)')
+                    return npz[f'train_{fold}'], npz[f'test_{fold}']
+                return [
+                    (npz[f'train_{i}'], npz[f'test_{i}'])
+                    for i in range(n_folds)]
+
+    folds = list(cv.split(X, y, groups))
+    if fname is not None:
+        arrays = {'n_folds': len(folds)}
+        dtype = np.int32 if len(X) < 2 ** 31 else np.int64
+        for i, (train, test) in enumerate(folds):
+            arrays[f'train_{i}'] = train.astype(dtype)
+            arrays[f'test_{i}'] = test.astype(dtype)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Concurrent jobs may write the same split: write and rename
+        t_fname = cache_dir / f'.{fname.stem}.{os.getpid()}.npz'
+        np.savez(t_fname, **arrays)
+        os.replace(t_fname, fname)
+        logger.info(f'Split saved to {fname}')
+    if fold is not None:
+        if not 0 <= fold < len(folds):
+            raise_error(f'Fold {fold} out of range ({len(folds)} folds)')
+        return folds[fold]
+    return folds
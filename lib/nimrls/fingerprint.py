@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .logging import logger, raise_error
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def _hasher():
+    """Get a new hash object: xxhash if installed, BLAKE2 otherwise"""
+    try:
+        import xxhash
+        return 'xxh3_128', xxhash.xxh3_128()
+    except ImportError:
+        return 'blake2b', hashlib.blake2b(digest_size=16)
+
+
+def _files(path):
+    path = Path(path)
+    if path.is_dir():
+        return sorted(x for x in path.rglob('*') if x.is_file())
+    return [path]
+
+
+def hash_file(fname, chunksize=1 << 20):
+    """Hash the content of a file, reading it by chunks
+
+    Parameters
+    ----------
+    fname : str or pathlib.Path
+        The file name.
+    chunksize : int
+        The number of bytes read at a time (defaults to 1 MiB).
+
+    Returns
+    -------
+    algorithm : str
+        The hash algorithm ('xxh3_128' if xxhash is installed, 'blake2b'
+        otherwise).
+    digest : str
+        The hex digest of the content.
+    """
+    algorithm, hasher = _hasher()
+    buffer = bytearray(chunksize)
+    view = memoryview(buffer)
+    with open(fname, 'rb') as fid:
+        while True:
+            n_read = fid.readinto(buffer)
+            if n_read == 0:
+                break
+            hasher.update(view[:n_read])
+    return algorithm, hasher.hexdigest()
+
+
+def fingerprint(path, full=True, chunksize=1 << 20):
+    """Get the fingerprint of a file or directory
+
+    The fingerprint has the size and modification time of each file and,
+    if ``full``, the hash of its content. Directories (e.g. Parquet
+    datasets) are fingerprinted file by file.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The file or directory.
+    full : bool
+        Whether to hash the content of the files (defaults to True).
+    chunksize : int
+        The number of bytes read at a time (defaults to 1 MiB).
+
+    Returns
+    -------
+    fp : dict
+        The fingerprint, one entry per file (relative to ``path`` for
+        directories).
+    """
+    path = Path(path)
+    if not path.exists():
+        raise_error(f'Can not fingerprint {path}, it does not exist')
+    fp = {}
+    for t_fname in _files(path):
+        stat = t_fname.stat()
+        t_name = (
+            t_fname.relative_to(path).as_posix() if path.is_dir() else '.')
+        fp[t_name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if full:
+            algorithm, digest = hash_file(t_fname, chunksize=chunksize)
+            fp[t_name][algorithm] = digest
+    return fp
+
+
+def _same_files(path, stored):
+    """Check a file or directory against its stored fingerprint
+
+    Files with the same size and modification time are assumed unchanged.
+    The others are hashed and compared with the stored hash.
+    """
+    current = fingerprint(path, full=False)
+    if set(current) != set(stored):
+        return False
+    path = Path(path)
+    for t_name, t_fp in current.items():
+        t_stored = stored[t_name]
+        if t_fp['size'] != t_stored['size']:
+            return False
+        if t_fp['mtime_ns'] == t_stored['mtime_ns']:
+            continue
+        t_fname = path if t_name == '.' else path / t_name
+        algorithm, digest = hash_file(t_fname)
+        if t_stored.get(algorithm) != digest:
+            return False
+    return True
+
+
+def manifest_fname(output):
+    """Get the name of the manifest of an output
+
+    Parameters
+    ----------
+    output : str or pathlib.Path
+        The output file or directory.
+
+    Returns
+    -------
+    fname : pathlib.Path
+        The manifest, next to the output (e.g. 'IPC.jay.manifest.json').
+    """
+    output = Path(output)
+    return output.parent / f'{output.name}{MANIFEST_SUFFIX}'
+
+
+def write_manifest(output, inputs, params=None):
+    """Record the inputs an output was computed from
+
+    Parameters
+    ----------
+    output : str or pathlib.Path
+        The output file or directory.
+    inputs : list(str or pathlib.Path)
+        The input files or directories.
+    params : dict | None
+        Other parameters the output depends on (must be JSON
+        serializable).
+
+    Returns
+    -------
+    fname : pathlib.Path
+        The manifest file name.
+    """
+    manifest = {
+        'output': str(output),
+        'inputs': {str(x): fingerprint(x) for x in inputs},
+        'params': params,
+        'created': datetime.now(timezone.utc).isoformat(),
+    }
+    fname = manifest_fname(output)
+    t_fname = fname.parent / f'.{fname.name}.tmp'
+    with open(t_fname, 'w') as fid:
+        json.dump(manifest, fid, indent=2)
+    os.replace(t_fname, fname)
+    logger.debug(f'Manifest of {output} written to {fname}')
+    return fname
+
+
+def is_up_to_date(output, inputs, params=None):
+    """Check whether an output was computed from the current inputs
+
+    Inputs with the same size and modification time as recorded in the
+    manifest are not read. Inputs that were touched but have the same
+    content are still considered unchanged.
+
+    Parameters
+    ----------
+    output : str or pathlib.Path
+        The output file or directory.
+    inputs : list(str or pathlib.Path)
+        The input files or directories.
+    params : dict | None
+        Other parameters the output depends on.
+
+    Returns
+    -------
+    up_to_date : bool
+        True if the output and its manifest exist and the inputs and
+        parameters are the same as recorded.
+    """
+    fname = manifest_fname(output)
+    if not Path(output).exists() or not fname.exists():
+        return False
+    with open(fname, 'r') as fid:
+        manifest = json.load(fid)
+    inputs = [str(x) for x in inputs]
+    if sorted(inputs) != sorted(manifest['inputs']):
+        logger.debug(f'{output}: the inputs changed')
+        return False
+    # Compare as stored (e.g. tuples are stored as lists)
+    if json.loads(json.dumps(params)) != manifest['params']:
+        logger.debug(f'{output}: the parameters changed')
+        return False
+    for t_input in inputs:
+        if not Path(t_input).exists() or not _same_files(
+                t_input, manifest['inputs'][t_input]):
+            logger.debug(f'{output}: {t_input} changed')
+            return False
+    return True
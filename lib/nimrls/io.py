@@ -1,9 +1,18 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager, suppress
+from datetime import datetime, timezone
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
 
 
 
-from . logging import logger
+from . logging import logger, raise_error
 
 
 def _validate_names(kind, atlas_name, agg_function):
@@ -11,7 +20,7 @@ def _validate_names(kind, atlas_name, agg_function):
         raise ValueError("Feature kind must not have the special character $")
     if '$' in atlas_name:
         raise ValueError("Atlas name must not have the special character $")
-    if '$' in agg_function:
+    if agg_function is not None and '$' in agg_function:
         raise ValueError(
             "Agg function mamemust not have the special character $")
 
@@ -28,10 +37,111 @@ def _from_table_name(table_name):
     splitted = table_name.split('$')
     kind = splitted[0]
     atlas_name = splitted[1]
-    agg_function = splitted[2]
+    agg_function = splitted[2] if len(splitted) > 2 else None
     return kind, atlas_name, agg_function
 
 
+# Engines, junifer storages and table metadata, created once per process
+_POOL = {'pid': None, 'engines': {}, 'storages': {}, 'tables': {}}
+
+_STORAGE_CLASSES = {
+    'sqlite': 'SQLiteFeatureStorage',
+    'hdf5': 'HDF5FeatureStorage',
+}
+
+
+def _check_pool():
+    if _POOL['pid'] != os.getpid():
+        # Connections inherited from the parent process can not be used
+        for engine in _POOL['engines'].values():
+            engine.dispose(close=False)
+        for x in ['engines', 'storages', 'tables']:
+            _POOL[x].clear()
+        _POOL['pid'] = os.getpid()
+
+
+def get_engine(uri):
+    """Get the SQLAlchemy engine of a URI
+
+    Engines are created once per URI and process and then reused, so
+    repeated reads from the same database share its connection pool. Use
+    `dispose` to close them.
+
+    Parameters
+    ----------
+    uri : str
+        The connection URI.
+
+    Returns
+    -------
+    engine : sqlalchemy.engine.Engine
+        The engine.
+    """
+    from sqlalchemy import create_engine
+    _check_pool()
+    uri = str(uri)
+    if uri not in _POOL['engines']:
+        logger.debug(f'Creating engine for {uri}')
+        _POOL['engines'][uri] = create_engine(uri, echo=False)
+    return _POOL['engines'][uri]
+
+
+def get_storage(uri, kind='sqlite'):
+    """Get a junifer feature storage
+
+    Storages are created once per URI and process and then reused. SQLite
+    storages use the engine of `get_engine` instead of creating a new one
+    for each read.
+
+    Parameters
+    ----------
+    uri : str or pathlib.Path
+        The path to the storage.
+    kind : str
+        The kind of storage: 'sqlite' or 'hdf5' (defaults to 'sqlite').
+
+    Returns
+    -------
+    storage : junifer.storage.BaseFeatureStorage
+        The storage.
+    """
+    import junifer.storage
+    if kind not in _STORAGE_CLASSES:
+        raise_error(f'Unknown storage kind {kind}')
+    _check_pool()
+    key = (kind, str(uri))
+    if key not in _POOL['storages']:
+        klass = getattr(junifer.storage, _STORAGE_CLASSES[kind])
+        storage = klass(uri, single_output=True)
+        if kind == 'sqlite':
+            engine = get_engine(f'sqlite:///{storage.uri}')
+            storage.get_engine = lambda element=None: engine
+        _POOL['storages'][key] = storage
+    return _POOL['storages'][key]
+
+
+def dispose(uri=None):
+    """Close pooled engines and drop pooled storages and metadata
+
+    Parameters
+    ----------
+    uri : str | None
+        The connection URI of the engine to dispose. If None (default),
+        dispose all of them.
+    """
+    uris = list(_POOL['engines']) if uri is None else [str(uri)]
+    for t_uri in uris:
+        engine = _POOL['engines'].pop(t_uri, None)
+        if engine is not None:
+            engine.dispose()
+    # Storages and metadata may refer to the disposed engines
+    _POOL['storages'].clear()
+    _POOL['tables'].clear()
+
+
+atexit.register(dispose)
+
+
 def list_features_old(uri):
     """List features from a SQL Database
 
@@ -51,8 +161,9 @@ def list_features_old(uri):
     df : pandas.DataFrame
         The DataFrame with the features list
     """
+    from sqlalchemy import inspect
     logger.debug(f'Listing features from DB {uri}')
-    engine = create_engine(uri, echo=False)
+    engine = get_engine(uri)
     features = {'kind': [], 'atlas_name': [], 'agg_function': []}
     for t_name in inspect(engine).get_table_names():
         t_k, t_a, t_f = _from_table_name(t_name)
@@ -63,8 +174,23 @@ def list_features_old(uri):
 
 
 def list_features(uri):
-    storage = SQLiteFeatureStorage(uri, single_output=True)
-    return storage.list_features()
+    """List the features of a junifer storage or of a features directory
+
+    Parameters
+    ----------
+    uri : str or pathlib.Path
+        The path to a junifer SQLite storage, or a directory with features
+        written by the nimrls writers (.jay, Parquet).
+
+    Returns
+    -------
+    features : dict or pandas.DataFrame
+        The junifer features, or the catalog of the directory (see
+        `read_catalog`).
+    """
+    if Path(uri).is_dir():
+        return read_catalog(uri)
+    return get_storage(uri).list_features()
 
 
 def read_features_old(uri, kind, atlas_name, index_col, agg_function=None):
@@ -94,63 +220,489 @@ def read_features_old(uri, kind, atlas_name, index_col, agg_function=None):
     df : pandas.DataFrame
         The DataFrame with the features
     """
-    from sqlalchemy import create_engine, inspect
     table_name = _to_table_name(kind, atlas_name, agg_function)
     logger.debug(f'Reading data from DB {uri} - table {table_name}')
-    engine = create_engine(uri, echo=False)
-    df = pd.read_sql(table_name, con=engine, index_col=index_col)
+    engine = get_engine(uri)
+    with engine.connect() as con:
+        df = pd.read_sql(table_name, con=con, index_col=index_col)
     return df
 
 
-def read_features(uri, feature_name):
-    from junifer.storage import SQLiteFeatureStorage
-    storage = SQLiteFeatureStorage(uri, single_output=True)
-    df = storage.read_df(feature_name=feature_name)
-    df = df.xs(0, level=1, drop_level=True)
-    df.index = [f'sub-{x}' for x in df.index]
+def _save_upsert(df, table_name, engine, upsert='update', chunksize=10000):
+    """Upsert a DataFrame into an existing table in a single transaction
+
+    The rows are first bulk inserted (executemany, by chunks) into a
+    temporary table which is then merged into the target table with one
+    UPDATE and one INSERT statement, keyed on the index columns.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The DataFrame to save. The index columns are used as keys.
+    table_name : str
+        The name of the table to upsert into.
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the database.
+    upsert : str
+        How to handle rows whose keys already exist in the table:
+        'ignore' keeps the existing rows, 'update' overwrites them with the
+        new values ('delete' is accepted as an alias of 'update').
+        Defaults to 'update'.
+    chunksize : int
+        Number of rows inserted per executemany call (defaults to 10000).
+    """
+    from sqlalchemy import text
+    if upsert not in ['ignore', 'update', 'delete']:
+        raise_error(f'Unknown upsert mode {upsert}')
+    quote = engine.dialect.identifier_preparer.quote
+    index_col = list(df.index.names)
+    columns = index_col + list(df.columns)
+    tmp_name = f'{table_name}_upsert_tmp'
+    t_table = quote(table_name)
+    t_tmp = quote(tmp_name)
+    t_cols = ', '.join(quote(x) for x in columns)
+    t_keys = ' AND '.join(
+        f'{t_table}.{quote(x)} = {t_tmp}.{quote(x)}' for x in index_col)
+
+    # pandas creates one index per key column, the merge needs a composite
+    # one to look up each key directly
+    t_index = quote(f'ix_{table_name}_upsert_keys')
+    t_index_cols = ', '.join(quote(x) for x in index_col)
+
+    logger.debug(f'Upserting {len(df)} rows into {table_name} ({upsert})')
+    with engine.begin() as con:
+        con.execute(text(
+            f'CREATE INDEX IF NOT EXISTS {t_index} ON {t_table} '
+            f'({t_index_cols})'))
+        df.to_sql(
+            name=tmp_name, con=con, if_exists='replace', chunksize=chunksize)
+        if upsert in ['update', 'delete'] and len(df.columns) > 0:
+            if engine.dialect.name in ['sqlite', 'postgresql']:
+                t_set = ', '.join(
+                    f'{quote(x)} = {t_tmp}.{quote(x)}' for x in df.columns)
+                con.execute(text(
+                    f'UPDATE {t_table} SET {t_set} FROM {t_tmp} '
+                    f'WHERE {t_keys}'))
+            else:
+                t_set = ', '.join(
+                    f'{quote(x)} = (SELECT {t_tmp}.{quote(x)} FROM {t_tmp} '
+                    f'WHERE {t_keys})' for x in df.columns)
+                con.execute(text(
+                    f'UPDATE {t_table} SET {t_set} WHERE EXISTS '
+                    f'(SELECT 1 FROM {t_tmp} WHERE {t_keys})'))
+        con.execute(text(
+            f'INSERT INTO {t_table} ({t_cols}) SELECT {t_cols} FROM {t_tmp} '
+            f'WHERE NOT EXISTS (SELECT 1 FROM {t_table} WHERE {t_keys})'))
+        con.execute(text(f'DROP TABLE {t_tmp}'))
+
+
+def save_features(df, uri, kind, atlas_name, agg_function=None,
+                  upsert='update', chunksize=10000):
+    """Save features to a SQL Database
+
+    If the table does not exist, it is created. Otherwise, the rows are
+    upserted using the index columns as keys. For SQLite files, the table
+    is recorded in the catalog next to the database (see `update_catalog`).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The DataFrame with the features. The index is used as key.
+    uri : str
+        The connection URI.
+        Easy options:
+            'sqlite://' for an in memory sqlite database
+            'sqlite:///<path_to_file>' to save in a file
+
+        Check https://docs.sqlalchemy.org/en/14/core/engines.html for more
+        options
+    kind : str
+        kind of features
+    altas_name : str
+        the name of the atlas
+    agg_function : str
+        The aggregation function used (defaults to None)
+    upsert : str
+        How to handle rows that already exist: 'ignore' or 'update'
+        (defaults to 'update'). See `_save_upsert`.
+    chunksize : int
+        Number of rows inserted per executemany call (defaults to 10000).
+    """
+    from sqlalchemy import inspect
+    table_name = _to_table_name(kind, atlas_name, agg_function)
+    logger.debug(f'Saving data to DB {uri} - table {table_name}')
+    engine = get_engine(uri)
+    exists = inspect(engine).has_table(table_name)
+    if exists:
+        _save_upsert(df, table_name, engine, upsert=upsert,
+                     chunksize=chunksize)
+    else:
+        with engine.begin() as con:
+            df.to_sql(name=table_name, con=con, chunksize=chunksize)
+
+    db_fname = engine.url.database
+    if engine.dialect.name == 'sqlite' and db_fname not in [None, '']:
+        from sqlalchemy import text
+        with engine.connect() as con:
+            n_rows = con.execute(text(
+                'SELECT COUNT(*) FROM '
+                f'{engine.dialect.identifier_preparer.quote(table_name)}'
+            )).scalar()
+        update_catalog(
+            Path(db_fname), f'{Path(db_fname).name}/{table_name}', df,
+            n_rows=n_rows, merge=exists)
+
+
+def _junifer_table(engine, feature_name):
+    """Get the table name, index and data columns of a junifer feature"""
+    from sqlalchemy import inspect, text
+    key = (str(engine.url), feature_name)
+    if key in _POOL['tables']:
+        return _POOL['tables'][key]
+    with engine.connect() as con:
+        # Names are stored JSON encoded in the meta table
+        md5s = con.execute(
+            text('SELECT meta_md5 FROM meta WHERE name = :name'),
+            {'name': f'"{feature_name}"'}).scalars().all()
+        if len(md5s) != 1:
+            raise_error(
+                f'Expected one feature named {feature_name}, found '
+                f'{len(md5s)}')
+        table_name = f'meta_{md5s[0]}'
+        rows = con.execute(text(
+            'SELECT il.name, il."unique", ii.name, ii.cid '
+            'FROM pragma_index_list(:table) AS il, '
+            'pragma_index_info(il.name) AS ii '
+            'ORDER BY il.name, ii.seqno'),
+            {'table': table_name}).all()
+    indexes = {}
+    for t_index, unique, t_col, cid in rows:
+        indexes.setdefault(t_index, (unique, []))[1].append((cid, t_col))
+    # A unique or composite index (e.g. the one of `_save_upsert`) has the
+    # index columns in order. Otherwise, pandas (and so junifer) creates one
+    # index per index level, in the order of the table columns.
+    keys = [x for x, (unique, cols) in indexes.items()
+            if unique or len(cols) > 1]
+    if len(keys) > 1:
+        raise_error(
+            f'Expected one index on {table_name}, found {sorted(keys)}')
+    if len(keys) == 1:
+        index_col = [x for _, x in indexes[keys[0]][1]]
+    else:
+        index_col = [
+            x for _, x in sorted(y for _, t in indexes.values() for y in t)]
+    names = [
+        x['name'] for x in inspect(engine).get_columns(table_name)
+        if x['name'] not in index_col]
+    _POOL['tables'][key] = table_name, index_col, names
+    return _POOL['tables'][key]
+
+
+def read_features(uri, feature_name, columns=None, subjects=None):
+    """Read features from a junifer SQLite storage
+
+    The column and subject selection is done in the SQL query, so only the
+    requested data is loaded.
+
+    Parameters
+    ----------
+    uri : str or pathlib.Path
+        The path to the junifer SQLite storage.
+    feature_name : str
+        The name of the feature.
+    columns : str or list(str) | None
+        Regular expressions selecting the columns to read. A column is read
+        if it fully matches any of them. If None (default), read all the
+        columns.
+    subjects : list(str) | None
+        The subjects to read (with or without the 'sub-' prefix). If None
+        (default), read all the subjects.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the features, indexed by SubjectID.
+    """
+    from sqlalchemy import bindparam, text
+    engine = get_storage(uri).get_engine()
+    table_name, index_col, names = _junifer_table(engine, feature_name)
+    quote = engine.dialect.identifier_preparer.quote
+
+    to_read = _match_columns(names, columns)
+    sql = (
+        f'SELECT {quote(index_col[0])}, '
+        f'{", ".join(quote(x) for x in to_read)} '
+        f'FROM {quote(table_name)}')
+
+    # Keep only the first row of each subject (as df.xs(0, level=1))
+    where = [f'{quote(x)} = 0' for x in index_col[1:2]]
+    params = {}
+    if subjects is not None:
+        where.append(f'{quote(index_col[0])} IN :subjects')
+        params['subjects'] = [
+            x[4:] if x.startswith('sub-') else x for x in subjects]
+    if len(where) > 0:
+        sql = f'{sql} WHERE {" AND ".join(where)}'
+    query = text(sql)
+    if subjects is not None:
+        query = query.bindparams(bindparam('subjects', expanding=True))
+
+    logger.debug(
+        f'Reading {len(to_read)} of {len(names)} columns of {feature_name} '
+        f'from {uri}')
+    with engine.connect() as con:
+        df = pd.read_sql(query, con=con, params=params,
+                         index_col=index_col[0])
+    df.index = 'sub-' + df.index.astype(str)
     df.index.name = 'SubjectID'
     return df
 
 
-def read_prs(fname):
-    data = np.genfromtxt(fname=fname, delimiter="\t")
-    subj_id = data[0].astype(int)
+def _to_subject_ids(values):
+    """Convert numeric IDs to 'sub-<ID>' strings, vectorised"""
+    return np.char.add('sub-', np.asarray(values).astype(int).astype(str))
+
+
+def _csv_engine():
+    """Use the multithreaded Arrow CSV parser if pyarrow is available"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return 'c'
+    return 'pyarrow'
+
+
+def _cache_fname(fname, schema):
+    stat = fname.stat()
+    key = json.dumps(
+        [stat.st_size, stat.st_mtime_ns, schema], sort_keys=True, default=str)
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+    return fname.with_name(f'.{fname.name}.{digest}.pkl')
+
+
+def _read_csv_cached(fname, cache=True, engine=None, **kwargs):
+    """Read a CSV file, caching the parsed DataFrame in a binary sidecar
+
+    The sidecar (``.<name>.<hash>.pkl`` next to the file) is keyed by the
+    size and modification time of the file, the parser engine and the
+    parsing arguments, so it is ignored (and replaced) as soon as any of
+    them changes.
+    """
+    fname = Path(fname)
+    if engine is None:
+        engine = _csv_engine()
+    cache_fname = None
+    if cache:
+        cache_fname = _cache_fname(fname, dict(kwargs, engine=engine))
+        # Another process may replace the sidecar between the two calls
+        with suppress(FileNotFoundError):
+            df = pd.read_pickle(cache_fname)
+            logger.debug(f'Reading {fname} from cache {cache_fname.name}')
+            return df
+
+    logger.debug(f'Parsing {fname} ({engine} engine)')
+    df = pd.read_csv(fname, engine=engine, **kwargs)
+    if cache:
+        for t_fname in fname.parent.glob(f'.{fname.name}.*.pkl'):
+            with suppress(FileNotFoundError):
+                t_fname.unlink()
+        # Write and rename, so readers never see a partial sidecar
+        t_fname = cache_fname.with_name(
+            f'{cache_fname.name}.{os.getpid()}.tmp')
+        try:
+            df.to_pickle(t_fname)
+            os.replace(t_fname, cache_fname)
+        except OSError as e:
+            logger.warning(f'Could not cache {fname}: {e}')
+            with suppress(FileNotFoundError):
+                t_fname.unlink()
+    return df
+
+
+def read_prs(fname, cache=True):
+    """Read polygenic risk scores
+
+    Parameters
+    ----------
+    fname : str or pathlib.Path
+        The TSV file, with the subject IDs in the first row and the scores
+        in the second one.
+    cache : bool
+        Whether to cache the parsed file in a binary sidecar (defaults to
+        True).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the scores, indexed by SubjectID.
+    """
+    data = _read_csv_cached(
+        fname, cache=cache, sep='\t', header=None, dtype=np.float64)
+    data = data.to_numpy()
+    subj_id = _to_subject_ids(data[0])
     prs = data[1]
-    vfunc = np.vectorize(lambda x: f'sub-{x}')
-    subj_id = vfunc(subj_id)
     df = pd.DataFrame({'SubjectID': subj_id, 'prs': prs})
     return df.set_index('SubjectID').dropna()
 
 
-def read_pheno(fname):
-    df = pd.read_csv(fname, sep=',')
-    df['SubjectID'] = [f'sub-{x}' for x in df['eid']]  # type: ignore
+def read_pheno(fname, columns=None, dtype=None, categories=None, cache=True):
+    """Read phenotypes
+
+    Parameters
+    ----------
+    fname : str or pathlib.Path
+        The CSV file, with the subject IDs in the 'eid' column.
+    columns : list(str) | None
+        The columns to read. If None (default), read all the columns.
+    dtype : dict(str, dtype) | None
+        The dtype of some of the columns. If None (default), they are
+        inferred.
+    categories : list(str) | None
+        The columns to read as categoricals (defaults to None).
+    cache : bool
+        Whether to cache the parsed file in a binary sidecar (defaults to
+        True).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the phenotypes, indexed by SubjectID.
+    """
+    usecols = None
+    if columns is not None:
+        usecols = ['eid'] + [x for x in columns if x != 'eid']
+    dtype = {} if dtype is None else dict(dtype)
+    if categories is not None:
+        dtype.update({x: 'category' for x in categories})
+    df = _read_csv_cached(
+        fname, cache=cache, sep=',', usecols=usecols,
+        dtype=dtype if len(dtype) > 0 else None)
+    df['SubjectID'] = 'sub-' + df['eid'].astype(str)  # type: ignore
 
     df.drop(columns={'eid'}, inplace=True)  # type: ignore
 
     return df.set_index('SubjectID')  # type: ignore
 
 
+def read_snps(fname, snps):
+    """Read some SNPs from a genotype TSV file
+
+    The file has one row per SNP (name followed by one genotype per
+    subject) and a header row with the subject IDs. It is scanned line by
+    line and only the requested rows are kept, so memory does not depend
+    on the number of SNPs in the file.
+
+    Parameters
+    ----------
+    fname : str or pathlib.Path
+        The genotype file.
+    snps : list(str)
+        The names of the SNPs to read.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with one column per SNP, indexed by SubjectID.
+    """
+    snps = list(snps)
+    to_find = set(snps)
+    data = {}
+    with open(fname) as fid:
+        header = fid.readline().rstrip('\r\n').split('\t')
+        subj_id = _to_subject_ids(header[1:])
+        for line in fid:
+            name, _, values = line.partition('\t')
+            if name in to_find:
+                data[name] = values.rstrip('\r\n').split('\t')
+                to_find.remove(name)
+                if len(to_find) == 0:
+                    break
+    if len(to_find) > 0:
+        raise_error(f'SNPs not found in {fname}: {sorted(to_find)}')
+    df = pd.DataFrame(
+        {x: data[x] for x in snps}, index=pd.Index(subj_id, name='SubjectID'))
+    return df
+
+
 def read_apoe(fname):
-    data = np.genfromtxt(fname=fname, delimiter="\t", dtype=str)
-    subj_id = data[0, 1:].astype(int)
-    vfunc = np.vectorize(lambda x: f'sub-{x}')
-    subj_id = vfunc(subj_id)
-    data_dict = {'SubjectID': subj_id}
-    for col in data[1:]:
-        col_name = col[0]
-        col_data = col[1:]
-        data_dict[col_name] = col_data
-
-    df = pd.DataFrame(data_dict).set_index('SubjectID')
+    df = read_snps(fname, ['rs429358', 'rs7412'])
     df['APOE'] = df['rs429358'] + df['rs7412']
     return df
 
 
-def read_features_jay(features_path):
+def read_jay_files(features_path, features, key='SubjectID', n_jobs=1):
+    """Read and align features from several datatable .jay files
+
+    Each file is filtered for missing values on its own. The frames are
+    then aligned on the key once, keeping only the samples present
+    (without missing values) in all the files, in the row order of the
+    first file (sorted by key, as the frames are keyed). This is the same
+    result as left-joining the files and dropping incomplete rows.
+
+    The files are opened one after the other: .jay files are memory-mapped,
+    so opening them is cheap, and datatable is not safe to call from
+    several Python threads (concurrent freads can mix up frames). The
+    thread budget is given to datatable, which parallelises the filtering,
+    the row selection and the conversion to pandas internally.
+
+    Parameters
+    ----------
+    features_path : pathlib.Path
+        The directory with the files.
+    features : dict(str, str)
+        The file names to read and the prefix to use for their columns.
+    key : str
+        The column used to align the files (defaults to 'SubjectID').
+    n_jobs : int
+        The number of threads used by datatable (defaults to 1).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the features, indexed by the key.
+    """
     import datatable
-    from datatable import dt, fread, f
-    datatable.options.nthreads = 1
+    from datatable import dt, fread
+
+    datatable.options.nthreads = n_jobs
+    frames = []
+    common = None
+    for fname, prefix in features.items():
+        logger.info(f"Reading features from {fname}")
+        t_dt = fread(features_path / fname)
+        t_dt.key = key
+        t_dt.names = {
+            col: f"{prefix}_{col.replace('(', '').replace(')', '')}"
+            for col in t_dt.names if col != key
+        }
+        n_samples = t_dt.shape[0]
+        # Drop the samples with missing features before aligning
+        t_dt = t_dt[dt.rowall(dt.f[:] != None), :]  # noqa: E711
+        logger.info(f"\tSamples: {n_samples} ({t_dt.shape[0]} complete)")
+        logger.info(f"\tFeatures: {t_dt.shape[1] - 1}")
+        t_keys = pd.Index(t_dt[key].to_list()[0])
+        common = t_keys if common is None else common.intersection(t_keys)
+        frames.append((t_dt, t_keys))
+
+    logger.info("Aligning samples")
+    first_keys = frames[0][1]
+    common = first_keys[first_keys.isin(common)]
+    final_dt = None
+    for t_dt, t_keys in frames:
+        t_rows = t_keys.get_indexer(common).tolist()
+        if final_dt is None:
+            final_dt = t_dt[t_rows, :]
+        else:
+            final_dt.cbind(t_dt[t_rows, dt.f[:].remove(dt.f[key])])
+    logger.info(f"\tSamples: {final_dt.shape[0]}")
+    logger.info(f"\tFeatures: {final_dt.shape[1] - 1}")
+    logger.info("Converting to pandas")
+    final_df = final_dt.to_pandas()
+    logger.info("Reading done")
+    return final_df.set_index(key)
+
+
+def read_features_jay(features_path, n_jobs=1):
     features = {
         "1_gmd_schaefer_all_subjects.jay": "GMD_Schaefer1000x7",
         "2_gmd_SUIT_all_subjects.jay": "GMD_SUIT",
@@ -170,28 +722,624 @@ def read_features_jay(features_path):
         "LCOR_SUIT_Mean.jay": "LCOR_SUIT",
         "LCOR_Tian_Mean.jay": "LCOR_Tian",
     }
+    return read_jay_files(features_path, features, n_jobs=n_jobs)
 
 
-    final_dt = None
-    for fname, prefix in features.items():
-        logger.info(f"Reading features from {fname}")
-        t_dt = fread(features_path / fname)
-        t_dt.key = "SubjectID"
-        t_dt.names = {
-            col: f"{prefix}_{col.replace('(', '').replace(')', '')}"
-            for col in t_dt.names if col != "SubjectID"
-        }
-        logger.info(f"\tSamples: {t_dt.shape[0]}")
-        logger.info(f"\tFeatures: {t_dt.shape[1] - 1}")
-        if final_dt is None:
-            final_dt = t_dt
+DTYPE_POLICY = {
+    'float': 'float32',
+    'categories': ['subject', 'task', 'event', 'response_prompt'],
+    'integers': ['timepoint', 'n_trial'],
+}
+
+
+def _memory_groups(df, exclude=()):
+    """Get the memory used by each group of columns, in bytes
+
+    Float columns are grouped by their prefix (e.g. 'DEFAULT' for
+    'DEFAULT_a~b'), the other columns are reported by name and the index
+    levels as 'index'.
+    """
+    usage = df.memory_usage(deep=True, index=False)
+    groups = [
+        str(x).split('_')[0]
+        if pd.api.types.is_float_dtype(df[x]) and x not in exclude
+        else str(x) for x in df.columns]
+    usage = usage.groupby(groups, sort=False).sum()
+    usage['index'] = df.index.memory_usage(deep=True)
+    return usage
+
+
+def _apply_policy(df, float_dtype, categories, integers):
+    df = df.copy()
+    for x in df.columns:
+        if x in categories:
+            df[x] = df[x].astype('category')
+        elif x in integers:
+            df[x] = pd.to_numeric(df[x], downcast='integer')
+        elif pd.api.types.is_float_dtype(df[x]):
+            df[x] = df[x].astype(float_dtype)
+    return df
+
+
+def apply_dtype_policy(df, policy=None):
+    """Downcast a DataFrame of features to save memory
+
+    Float features are cast to float32, string columns (e.g. 'subject',
+    'event', 'response_prompt') to categoricals and integer columns (e.g.
+    'timepoint', 'n_trial') to the narrowest integer type that holds their
+    values. Index levels follow the same rules, so they keep their dtype
+    when moved to columns. The memory used by each group of columns before
+    and after is logged.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The features.
+    policy : dict | None
+        The policy, with the keys of `DTYPE_POLICY` ('float' dtype and
+        lists of 'categories' and 'integers' columns). Missing keys are
+        taken from `DTYPE_POLICY`. If None (default), use `DTYPE_POLICY`.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The downcast features (a copy).
+    """
+    policy = {**DTYPE_POLICY, **({} if policy is None else policy)}
+    categories, integers = policy['categories'], policy['integers']
+    before = _memory_groups(df, exclude=integers)
+
+    out = _apply_policy(df, policy['float'], categories, integers)
+    if any(x is not None for x in df.index.names):
+        index = _apply_policy(
+            df.index.to_frame(index=False), policy['float'], categories,
+            integers)
+        if index.shape[1] == 1:
+            out.index = pd.Index(index.iloc[:, 0])
         else:
-            final_dt = final_dt[:, :, dt.join(t_dt)]
-    logger.info("Filtering out samples with missing features")
-    final_dt = final_dt[dt.rowall(f[:] != None), :]
-    logger.info(f"\tSamples: {final_dt.shape[0]}")
-    logger.info(f"\tFeatures: {final_dt.shape[1] - 1}")
-    logger.info("Converting to pandas")
-    final_df = final_dt.to_pandas()
-    logger.info("Reading done")
-    return final_df.set_index('SubjectID')
+            out.index = pd.MultiIndex.from_frame(index)
+
+    after = _memory_groups(out, exclude=integers)
+    report = pd.DataFrame({'before': before, 'after': after}) / 2 ** 20
+    for t_group, t_row in report.iterrows():
+        logger.info(
+            f'{t_group}: {t_row["before"]:.2f} MB -> '
+            f'{t_row["after"]:.2f} MB')
+    logger.info(
+        f'Dtype policy: {report["before"].sum():.2f} MB -> '
+        f'{report["after"].sum():.2f} MB')
+    return out
+
+
+def _match_columns(names, patterns):
+    """Select the names that fully match any of the regex patterns"""
+    if patterns is None:
+        return list(names)
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    regexes = [re.compile(p) for p in patterns]
+    return [x for x in names if any(r.fullmatch(x) for r in regexes)]
+
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _partitioning(partition_col):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(
+        pa.schema([(x, pa.string()) for x in _as_list(partition_col)]),
+        flavor='hive')
+
+
+def _dataset_partitions(path):
+    """Get the hive partition columns of a dataset from its layout"""
+    names = []
+    t_path = Path(path)
+    while True:
+        t_dirs = [x for x in t_path.iterdir() if x.is_dir() and '=' in x.name]
+        if len(t_dirs) == 0:
+            return names
+        names.append(t_dirs[0].name.split('=', 1)[0])
+        t_path = t_dirs[0]
+
+
+def _open_dataset(path, partition_col=None):
+    import pyarrow.dataset as ds
+    if partition_col is None:
+        partition_col = _dataset_partitions(path)
+    return ds.dataset(
+        str(path), format='parquet',
+        partitioning=_partitioning(partition_col))
+
+
+def save_features_parquet(df, path, partition_col='subject',
+                          compression='zstd', max_rows_per_group=None,
+                          overwrite=False):
+    """Save features as a Parquet dataset partitioned by subject
+
+    Each partition is written to ``<path>/<partition_col>=<value>/`` so that
+    readers only open the files of the requested subjects. With several
+    partition columns, partitions are nested in the given order (e.g.
+    ``<path>/task=ES/subject=sub-01/``). Index levels are stored as regular
+    columns. Existing partitions for the same values are replaced, the
+    others are kept unless ``overwrite``. The dataset is recorded in the
+    catalog of its parent directory (see `update_catalog`).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The DataFrame with the features.
+    path : str or pathlib.Path
+        The root directory of the dataset.
+    partition_col : str or list(str)
+        The column(s) (or index levels) used to partition the dataset
+        (defaults to 'subject').
+    compression : str
+        The Parquet compression codec (defaults to 'zstd').
+    max_rows_per_group : int | None
+        The maximum number of rows of each Parquet row group. If None
+        (default), use the pyarrow default.
+    overwrite : bool
+        If True, delete the whole dataset first (e.g. for a full export,
+        so the partitions of dropped subjects do not survive). Defaults to
+        False.
+    """
+    import shutil
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    t_df = df
+    if any(x is not None for x in df.index.names):
+        t_df = df.reset_index()
+    partition_col = _as_list(partition_col)
+    for t_col in partition_col:
+        if t_col not in t_df.columns:
+            raise_error(f'Partition column {t_col} not in the features')
+    logger.debug(f'Saving features to {path} (partitioned by {partition_col})')
+    if overwrite and Path(path).exists():
+        logger.debug(f'Deleting the existing dataset {path}')
+        shutil.rmtree(path)
+    table = pa.Table.from_pandas(t_df, preserve_index=False)
+    for t_col in partition_col:
+        t_idx = table.schema.get_field_index(t_col)
+        table = table.set_column(
+            t_idx, t_col, table.column(t_idx).cast(pa.string()))
+    fmt = ds.ParquetFileFormat()
+    kwargs = {}
+    if max_rows_per_group is not None:
+        kwargs['min_rows_per_group'] = 0
+        kwargs['max_rows_per_group'] = max_rows_per_group
+    # Single threaded so rows keep their order within each partition
+    ds.write_dataset(
+        table, str(path), format=fmt,
+        partitioning=_partitioning(partition_col),
+        file_options=fmt.make_write_options(compression=compression),
+        existing_data_behavior='delete_matching',
+        use_threads=False, **kwargs)
+
+    n_rows = _open_dataset(path, partition_col).count_rows()
+    update_catalog(
+        path, Path(path).name, df, n_rows=n_rows, merge=not overwrite)
+
+
+def read_features_parquet(path, columns=None, subjects=None, timepoints=None,
+                          index_col=('subject', 'timepoint'),
+                          partition_col=None, tasks=None):
+    """Read features from a Parquet dataset partitioned by subject
+
+    Only the partitions of the requested subjects (and tasks) and the
+    columns matching the projection are read from disk.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The root directory of the dataset.
+    columns : str or list(str) | None
+        Regular expressions selecting the columns to read. A column is read
+        if it fully matches any of them (same rule as julearn X_types).
+        If None (default), read all the columns. The index columns are
+        always read.
+    subjects : list(str) | None
+        The subjects to read. If None (default), read all the subjects.
+    timepoints : list(int) | None
+        The timepoints to read. If None (default), read all the timepoints.
+    index_col : list(str) | None
+        The columns to be used as index (defaults to subject and timepoint).
+    partition_col : str or list(str) | None
+        The column(s) used to partition the dataset. If None (default),
+        they are taken from the directory layout.
+    tasks : list(str) | None
+        The tasks to read (requires a 'task' column, see
+        `nimrls.convert.hdf5_to_parquet`). If None (default), read all the
+        tasks.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The DataFrame with the features
+    """
+    import pyarrow.dataset as ds
+    dataset = _open_dataset(path, partition_col)
+    index_col = [] if index_col is None else list(index_col)
+    names = [x for x in dataset.schema.names if x not in index_col]
+    to_read = index_col + _match_columns(names, columns)
+
+    row_filter = None
+    for t_name, t_values in [
+            ('subject', subjects), ('task', tasks),
+            ('timepoint', timepoints)]:
+        if t_values is None:
+            continue
+        if t_name not in dataset.schema.names:
+            raise_error(f'Can not filter by {t_name}, no such column')
+        t_filter = ds.field(t_name).isin(list(t_values))
+        row_filter = (
+            t_filter if row_filter is None else row_filter & t_filter)
+
+    logger.debug(
+        f'Reading {len(to_read)} of {len(dataset.schema.names)} columns '
+        f'from {path}')
+    table = dataset.to_table(columns=to_read, filter=row_filter)
+    df = table.to_pandas()
+    if len(index_col) > 0:
+        df = df.set_index(index_col)
+    return df
+
+
+def save_features_jay(df, fname):
+    """Save features as a datatable .jay file
+
+    Index levels are stored as regular columns. The file is recorded in
+    the catalog of its directory (see `update_catalog`).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The DataFrame with the features.
+    fname : str or pathlib.Path
+        The file name.
+    """
+    from datatable import dt
+    t_df = df
+    if any(x is not None for x in df.index.names):
+        t_df = df.reset_index()
+    logger.debug(f'Saving features to {fname}')
+    dt.Frame(t_df).to_jay(str(fname))
+    update_catalog(fname, Path(fname).name, df)
+
+
+def _chunk_bounds(n_rows, chunksize):
+    for start in range(0, n_rows, chunksize):
+        yield start, min(start + chunksize, n_rows)
+
+
+def _iter_parquet(path, by, chunksize, columns, index_col):
+    import pyarrow.dataset as ds
+    dataset = _open_dataset(path)
+    names = [x for x in dataset.schema.names if x not in index_col]
+    to_read = index_col + _match_columns(names, columns)
+
+    def _to_frame(table):
+        df = table.to_pandas()
+        return df.set_index(index_col) if len(index_col) > 0 else df
+
+    if by is not None:
+        values = dataset.to_table(columns=[by]).column(by).unique()
+        for t_value in values.to_pylist():
+            yield _to_frame(dataset.to_table(
+                columns=to_read, filter=ds.field(by) == t_value))
+    else:
+        for t_batch in dataset.to_batches(
+                columns=to_read, batch_size=chunksize):
+            if t_batch.num_rows > 0:
+                yield _to_frame(t_batch)
+
+
+def _iter_jay(fname, by, chunksize, columns, index_col):
+    from datatable import fread
+    # .jay files are memory-mapped, only the selected rows are converted
+    frame = fread(fname)
+    names = [x for x in frame.names if x not in index_col]
+    to_read = index_col + _match_columns(names, columns)
+
+    def _to_frame(rows):
+        df = frame[rows, to_read].to_pandas()
+        return df.set_index(index_col) if len(index_col) > 0 else df
+
+    if by is not None:
+        values = pd.Series(frame[:, by].to_list()[0])
+        for t_rows in values.groupby(values, sort=False).indices.values():
+            yield _to_frame(t_rows.tolist())
+    else:
+        for start, stop in _chunk_bounds(frame.shape[0], chunksize):
+            yield _to_frame(slice(start, stop))
+
+
+def _h5_str(dataset):
+    """Decode a unicode string stored by junifer as an uint8 array"""
+    return bytes(dataset[()]).decode('utf-8')
+
+
+def _h5_list(group):
+    return [group[f'idx_{i}'] for i in range(len(group))]
+
+
+def _iter_hdf5(fname, feature_name, by, chunksize, columns):
+    import h5py
+    with h5py.File(fname, 'r') as fid:
+        meta = json.loads(_h5_str(fid['meta']))
+        md5s = [k for k, v in meta.items() if v['name'] == feature_name]
+        if len(md5s) != 1:
+            raise_error(
+                f'Expected one feature named {feature_name}, found '
+                f'{len(md5s)}')
+        group = fid[md5s[0]]
+        kind = _h5_str(group['key_kind'])
+        if kind != 'timeseries':
+            # Other layouts are stored as a single block: load it whole
+            logger.warning(
+                f'Feature kind {kind} can not be read by parts, loading '
+                'it in memory')
+            df = get_storage(fname, kind='hdf5').read_df(feature_name)
+            if by is not None:
+                for _, t_df in df.groupby(level=by, sort=False):
+                    yield t_df
+            else:
+                for start, stop in _chunk_bounds(df.shape[0], chunksize):
+                    yield df.iloc[start:stop]
+            return
+
+        names = [_h5_str(x) for x in _h5_list(group['key_column_headers'])]
+        col_idx = [names.index(x) for x in _match_columns(names, columns)]
+        row_name = _h5_str(group['key_row_header_column_name'])
+        elements = [
+            {k[4:]: _h5_str(v) for k, v in x.items()}
+            for x in _h5_list(group['key_element'])]
+        data = _h5_list(group['key_data'])
+
+        def _read(t_elements, start=0, stop=None):
+            frames = []
+            for i in t_elements:
+                t_data = data[i][start:stop, col_idx]
+                t_index = pd.DataFrame({
+                    k: [v] * t_data.shape[0] for k, v in elements[i].items()})
+                t_index[row_name] = np.arange(start, start + t_data.shape[0])
+                frames.append(pd.DataFrame(
+                    t_data, columns=[names[x] for x in col_idx],
+                    index=pd.MultiIndex.from_frame(t_index)))
+            return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+        if by is not None:
+            values = pd.Series([x[by] for x in elements])
+            for t_elements in values.groupby(
+                    values, sort=False).indices.values():
+                yield _read(t_elements)
+        else:
+            for i, t_data in enumerate(data):
+                for start, stop in _chunk_bounds(t_data.shape[0], chunksize):
+                    yield _read([i], start, stop)
+
+
+def iter_features(source, by=None, chunksize=None, columns=None,
+                  feature_name=None, index_col=('subject', 'timepoint')):
+    """Iterate over features by parts, to process them in bounded memory
+
+    Exactly one of ``by`` or ``chunksize`` must be given. Only the rows of
+    each part and the selected columns are read from disk.
+
+    Supported sources:
+
+    * Parquet datasets written by `save_features_parquet` (a directory).
+    * datatable ``.jay`` files (memory-mapped).
+    * junifer HDF5 storages (``.hdf5``/``.h5``, requires ``feature_name``).
+      Timeseries features are read element by element; other kinds are
+      loaded whole and then split.
+
+    Parameters
+    ----------
+    source : str or pathlib.Path
+        The features to read.
+    by : str | None
+        Yield one part per value of this column (e.g. 'subject').
+    chunksize : int | None
+        Yield parts of at most this number of rows. For HDF5, parts do not
+        span several elements.
+    columns : str or list(str) | None
+        Regular expressions selecting the columns to read (see
+        `read_features_parquet`). If None (default), read all the columns.
+    feature_name : str | None
+        The name of the feature (HDF5 sources only).
+    index_col : list(str)
+        The columns to be used as index (Parquet and jay sources only,
+        defaults to subject and timepoint). HDF5 sources are indexed by the
+        junifer element and row header.
+
+    Yields
+    ------
+    df : pandas.DataFrame
+        One part of the features.
+    """
+    if (by is None) == (chunksize is None):
+        raise_error('Exactly one of by or chunksize must be specified')
+    source = Path(source)
+    index_col = [] if index_col is None else list(index_col)
+    logger.debug(
+        f'Iterating over {source} '
+        f'({f"by {by}" if by is not None else f"{chunksize} rows"})')
+    if source.is_dir():
+        yield from _iter_parquet(source, by, chunksize, columns, index_col)
+    elif source.suffix == '.jay':
+        yield from _iter_jay(source, by, chunksize, columns, index_col)
+    elif source.suffix in ['.hdf5', '.h5']:
+        if feature_name is None:
+            raise_error('feature_name is required to read HDF5 sources')
+        yield from _iter_hdf5(source, feature_name, by, chunksize, columns)
+    else:
+        raise_error(f'Unknown features source {source}')
+
+
+CATALOG_FNAME = 'catalog.json'
+
+
+def _index_values(df, name):
+    """Get the unique values of an index level or column, if present"""
+    if name in df.index.names:
+        values = df.index.get_level_values(name)
+    elif name in df.columns:
+        values = df[name]
+    else:
+        return []
+    return sorted(str(x) for x in pd.unique(values))
+
+
+def _content_hash(fname, old_files=None):
+    """Hash the file (or the files of a directory) written on disk
+
+    Files with the same size and modification time as in ``old_files``
+    (the previous catalog entry) are not read again.
+    """
+    from .fingerprint import fingerprint, hash_file
+    fname = Path(fname)
+    files = fingerprint(fname, full=False)
+    old_files = {} if old_files is None else old_files
+    content = hashlib.blake2b(digest_size=16)
+    for t_name in sorted(files):
+        t_fp = files[t_name]
+        t_old = old_files.get(t_name, {})
+        if (t_old.get('size') == t_fp['size']
+                and t_old.get('mtime_ns') == t_fp['mtime_ns']):
+            t_fp['hash'] = t_old['hash']
+        else:
+            t_fname = fname if t_name == '.' else fname / t_name
+            t_fp['hash'] = hash_file(t_fname)[1]
+        content.update(f'{t_name}:{t_fp["hash"]}\n'.encode('utf-8'))
+    return content.hexdigest(), files
+
+
+@contextmanager
+def _catalog_lock(catalog_fname):
+    """Hold an exclusive lock on a catalog (between processes)"""
+    try:
+        import fcntl
+    except ImportError:
+        # No file locks (Windows), writers are not serialised
+        yield
+        return
+    lock_fname = catalog_fname.with_name(f'.{catalog_fname.name}.lock')
+    with open(lock_fname, 'w') as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+def _load_catalog(catalog_fname):
+    if not catalog_fname.exists():
+        return {}
+    with open(catalog_fname) as fid:
+        return json.load(fid)
+
+
+def _catalog_entry(df, location):
+    """Describe a DataFrame of features for the catalog"""
+    columns = pd.Series([str(x) for x in df.columns], dtype=object)
+    groups = columns.str.split('_').str[0].value_counts(sort=False)
+    dtypes = df.dtypes.astype(str).value_counts(sort=False)
+    subjects = _index_values(df, 'subject')
+    if len(subjects) == 0:
+        subjects = _index_values(df, 'SubjectID')
+    return {
+        'location': str(location),
+        'n_rows': int(df.shape[0]),
+        'n_columns': int(df.shape[1]),
+        'dtypes': {k: int(v) for k, v in dtypes.items()},
+        'subjects': subjects,
+        'tasks': _index_values(df, 'task'),
+        'column_groups': {k: int(v) for k, v in groups.items()},
+        'updated': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def update_catalog(fname, name, df, n_rows=None, merge=False):
+    """Record a written feature in the catalog of its directory
+
+    The catalog is a JSON file (``catalog.json``) next to the features,
+    with the shape, dtypes, subjects, tasks, column groups (prefix before
+    the first '_') and content hash of each feature. It is updated by the
+    nimrls writers, so features can be listed without opening them. The
+    content hash is computed from the files on disk. Updates are
+    serialised with a lock file, so concurrent writers (e.g. per-subject
+    jobs) do not lose entries.
+
+    Parameters
+    ----------
+    fname : str or pathlib.Path
+        The file (or dataset directory) where the feature was written.
+    name : str
+        The name of the feature in the catalog.
+    df : pandas.DataFrame
+        The DataFrame that was written.
+    n_rows : int | None
+        The number of rows of the feature after the write, if it differs
+        from the rows of df (incremental writes). Defaults to None.
+    merge : bool
+        If True, the write added to or replaced part of an existing
+        feature: subjects and tasks are merged with the previous entry.
+        Defaults to False.
+    """
+    fname = Path(fname)
+    catalog_fname = fname.parent / CATALOG_FNAME
+    entry = _catalog_entry(df, fname.name)
+    if n_rows is not None:
+        entry['n_rows'] = int(n_rows)
+
+    with _catalog_lock(catalog_fname):
+        catalog = _load_catalog(catalog_fname)
+        old = catalog.get(name)
+        if merge and old is not None:
+            for t_key in ['subjects', 'tasks']:
+                entry[t_key] = sorted(set(old[t_key]) | set(entry[t_key]))
+        # Files shared by several entries (e.g. tables of a database)
+        old_files = {}
+        for t_entry in catalog.values():
+            if t_entry['location'] == entry['location']:
+                old_files = t_entry.get('files', {})
+        entry['content_hash'], entry['files'] = _content_hash(
+            fname, old_files)
+        catalog[name] = entry
+
+        logger.debug(f'Updating catalog {catalog_fname} ({name})')
+        t_fname = catalog_fname.with_name(
+            f'.{CATALOG_FNAME}.{os.getpid()}')
+        with open(t_fname, 'w') as fid:
+            json.dump(catalog, fid, indent=1)
+        os.replace(t_fname, catalog_fname)
+
+
+def read_catalog(path):
+    """List the features recorded in a catalog
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The directory with the features (or the catalog file itself).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        One row per feature, indexed by name.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / CATALOG_FNAME
+    if not path.exists():
+        raise_error(f'No feature catalog in {path.parent}')
+    with open(path) as fid:
+        catalog = json.load(fid)
+    df = pd.DataFrame.from_dict(catalog, orient='index')
+    # The per-file fingerprints are only used to update the hashes
+    df = df.drop(columns='files', errors='ignore')
+    df.index.name = 'name'
+    return df
@@ -1,22 +1,106 @@
+import hashlib
+import re
+from collections import OrderedDict
+
 import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid, check_cv
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
 from sklearn.svm import LinearSVC
+from sklearn.utils import _safe_indexing
 
-from .logging import logger
+from .logging import logger, raise_error
 
 
-def heuristic_C(data=None):
-    """
-    Calculate the heuristic C for linearSVR (Joachims 2002).
-    """
+# Heuristic C of the last matrices seen, by fingerprint (least recently
+# used first)
+_HEURISTIC_C = OrderedDict()
+_HEURISTIC_C_SIZE = 32
+
+
+def _fingerprint(data, n_rows=64):
+    """Cheap key of a matrix: id, shape, dtype and a hash of strided rows"""
+    from scipy import sparse
+    content = hashlib.blake2b(digest_size=16)
+    if sparse.issparse(data):
+        values = data.data
+        step = max(1, len(values) // (n_rows * 64))
+        content.update(np.ascontiguousarray(values[::step]).tobytes())
+        dtype = values.dtype
+    else:
+        rows = np.unique(
+            np.linspace(0, data.shape[0] - 1, n_rows).astype(int))
+        if hasattr(data, "iloc"):
+            sample = data.iloc[rows].to_numpy()
+        else:
+            sample = np.asarray(data[rows])
+        content.update(np.ascontiguousarray(sample).tobytes())
+        dtype = sample.dtype
+    return (id(data), data.shape, str(dtype), content.hexdigest())
 
-    if data is None:
-        logger.error("No data was provided.")
 
-    C = 1 / np.mean(np.sqrt((data**2).sum(axis=1)))
+def _sum_row_norms(data, chunksize):
+    """Sum of the L2 norms of the rows, without squaring the whole matrix"""
+    from scipy import sparse
+    from sklearn.utils.extmath import row_norms
+    if sparse.issparse(data):
+        return float(row_norms(data.tocsr()).sum(dtype=np.float64))
+    total = 0.
+    n_rows = data.shape[0]
+    for start in range(0, n_rows, chunksize):
+        if hasattr(data, "iloc"):
+            # Only a chunk of the DataFrame is converted at a time
+            chunk = data.iloc[start:start + chunksize].to_numpy()
+        else:
+            chunk = np.asarray(data[start:start + chunksize])
+        if chunk.dtype not in [np.float32, np.float64]:
+            chunk = chunk.astype(np.float64)
+        total += row_norms(chunk).sum(dtype=np.float64)
+    return total
 
-    # Formular Kaustubh: C = 1/mean(sqrt(rowSums(data^2)))
 
+def heuristic_C(data=None, chunksize=4096, cache=True):
+    """Calculate the heuristic C for linear SVMs (Joachims 2002)
+
+    C = 1 / mean(sqrt(rowSums(data^2))). The row norms are computed by
+    chunks of rows, without a squared copy of the data. Dense (float32 or
+    float64), pandas and scipy sparse data are supported.
+
+    Parameters
+    ----------
+    data : array-like or sparse matrix
+        The training data (samples x features).
+    chunksize : int
+        The number of rows processed at a time (defaults to 4096).
+    cache : bool
+        Whether to reuse the value computed for the same matrix (defaults
+        to True). The matrix is identified by its id, shape, dtype and a
+        hash of evenly spaced rows, so fitting the same fold again does
+        not recompute the norms and an in-place change of those rows does.
+
+    Returns
+    -------
+    C : float
+        The heuristic C.
+    """
+    if data is None:
+        raise_error("No data was provided.")
+    if data.shape[0] == 0:
+        raise_error("Cannot compute the heuristic C of empty data.")
+    if cache:
+        key = _fingerprint(data)
+        if key in _HEURISTIC_C:
+            _HEURISTIC_C.move_to_end(key)
+            logger.debug(f"Using cached heuristic C = {_HEURISTIC_C[key]}")
+            return _HEURISTIC_C[key]
+    C = 1 / (_sum_row_norms(data, chunksize) / data.shape[0])
+    if cache:
+        _HEURISTIC_C[key] = C
+        if len(_HEURISTIC_C) > _HEURISTIC_C_SIZE:
+            _HEURISTIC_C.popitem(last=False)
     return C
 
 
@@ -31,7 +115,7 @@ class LinearSVCHeuristicC(LinearSVC):
     def fit(self, X, y, sample_weight=None):
         # calculate heuristic C
         C = heuristic_C(X)
-        logger.info(f"Using heuristic C = {C} for LinearSVC")
+        logger.debug(f"Using heuristic C = {C} for LinearSVC")
 
         # set C value
         self.C = C
@@ -53,7 +137,7 @@ class LogisticRegressionHeuristicC(LogisticRegression):
     def fit(self, X, y, sample_weight=None):
         # calculate heuristic C
         C = heuristic_C(X)
-        logger.info(f"Using heuristic C = {C} for LogisticRegression")
+        logger.debug(f"Using heuristic C = {C} for LogisticRegression")
 
         # set C value
         self.C = C
@@ -61,3 +145,1029 @@ class LogisticRegressionHeuristicC(LogisticRegression):
         # call super fit method
         super().fit(X, y, sample_weight=sample_weight)
         return self  # convention in scikitlearn
+
+
+class SharedPreprocessingGridSearchCV(ClassifierMixin, BaseEstimator):
+    """Grid search that fits the preprocessing once per inner split
+
+    Equivalent to a `GridSearchCV` over ``Pipeline([preprocessing,
+    estimator])`` in which only the estimator parameters are searched, but
+    the preprocessing (e.g. zscore, PCA) is fitted once per inner split and
+    its output reused for every candidate, instead of once per candidate
+    and split. After the search, the preprocessing and the best estimator
+    are refitted on all the data.
+
+    Parameters
+    ----------
+    preprocessing : transformer | None
+        The preprocessing (e.g. a Pipeline of StandardScaler and PCA). If
+        None, the estimator is fitted on the input data.
+    estimator : classifier
+        The final estimator.
+    param_grid : dict or list(dict)
+        The estimator parameters to search.
+    cv : int, cross-validation generator or iterable
+        The inner cross-validation (defaults to 5 stratified folds).
+    scoring : str or callable
+        The score to maximise (defaults to 'balanced_accuracy').
+    """
+
+    def __init__(self, preprocessing, estimator, param_grid, cv=5,
+                 scoring="balanced_accuracy"):
+        self.preprocessing = preprocessing
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+
+    def _preprocessing(self):
+        if self.preprocessing is None:
+            return "passthrough"
+        return clone(self.preprocessing)
+
+    def fit(self, X, y, groups=None):
+        cv = check_cv(self.cv, y, classifier=True)
+        scorer = check_scoring(self.estimator, scoring=self.scoring)
+        candidates = list(ParameterGrid(self.param_grid))
+        n_splits = cv.get_n_splits(X, y, groups)
+        scores = np.empty((len(candidates), n_splits))
+        for i_split, (train, test) in enumerate(cv.split(X, y, groups)):
+            y_train = _safe_indexing(y, train)
+            X_train = _safe_indexing(X, train)
+            X_test = _safe_indexing(X, test)
+            if self.preprocessing is not None:
+                prepro = clone(self.preprocessing)
+                X_train = prepro.fit_transform(X_train, y_train)
+                X_test = prepro.transform(X_test)
+            for i_cand, params in enumerate(candidates):
+                t_est = clone(self.estimator).set_params(**params)
+                t_est.fit(X_train, y_train)
+                scores[i_cand, i_split] = scorer(
+                    t_est, X_test, _safe_indexing(y, test))
+
+        mean = scores.mean(axis=1)
+        self.cv_results_ = {
+            "params": candidates,
+            "mean_test_score": mean,
+            "std_test_score": scores.std(axis=1),
+            "rank_test_score": (
+                np.argsort(np.argsort(-mean, kind="stable")) + 1),
+        }
+        for i_split in range(n_splits):
+            self.cv_results_[f"split{i_split}_test_score"] = scores[
+                :, i_split]
+        self.best_index_ = int(np.argmax(mean))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = float(mean[self.best_index_])
+        logger.info(
+            f"Best parameters {self.best_params_} "
+            f"(score {self.best_score_:.3f})")
+
+        self.best_estimator_ = Pipeline([
+            ("preprocessing", self._preprocessing()),
+            ("estimator",
+             clone(self.estimator).set_params(**self.best_params_)),
+        ]).fit(X, y)
+        self.classes_ = self.best_estimator_.classes_
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def decision_function(self, X):
+        return self.best_estimator_.decision_function(X)
+
+
+def _squared_hinge_data(params, X, y, sample_weight):
+    """Squared hinge loss (without penalty) and its gradient
+
+    The products with X are done in the dtype of X, so float32 data are
+    not upcast.
+    """
+    w, b = params[:-1], params[-1]
+    margin = np.maximum(1 - y * (X @ w.astype(X.dtype, copy=False) + b), 0)
+    loss = (sample_weight * margin * margin).sum()
+    t_grad = -2 * sample_weight * margin * y
+    grad = np.empty_like(params)
+    grad[:-1] = X.T @ t_grad.astype(X.dtype, copy=False)
+    grad[-1] = t_grad.sum()
+    return loss, grad
+
+
+def _squared_hinge(params, X, y, sample_weight, C):
+    """L2-regularised squared hinge loss (as LinearSVC) and its gradient
+
+    The intercept is not regularised. The objective is divided by C so it
+    stays well scaled along the path.
+    """
+    w = params[:-1]
+    loss, grad = _squared_hinge_data(params, X, y, sample_weight)
+    grad[:-1] += w / C
+    return loss + 0.5 / C * (w @ w), grad
+
+
+class RegularizationPathClassifier(ClassifierMixin, BaseEstimator):
+    """Linear classifier fitted along a warm-started path of C values
+
+    The C values are fitted in increasing order, each one starting from
+    the coefficients of the previous one, so the whole path costs little
+    more than a single fit. The best C is chosen by inner cross-validation
+    (the path is fitted once per inner split) and the path is then fitted
+    on all the data.
+
+    Parameters
+    ----------
+    loss : str
+        'squared_hinge' (as LinearSVC, L2 penalty) or 'logistic'
+        (defaults to 'squared_hinge').
+    penalty : str
+        'l2' or 'l1' (logistic loss only). Defaults to 'l2'.
+    Cs : list(float)
+        The C values (defaults to 1e-4 to 1e6).
+    cv : int, cross-validation generator or iterable
+        The inner cross-validation (defaults to 5 stratified folds).
+    scoring : str or callable
+        The score to maximise (defaults to 'balanced_accuracy').
+    class_weight : dict or 'balanced' | None
+        The class weights (defaults to None).
+    max_iter : int
+        The maximum number of iterations of each fit (defaults to 1000).
+    tol : float
+        The tolerance of each fit (defaults to 1e-4).
+    row_groups : pandas.Series | None
+        The groups of all the rows, looked up by the index of ``X`` when
+        ``fit`` is called without ``groups`` (e.g. inside julearn, which
+        does not pass the groups to the estimator). Defaults to None.
+
+    Attributes
+    ----------
+    Cs_ : numpy.ndarray
+        The C values, in increasing order.
+    cv_scores_ : numpy.ndarray
+        The inner scores (n_Cs x n_splits).
+    C_ : float
+        The best C.
+    coefs_path_ : numpy.ndarray
+        The coefficients fitted on all the data for each C
+        (n_Cs x n_features).
+    intercepts_path_ : numpy.ndarray
+        The intercepts fitted on all the data for each C.
+    coef_, intercept_ : numpy.ndarray
+        The coefficients and intercept of the best C.
+    """
+
+    def __init__(self, loss="squared_hinge", penalty="l2",
+                 Cs=(1e-4, 1e-3, 1e-2, 1e-1, 1, 10, 100, 1e3, 1e4, 1e6),
+                 cv=5, scoring="balanced_accuracy", class_weight=None,
+                 max_iter=1000, tol=1e-4, row_groups=None):
+        self.loss = loss
+        self.penalty = penalty
+        self.Cs = Cs
+        self.cv = cv
+        self.scoring = scoring
+        self.class_weight = class_weight
+        self.max_iter = max_iter
+        self.tol = tol
+        self.row_groups = row_groups
+
+    def _fit_path(self, X, y, Cs):
+        """Fit the path of C values, y in {-1, 1}"""
+        from sklearn.utils.class_weight import compute_sample_weight
+        coefs = np.zeros((len(Cs), X.shape[1]))
+        intercepts = np.zeros(len(Cs))
+        sample_weight = compute_sample_weight(self.class_weight, y)
+        if self.loss == "logistic":
+            model = LogisticRegression(
+                l1_ratio=1. if self.penalty == "l1" else 0.,
+                solver="saga" if self.penalty == "l1" else "lbfgs",
+                warm_start=True, max_iter=self.max_iter, tol=self.tol)
+            for i, C in enumerate(Cs):
+                model.set_params(C=C).fit(X, y, sample_weight=sample_weight)
+                coefs[i] = model.coef_[0]
+                intercepts[i] = model.intercept_[0]
+        else:
+            from scipy.optimize import minimize
+            params = np.zeros(X.shape[1] + 1)
+            for i, C in enumerate(Cs):
+                res = minimize(
+                    _squared_hinge, params, args=(X, y, sample_weight, C),
+                    jac=True, method="L-BFGS-B",
+                    options={"maxiter": self.max_iter, "gtol": self.tol})
+                params = res.x
+                coefs[i], intercepts[i] = params[:-1], params[-1]
+        return coefs, intercepts
+
+    def _at(self, coef, intercept):
+        """Copy of the classifier with the given coefficients"""
+        model = type(self)(**self.get_params(deep=False))
+        model.classes_ = self.classes_
+        model.n_features_in_ = self.n_features_in_
+        model.coef_ = coef[None, :]
+        model.intercept_ = np.array([intercept])
+        return model
+
+    def fit(self, X, y, groups=None):
+        from sklearn.utils import check_X_y
+        if self.loss not in ["squared_hinge", "logistic"]:
+            raise_error(f"Unknown loss {self.loss}")
+        if self.penalty not in ["l1", "l2"] or (
+                self.penalty == "l1" and self.loss != "logistic"):
+            raise_error(
+                f"Penalty {self.penalty} is not available for {self.loss}")
+        if groups is None and self.row_groups is not None:
+            if not hasattr(X, "index"):
+                raise_error("row_groups requires X with an index")
+            groups = self.row_groups.loc[X.index].to_numpy()
+        X, y = check_X_y(X, y, dtype=[np.float64, np.float32])
+        self.n_features_in_ = X.shape[1]
+        self.classes_, y_enc = np.unique(y, return_inverse=True)
+        if len(self.classes_) != 2:
+            raise_error("Only binary classification is supported")
+        y_enc = 2. * y_enc - 1
+        self.Cs_ = np.sort(np.asarray(self.Cs, dtype=float))
+
+        # The inner splits keep the rows of a group (e.g. the TRs of a
+        # trial or subject) on the same side
+        cv = check_cv(self.cv, y, classifier=True)
+        scorer = check_scoring(self, scoring=self.scoring)
+        splits = list(cv.split(X, y, groups))
+        self.cv_scores_ = np.empty((len(self.Cs_), len(splits)))
+        for i_split, (train, test) in enumerate(splits):
+            coefs, intercepts = self._fit_path(
+                X[train], y_enc[train], self.Cs_)
+            for i_C in range(len(self.Cs_)):
+                self.cv_scores_[i_C, i_split] = scorer(
+                    self._at(coefs[i_C], intercepts[i_C]), X[test], y[test])
+
+        i_best = int(np.argmax(self.cv_scores_.mean(axis=1)))
+        self.C_ = float(self.Cs_[i_best])
+        self.coefs_path_, self.intercepts_path_ = self._fit_path(
+            X, y_enc, self.Cs_)
+        self.coef_ = self.coefs_path_[i_best][None, :]
+        self.intercept_ = self.intercepts_path_[i_best:i_best + 1]
+        logger.debug(f"Best C = {self.C_} for {self.loss} path")
+        return self
+
+    def decision_function(self, X):
+        from sklearn.utils.validation import check_array, check_is_fitted
+        check_is_fitted(self, ["coef_", "intercept_"])
+        X = check_array(X, dtype=[np.float64, np.float32])
+        if X.shape[1] != self.n_features_in_:
+            raise_error(
+                f"X has {X.shape[1]} features, but the classifier was "
+                f"fitted with {self.n_features_in_}")
+        return X @ self.coef_[0] + self.intercept_[0]
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+    def predict_proba(self, X):
+        if self.loss != "logistic":
+            raise_error("predict_proba is only available for logistic loss")
+        proba = 1 / (1 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1 - proba, proba])
+
+
+def _to_float32(X):
+    """Cast to float32, without a copy if the data already are"""
+    if hasattr(X, "columns"):
+        same = all(x == np.float32 for x in X.dtypes)
+    else:
+        if not hasattr(X, "dtype"):
+            X = np.asarray(X)
+        same = X.dtype == np.float32
+    return X if same else X.astype(np.float32)
+
+
+def _as_float(X):
+    """Get X as an array, keeping float32 and converting others to float64"""
+    X = np.asarray(X)
+    if X.dtype not in [np.float32, np.float64]:
+        X = X.astype(np.float64)
+    return X
+
+
+def _squared_spectral_norm(X, n_iter=30):
+    """Largest eigenvalue of [X, 1]' [X, 1], by power iteration"""
+    rng = np.random.default_rng(0)
+    v = rng.standard_normal(X.shape[1] + 1)
+    norm = 0.
+    for _ in range(n_iter):
+        v /= np.linalg.norm(v)
+        u = X @ v[:-1].astype(X.dtype) + v[-1]
+        v = np.append(X.T @ u.astype(X.dtype), u.sum())
+        norm = np.linalg.norm(v)
+    return norm
+
+
+class Float32StandardScaler(StandardScaler):
+    """StandardScaler that always outputs float32
+
+    StandardScaler keeps float32 data as float32, but float64 data stay
+    float64. This z-scorer is the conversion point of a float32 pipeline:
+    the data are cast once (if needed) and scaled in place, so the output
+    is the only copy. The mean and variance are accumulated in float64 by
+    chunks of rows, so only a chunk is upcast at a time.
+
+    Parameters
+    ----------
+    copy, with_mean, with_std : bool
+        As in StandardScaler (default to True).
+    chunksize : int
+        The number of rows processed at a time in `fit` (defaults to
+        4096).
+    """
+
+    def __init__(self, *, copy=True, with_mean=True, with_std=True,
+                 chunksize=4096):
+        super().__init__(copy=copy, with_mean=with_mean, with_std=with_std)
+        self.chunksize = chunksize
+
+    def fit(self, X, y=None, sample_weight=None):
+        if not hasattr(X, "shape"):
+            X = np.asarray(X)
+        self._reset()
+        for start in range(0, X.shape[0], self.chunksize):
+            t_rows = slice(start, start + self.chunksize)
+            self.partial_fit(
+                _safe_indexing(X, t_rows), y,
+                sample_weight=None if sample_weight is None
+                else np.asarray(sample_weight)[t_rows])
+        return self
+
+    def partial_fit(self, X, y=None, sample_weight=None):
+        return super().partial_fit(
+            _to_float32(X), y, sample_weight=sample_weight)
+
+    def transform(self, X, copy=None):
+        X_32 = _to_float32(X)
+        if X_32 is not X:
+            # Already a copy
+            copy = False
+        return super().transform(X_32, copy=copy)
+
+
+class Float32LinearSVC(ClassifierMixin, BaseEstimator):
+    """Linear SVM (squared hinge loss) that does not upcast float32 data
+
+    LinearSVC (liblinear) copies the data to float64 in every fit. This
+    variant minimises the same objective on the data as float32 (cast
+    without a copy if they already are): L-BFGS for the L2 penalty and
+    FISTA (accelerated proximal gradient) for the L1 penalty. Only the
+    coefficients and the optimiser state, of size n_features, are float64.
+    Unlike liblinear, the intercept is not regularised. Only binary
+    classification is supported.
+
+    Parameters
+    ----------
+    penalty : str
+        'l2' or 'l1' (defaults to 'l2').
+    C : float
+        The inverse of the regularisation strength (defaults to 1).
+    class_weight : dict or 'balanced' | None
+        The class weights (defaults to None).
+    max_iter : int
+        The maximum number of iterations (defaults to 1000).
+    tol : float
+        The tolerance (defaults to 1e-4).
+
+    Attributes
+    ----------
+    coef_, intercept_ : numpy.ndarray
+        The coefficients and intercept.
+    n_iter_ : int
+        The number of iterations run.
+    """
+
+    def __init__(self, penalty="l2", C=1., class_weight=None, max_iter=1000,
+                 tol=1e-4):
+        self.penalty = penalty
+        self.C = C
+        self.class_weight = class_weight
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def _fit_l2(self, X, y, sample_weight):
+        from scipy.optimize import minimize
+        res = minimize(
+            _squared_hinge, np.zeros(X.shape[1] + 1),
+            args=(X, y, sample_weight, self.C), jac=True,
+            method="L-BFGS-B",
+            options={"maxiter": self.max_iter, "gtol": self.tol})
+        return res.x, res.nit
+
+    def _fit_l1(self, X, y, sample_weight):
+        # Step of 1 / Lipschitz constant of the squared hinge gradient
+        step = 1 / (2.2 * sample_weight.max() * _squared_spectral_norm(X))
+        params = np.zeros(X.shape[1] + 1)
+        z = params.copy()
+        t = 1.
+        for n_iter in range(1, self.max_iter + 1):
+            _, grad = _squared_hinge_data(z, X, y, sample_weight)
+            new = z - step * grad
+            new[:-1] = np.sign(new[:-1]) * np.maximum(
+                np.abs(new[:-1]) - step / self.C, 0)
+            t_new = (1 + np.sqrt(1 + 4 * t * t)) / 2
+            z = new + (t - 1) / t_new * (new - params)
+            delta = np.abs(new - params).max()
+            params, t = new, t_new
+            if delta <= self.tol * max(1., np.abs(params).max()):
+                break
+        else:
+            logger.warning(
+                f"Float32LinearSVC did not converge in {self.max_iter} "
+                "iterations")
+        return params, n_iter
+
+    def fit(self, X, y, sample_weight=None):
+        from sklearn.utils import check_X_y
+        from sklearn.utils.class_weight import compute_sample_weight
+        if self.penalty not in ["l1", "l2"]:
+            raise_error(f"Unknown penalty {self.penalty}")
+        X, y = check_X_y(_to_float32(X), y, dtype=np.float32)
+        self.classes_, y_enc = np.unique(y, return_inverse=True)
+        if len(self.classes_) != 2:
+            raise_error("Only binary classification is supported")
+        y_enc = 2. * y_enc - 1
+        weights = compute_sample_weight(self.class_weight, y)
+        if sample_weight is not None:
+            weights = weights * np.asarray(sample_weight, dtype=float)
+        if self.penalty == "l2":
+            params, self.n_iter_ = self._fit_l2(X, y_enc, weights)
+        else:
+            params, self.n_iter_ = self._fit_l1(X, y_enc, weights)
+        self.coef_ = params[None, :-1]
+        self.intercept_ = params[-1:]
+        return self
+
+    def decision_function(self, X):
+        X = _as_float(X)
+        return X @ self.coef_[0].astype(X.dtype) + self.intercept_[0]
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+
+class Float32LinearSVCHeuristicC(Float32LinearSVC):
+    """Float32LinearSVC with the heuristic C, calculated in fit (see
+    LinearSVCHeuristicC).
+    """
+
+    def fit(self, X, y, sample_weight=None):
+        # calculate heuristic C
+        C = heuristic_C(X)
+        logger.debug(f"Using heuristic C = {C} for Float32LinearSVC")
+
+        # set C value
+        self.C = C
+
+        # call super fit method
+        super().fit(X, y, sample_weight=sample_weight)
+        return self
+
+
+class Float32LogisticRegressionHeuristicC(LogisticRegressionHeuristicC):
+    """LogisticRegressionHeuristicC that does not upcast float32 data
+
+    The data are cast to float32 (without a copy if they already are),
+    which the lbfgs, newton-cg, sag and saga solvers keep. liblinear
+    always copies the data to float64 and is not allowed: use saga for the
+    L1 penalty.
+    """
+
+    def fit(self, X, y, sample_weight=None):
+        if self.solver == "liblinear":
+            raise_error(
+                "liblinear copies the data to float64, use the saga solver")
+        return super().fit(_to_float32(X), y, sample_weight=sample_weight)
+
+
+class _LinearFoldModel(ClassifierMixin, BaseEstimator):
+    """Fitted binary linear classifier of one fold of `BatchedLOSO`"""
+
+    def __init__(self, coef, intercept, classes):
+        self.coef = coef
+        self.intercept = intercept
+        self.classes = classes
+        self.coef_ = coef[None, :]
+        self.intercept_ = np.array([intercept])
+        self.classes_ = classes
+
+    def decision_function(self, X):
+        return np.asarray(X) @ self.coef + self.intercept
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+
+class BatchedLOSO:
+    """Leave-one-group-out linear classifiers from sufficient statistics
+
+    Computes the count, sum and cross-product (X^T X) of each class once,
+    and the ones of each group once. The z-score scaler and the linear
+    model of each fold are then derived from the totals minus the held-out
+    group, without refitting on the training rows. The models are the
+    same as ``make_pipeline(StandardScaler(), model)`` fitted on each
+    fold, with model:
+
+    * 'ridge': ``RidgeClassifier(alpha=alpha)``.
+    * 'lda': ``LinearDiscriminantAnalysis(solver='lsqr',
+      shrinkage=shrinkage)``.
+
+    The memory and the cost of each fold grow with the square and the cube
+    of the number of features.
+
+    Parameters
+    ----------
+    model : str
+        'ridge' or 'lda' (defaults to 'ridge').
+    alpha : float
+        The ridge regularisation (defaults to 1).
+    shrinkage : float | None
+        The LDA covariance shrinkage, between 0 and 1 (defaults to None).
+    scale : bool
+        Whether to z-score the features in each fold (defaults to True).
+
+    Attributes
+    ----------
+    groups_ : numpy.ndarray
+        The held-out group of each fold.
+    classes_ : numpy.ndarray
+        The two classes.
+    coefs_ : numpy.ndarray
+        The coefficients of each fold in the original feature space, with
+        the scaler folded in (n_groups x n_features).
+    intercepts_ : numpy.ndarray
+        The intercepts of each fold.
+    """
+
+    def __init__(self, model="ridge", alpha=1., shrinkage=None, scale=True):
+        self.model = model
+        self.alpha = alpha
+        self.shrinkage = shrinkage
+        self.scale = scale
+
+    def fit(self, X, y, groups):
+        from scipy import linalg
+        from sklearn.utils import check_array
+        if self.model not in ["ridge", "lda"]:
+            raise_error(f"Unknown model {self.model}")
+        X = check_array(X, dtype=np.float64)
+        self.classes_, y_enc = np.unique(np.asarray(y), return_inverse=True)
+        if len(self.classes_) != 2:
+            raise_error("Only binary classification is supported")
+        self.groups_, g_inv = np.unique(
+            np.asarray(groups), return_inverse=True)
+        n_groups, n_features = len(self.groups_), X.shape[1]
+
+        # Shift by the global mean to avoid cancellation in the moments
+        shift = X.mean(axis=0)
+        X = X - shift
+        n_gc = np.zeros((n_groups, 2))
+        s_gc = np.zeros((n_groups, 2, n_features))
+        q_c = np.zeros((2, n_features, n_features))
+        for c in range(2):
+            mask = y_enc == c
+            n_gc[:, c] = np.bincount(g_inv[mask], minlength=n_groups)
+            np.add.at(s_gc[:, c], g_inv[mask], X[mask])
+            q_c[c] = X[mask].T @ X[mask]
+
+        self.coefs_ = np.zeros((n_groups, n_features))
+        self.intercepts_ = np.zeros(n_groups)
+        for i_group in range(n_groups):
+            N_c = n_gc.sum(axis=0) - n_gc[i_group]
+            if (N_c == 0).any():
+                raise_error(
+                    f"Only one class left without group "
+                    f"{self.groups_[i_group]}")
+            S_c = s_gc.sum(axis=0) - s_gc[i_group]
+            Q_c = q_c.copy()
+            for c in range(2):
+                t_X = X[(g_inv == i_group) & (y_enc == c)]
+                Q_c[c] -= t_X.T @ t_X
+
+            # Scaler of the fold, then the z-scored statistics
+            N = N_c.sum()
+            mean = S_c.sum(axis=0) / N
+            std = np.ones(n_features)
+            if self.scale:
+                var = np.diagonal(Q_c.sum(axis=0)) / N - mean ** 2
+                std = np.sqrt(np.maximum(var, 0))
+                std[std < 10 * np.finfo(np.float64).eps] = 1.
+            Sz_c = (S_c - N_c[:, None] * mean) / std
+            Qz_c = np.stack([
+                Q_c[c] - np.outer(S_c[c], mean) - np.outer(mean, S_c[c])
+                + N_c[c] * np.outer(mean, mean) for c in range(2)])
+            Qz_c /= np.outer(std, std)
+
+            if self.model == "ridge":
+                # y in {-1, 1}, Z is centered so Z^T (y - mean(y)) = Z^T y
+                y_sum = Sz_c[1] - Sz_c[0]
+                w = linalg.solve(
+                    Qz_c.sum(axis=0) + self.alpha * np.eye(n_features),
+                    y_sum, assume_a="pos")
+                b = (N_c[1] - N_c[0]) / N
+            else:
+                priors = N_c / N
+                means = Sz_c / N_c[:, None]
+                cov = np.zeros((n_features, n_features))
+                for c in range(2):
+                    t_cov = Qz_c[c] / N_c[c] - np.outer(means[c], means[c])
+                    if self.shrinkage is not None:
+                        t_mu = np.trace(t_cov) / n_features
+                        t_cov = (1 - self.shrinkage) * t_cov
+                        t_cov.flat[::n_features + 1] += self.shrinkage * t_mu
+                    cov += priors[c] * t_cov
+                coef = linalg.lstsq(cov, means.T)[0].T
+                intercept = -0.5 * np.einsum(
+                    "ij,ij->i", means, coef) + np.log(priors)
+                w, b = coef[1] - coef[0], intercept[1] - intercept[0]
+
+            # Back to the original (unshifted, unscaled) features
+            self.coefs_[i_group] = w / std
+            self.intercepts_[i_group] = b - self.coefs_[i_group] @ (
+                mean + shift)
+        return self
+
+    def fold_estimator(self, i_fold):
+        """Get the fitted classifier of a fold
+
+        Parameters
+        ----------
+        i_fold : int
+            The fold (position of its held-out group in ``groups_``).
+
+        Returns
+        -------
+        estimator : classifier
+            The classifier, with ``decision_function`` and ``predict``.
+        """
+        return _LinearFoldModel(
+            self.coefs_[i_fold], self.intercepts_[i_fold], self.classes_)
+
+    def decision_function(self, X, groups):
+        """Out-of-fold decision function
+
+        Each sample is scored by the model of the fold in which its group
+        was held out.
+
+        Parameters
+        ----------
+        X : array-like
+            The data.
+        groups : array-like
+            The group of each sample.
+
+        Returns
+        -------
+        decision : numpy.ndarray
+            The decision function (positive for ``classes_[1]``).
+        """
+        i_fold = np.searchsorted(self.groups_, np.asarray(groups))
+        X = np.asarray(X, dtype=np.float64)
+        return np.einsum(
+            "ij,ij->i", X, self.coefs_[i_fold]) + self.intercepts_[i_fold]
+
+
+class IncrementalDecoder(ClassifierMixin, BaseEstimator):
+    """Linear classifier trained incrementally, with an online z-scorer
+
+    Each call to `partial_fit` updates the running mean and variance of the
+    features, z-scores the new samples with them and does one SGD pass
+    over them. Classes are reweighted by their running counts (as
+    ``class_weight='balanced'`` on all the samples seen so far). Data can
+    therefore be streamed by subject or by chunks of TRs (e.g. from
+    `nimrls.io.iter_features`) without keeping it in memory::
+
+        model = IncrementalDecoder()
+        for t_df in iter_features(path, by='subject'):
+            model.partial_fit(t_df[features], t_df['target'], classes=[0, 1])
+
+    Parameters
+    ----------
+    loss : str
+        'log_loss' (logistic regression) or 'hinge' (linear SVM). Defaults
+        to 'log_loss'.
+    alpha : float
+        The L2 regularisation of the SGD (defaults to 1e-4).
+    class_weight : 'balanced' | None
+        Whether to reweight the classes by their running counts (defaults
+        to 'balanced').
+    n_epochs : int
+        The number of passes over the data in `fit` (defaults to 5).
+    chunksize : int
+        The number of samples per `partial_fit` call in `fit` (defaults to
+        1000).
+    random_state : int | None
+        The seed of the SGD and of the sample order in `fit` (defaults to
+        None).
+
+    Attributes
+    ----------
+    scaler_ : sklearn.preprocessing.StandardScaler
+        The online z-scorer.
+    sgd_ : sklearn.linear_model.SGDClassifier
+        The classifier, on z-scored features.
+    class_counts_ : numpy.ndarray
+        The number of samples seen of each class.
+    """
+
+    def __init__(self, loss="log_loss", alpha=1e-4, class_weight="balanced",
+                 n_epochs=5, chunksize=1000, random_state=None):
+        self.loss = loss
+        self.alpha = alpha
+        self.class_weight = class_weight
+        self.n_epochs = n_epochs
+        self.chunksize = chunksize
+        self.random_state = random_state
+
+    def _reset(self):
+        from sklearn.linear_model import SGDClassifier
+        for x in ["scaler_", "sgd_", "classes_", "class_counts_"]:
+            if hasattr(self, x):
+                delattr(self, x)
+        self.scaler_ = StandardScaler()
+        self.sgd_ = SGDClassifier(
+            loss=self.loss, alpha=self.alpha,
+            random_state=self.random_state)
+
+    def partial_fit(self, X, y, classes=None, update_scaler=True):
+        """Update the model with a chunk of samples
+
+        Parameters
+        ----------
+        X : array-like
+            The samples.
+        y : array-like
+            The target.
+        classes : array-like | None
+            All the classes. Required in the first call.
+        update_scaler : bool
+            Whether to update the z-scorer with the chunk (defaults to
+            True). Must be True until the z-scorer has seen some data.
+
+        Returns
+        -------
+        self : IncrementalDecoder
+            The updated model.
+        """
+        if not update_scaler and not hasattr(
+                getattr(self, "scaler_", None), "n_samples_seen_"):
+            raise_error(
+                "The z-scorer is not fitted, the first partial_fit needs "
+                "update_scaler=True")
+        if not hasattr(self, "classes_"):
+            if classes is None:
+                raise_error("classes must be passed to the first partial_fit")
+            if not hasattr(self, "sgd_"):
+                self._reset()
+            self.classes_ = np.unique(classes)
+            self.class_counts_ = np.zeros(len(self.classes_))
+        X = _as_float(X)
+        y = np.asarray(y)
+        if not np.isin(y, self.classes_).all():
+            raise_error("y has classes not in classes")
+        y_idx = np.searchsorted(self.classes_, y)
+
+        if update_scaler:
+            self.scaler_.partial_fit(X)
+            self.class_counts_ += np.bincount(
+                y_idx, minlength=len(self.classes_))
+        sample_weight = None
+        if self.class_weight == "balanced":
+            counts = np.maximum(self.class_counts_, 1)
+            weights = counts.sum() / (len(counts) * counts)
+            sample_weight = weights[y_idx]
+        self.sgd_.partial_fit(
+            self.scaler_.transform(X), y, classes=self.classes_,
+            sample_weight=sample_weight)
+        return self
+
+    def fit(self, X, y):
+        self._reset()
+        X = _as_float(X)
+        y = np.asarray(y)
+        rng = np.random.default_rng(self.random_state)
+        classes = np.unique(y)
+        # Final scaler and class counts from the start, then SGD passes
+        self.scaler_.fit(X)
+        self.classes_ = classes
+        self.class_counts_ = np.array(
+            [(y == x).sum() for x in classes], dtype=float)
+        for _ in range(self.n_epochs):
+            order = rng.permutation(len(y))
+            for start in range(0, len(y), self.chunksize):
+                t_idx = order[start:start + self.chunksize]
+                self.partial_fit(X[t_idx], y[t_idx], update_scaler=False)
+        return self
+
+    def decision_function(self, X):
+        X = _as_float(X)
+        return self.sgd_.decision_function(self.scaler_.transform(X))
+
+    def predict(self, X):
+        X = _as_float(X)
+        return self.sgd_.predict(self.scaler_.transform(X))
+
+    def predict_proba(self, X):
+        if self.loss != "log_loss":
+            raise_error("predict_proba is only available for log_loss")
+        X = _as_float(X)
+        return self.sgd_.predict_proba(self.scaler_.transform(X))
+
+
+def _fitted_steps(estimator):
+    """The fitted steps of a pipeline, without searches and wrappers"""
+    for attr in ["best_estimator_", "model_", "column_transformer_"]:
+        if hasattr(estimator, attr):
+            return _fitted_steps(getattr(estimator, attr))
+    if isinstance(estimator, Pipeline):
+        return [
+            x for _, t_step in estimator.steps
+            if t_step is not None and t_step != "passthrough"
+            for x in _fitted_steps(t_step)]
+    if hasattr(estimator, "transformers_"):
+        # ColumnTransformer with a single transformer
+        fitted = [x[1] for x in estimator.transformers_
+                  if not isinstance(x[1], str)]
+        if len(fitted) == 1:
+            return _fitted_steps(fitted[0])
+    return [estimator]
+
+
+class CompactLinearDecoder:
+    """Binary linear decoder restricted to its non-zero coefficients
+
+    L1-penalised decoders (e.g. LinearSVC or LogisticRegression with
+    ``penalty='l1'``) only use a few of the features. This keeps those
+    features with their z-score parameters, so new data can be decoded
+    reading only their columns::
+
+        decoder = CompactLinearDecoder.from_estimator(model)
+        df = read_features_parquet(path, columns=decoder.columns)
+        decision = decoder.decision_function(df)
+
+    Parameters
+    ----------
+    features : list(str)
+        The names of the features kept.
+    mean, scale : numpy.ndarray
+        The z-score parameters of the features.
+    coef : numpy.ndarray
+        The coefficients of the features (on z-scored data).
+    intercept : float
+        The intercept.
+    classes : numpy.ndarray
+        The classes (the decision is positive for ``classes[1]``).
+    """
+
+    def __init__(self, features, mean, scale, coef, intercept, classes):
+        self.features = [str(x) for x in features]
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.classes_ = np.asarray(classes)
+        if not (len(self.features) == len(self.mean) == len(self.scale)
+                == len(self.coef)):
+            raise_error("features, mean, scale and coef differ in length")
+        # z-score folded into the coefficients
+        self.weights_ = self.coef / self.scale
+        self.offset_ = self.intercept - self.mean @ self.weights_
+
+    @classmethod
+    def from_estimator(cls, estimator, feature_names=None, tol=0.):
+        """Compact a fitted linear model or pipeline
+
+        The pipeline can have z-score steps (StandardScaler or its
+        subclasses) followed by a binary linear model. Grid searches and
+        julearn wrappers are unwrapped.
+
+        Parameters
+        ----------
+        estimator : object
+            The fitted model or pipeline.
+        feature_names : list(str) | None
+            The names of the input features. If None (default), taken from
+            ``feature_names_in_`` (without the julearn column types).
+        tol : float
+            The features with absolute coefficients not above tol are
+            dropped (defaults to 0).
+
+        Returns
+        -------
+        decoder : CompactLinearDecoder
+            The compact decoder.
+        """
+        steps = _fitted_steps(estimator)
+        final = steps[-1]
+        coef = np.atleast_2d(getattr(final, "coef_", np.empty((0, 0))))
+        if coef.shape[0] != 1 or not hasattr(final, "intercept_"):
+            raise_error(
+                f"{type(final).__name__} is not a binary linear model")
+        coef = coef[0]
+        mean, scale = np.zeros(len(coef)), np.ones(len(coef))
+        for t_step in steps[:-1]:
+            if type(t_step).__name__ == "SetColumnTypes":
+                # julearn, only renames the columns
+                continue
+            if not isinstance(t_step, StandardScaler):
+                # Other scalers (e.g. RobustScaler) center differently
+                raise_error(
+                    f"Can not compact a pipeline with a "
+                    f"{type(t_step).__name__} step")
+            if t_step.with_mean:
+                mean = mean + t_step.mean_ * scale
+            if t_step.scale_ is not None:
+                scale = scale * t_step.scale_
+
+        if feature_names is None:
+            for t_step in [estimator] + steps:
+                feature_names = getattr(t_step, "feature_names_in_", None)
+                if feature_names is not None:
+                    break
+            else:
+                raise_error("No feature names, pass feature_names")
+            feature_names = [
+                re.sub(r"__:type:__.*$", "", x) for x in feature_names]
+        if len(feature_names) != len(coef):
+            raise_error(
+                f"{len(feature_names)} feature names for {len(coef)} "
+                "coefficients")
+
+        keep = np.flatnonzero(np.abs(coef) > tol)
+        logger.info(f"Compact decoder: {len(keep)} of {len(coef)} features")
+        return cls(
+            np.asarray(feature_names)[keep], mean[keep], scale[keep],
+            coef[keep], np.ravel(final.intercept_)[0], final.classes_)
+
+    @property
+    def columns(self):
+        """The regular expressions reading only the features (see
+        `nimrls.io.read_features_parquet`)
+        """
+        return [re.escape(x) for x in self.features]
+
+    def decision_function(self, X):
+        """Get the decision function
+
+        Parameters
+        ----------
+        X : pandas.DataFrame or array-like
+            The data. DataFrames can have other columns, arrays must only
+            have the features kept, in order.
+
+        Returns
+        -------
+        decision : numpy.ndarray
+            The decision function (positive for ``classes_[1]``).
+        """
+        if hasattr(X, "columns"):
+            X = X[self.features]
+        X = _as_float(X)
+        if X.ndim != 2 or X.shape[1] != len(self.features):
+            raise_error(
+                f"Expected {len(self.features)} features, got shape "
+                f"{X.shape}")
+        return X @ self.weights_.astype(X.dtype) + self.offset_
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+    def save(self, fname):
+        """Save to a .npz file
+
+        Parameters
+        ----------
+        fname : str or pathlib.Path
+            The file name.
+        """
+        classes = self.classes_
+        if classes.dtype == object:
+            classes = classes.astype(str)
+        np.savez(
+            fname, features=np.asarray(self.features, dtype=str),
+            mean=self.mean, scale=self.scale, coef=self.coef,
+            intercept=self.intercept, classes=classes)
+
+    @classmethod
+    def load(cls, fname):
+        """Load from a .npz file written by `save`
+
+        Parameters
+        ----------
+        fname : str or pathlib.Path
+            The file name.
+
+        Returns
+        -------
+        decoder : CompactLinearDecoder
+            The compact decoder.
+        """
+        with np.load(fname) as npz:
+            return cls(
+                npz["features"], npz["mean"], npz["scale"], npz["coef"],
+                npz["intercept"], npz["classes"])
@@ -0,0 +1,79 @@
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from nimrls.connectivity import Connectivity, parse_roi
+
+
+rois = ['LH_Vis_1', 'LH_Default_PFC_1', 'RH_Default_Par_1', 'HIP-rh']
+columns = [f'{a}~{b}' for a in rois for b in rois]
+matrix = np.array([
+    [1., .1, .2, .3],
+    [.1, 1., .4, .5],
+    [.2, .4, 1., .6],
+    [.3, .5, .6, 1.],
+])
+df_full = pd.DataFrame(
+    np.vstack([matrix.ravel(), 2 * matrix.ravel()]),
+    columns=columns,
+    index=pd.MultiIndex.from_tuples(
+        [('sub-01', 0), ('sub-01', 1)], names=['subject', 'timepoint']))
+
+
+def test_parse_roi():
+    assert parse_roi('LH_Default_PFC_1') == ('LH', 'Default')
+    assert parse_roi('RH_DorsAttn_Post_2') == ('RH', 'DorsAttn')
+    assert parse_roi('pTHA-lh') == ('LH', 'Subcortex')
+
+
+def test_from_frame():
+    conn = Connectivity.from_frame(df_full)
+    assert conn.n_rois == 4
+    # The source dtype is kept, unless another one is requested
+    assert conn.data.dtype == np.float64
+    assert Connectivity.from_frame(df_full.astype(np.float32)).data.dtype == (
+        np.float32)
+    assert Connectivity.from_frame(df_full, dtype='float32').data.dtype == (
+        np.float32)
+    np.testing.assert_array_equal(conn.data[0], [.1, .2, .3, .4, .5, .6])
+    np.testing.assert_allclose(conn.data[1], [.2, .4, .6, .8, 1., 1.2])
+    assert list(conn.rois['network']) == [
+        'Vis', 'Default', 'Default', 'Subcortex']
+
+    unpacked = conn.to_matrix(0)
+    np.testing.assert_allclose(
+        unpacked[~np.eye(4, dtype=bool)], matrix[~np.eye(4, dtype=bool)])
+
+
+def test_select_and_to_frame():
+    conn = Connectivity.from_frame(df_full)
+    mask = conn.select(within='Default')
+    assert mask.tolist() == [False, False, False, True, False, False]
+    mask = conn.select(between=('Subcortex', 'Default'))
+    assert mask.tolist() == [False, False, False, False, True, True]
+
+    c_df = conn.to_frame(mask=conn.select(within=['Default', 'Vis']))
+    assert list(c_df.columns) == ['DEFAULT_LH_Default_PFC_1~RH_Default_Par_1']
+    assert c_df.index.equals(df_full.index)
+
+    c_df = conn.to_frame()
+    assert c_df.columns[0] == (
+        'INTERNETWORK_Vis_Default_LH_Vis_1~LH_Default_PFC_1')
+    # No precision lost in the round trip
+    assert c_df.dtypes.eq(np.float64).all()
+    np.testing.assert_array_equal(
+        c_df['DEFAULT_LH_Default_PFC_1~RH_Default_Par_1'],
+        df_full['LH_Default_PFC_1~RH_Default_Par_1'])
+
+
+def test_save_load():
+    conn = Connectivity.from_frame(df_full)
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        fname = f'{_tmpdir}/conn.npz'
+        conn.save(fname)
+        c_conn = Connectivity.load(fname)
+    np.testing.assert_array_equal(conn.data, c_conn.data)
+    assert_frame_equal(conn.rois, c_conn.rois)
+    assert conn.index.equals(c_conn.index)
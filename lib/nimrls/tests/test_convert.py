@@ -0,0 +1,64 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from nimrls.convert import hdf5_to_parquet, main
+from nimrls.io import read_features_parquet
+
+
+def _make_storage(uri):
+    storage_module = pytest.importorskip('junifer.storage')
+    storage = storage_module.HDF5FeatureStorage(uri, single_output=True)
+    for task in ['ES', 'rest']:
+        for i, subject in enumerate(['1001', '1002', '1003']):
+            element = {'subject': subject, 'task': task}
+            storage.store_metadata(
+                meta_md5='md5', element=element,
+                meta={'name': 'BOLD_fc', 'marker': {}, 'dependencies': []})
+            storage.store_timeseries(
+                meta_md5='md5', element=element,
+                data=np.arange(12.).reshape(4, 3) + i,
+                col_names=['a~b', 'a~c', 'b~c'])
+    return storage
+
+
+def test_hdf5_to_parquet():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'{_tmpdir}/test.hdf5'
+        storage = _make_storage(uri)
+        stored = storage.read_df('BOLD_fc')
+        expected = stored
+        index_col = list(expected.index.names)
+
+        path = Path(_tmpdir) / 'BOLD_fc.parquet'
+        assert hdf5_to_parquet(uri, 'BOLD_fc', path) == 24
+        assert (path / 'task=ES' / 'subject=1002').is_dir()
+
+        df = read_features_parquet(path, index_col=index_col)
+        assert (df.dtypes == stored.dtypes).all()
+        assert_frame_equal(
+            df.sort_index(), expected.sort_index(), check_index_type=False)
+
+        df = read_features_parquet(
+            path, tasks=['ES'], subjects=['1001', '1003'],
+            index_col=index_col)
+        t_expected = expected[
+            (expected.index.get_level_values('task') == 'ES')
+            & expected.index.get_level_values('subject').isin(
+                ['1001', '1003'])]
+        assert_frame_equal(
+            df.sort_index(), t_expected.sort_index(),
+            check_index_type=False)
+
+        # Command line, a single partition column and one column
+        path = Path(_tmpdir) / 'BOLD_fc_ab.parquet'
+        main([uri, 'BOLD_fc', str(path), '--partition', 'subject',
+              '--columns', 'a~b', '--dtype', 'float32'])
+        df = read_features_parquet(path, index_col=index_col)
+        assert list(df.columns) == ['a~b']
+        assert df['a~b'].dtype == np.float32
+        assert pd.Index(df.index.get_level_values('task')).nunique() == 2
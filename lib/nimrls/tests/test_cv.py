@@ -0,0 +1,211 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sklearn.model_selection import StratifiedGroupKFold
+
+from nimrls.cv import (
+    DownsampledRepeatedStratifiedKFold, RepeatedStratifiedGroupKFold,
+    DownsampledGroupCV, cached_split, split_key)
+
+
+def _data(n_neg=40, n_pos=10):
+    y = np.array([0] * n_neg + [1] * n_pos)
+    X = pd.DataFrame({'a': np.arange(len(y))})
+    return X, y
+
+
+def test_downsampled_repeated_stratified_kfold():
+    X, y = _data()
+    cv = DownsampledRepeatedStratifiedKFold(
+        n_splits=5, n_repeats=3, random_state=42)
+    assert cv.get_n_splits() == 15
+    folds = list(cv.split(X, y))
+    assert len(folds) == 15
+
+    for i_repeat in range(3):
+        t_folds = folds[i_repeat * 5:(i_repeat + 1) * 5]
+        tests = np.concatenate([test for _, test in t_folds])
+        # Each subsampled row is tested once, without replacement
+        assert len(np.unique(tests)) == len(tests) == 20
+        assert (y[tests] == 1).sum() == 10
+        for train, test in t_folds:
+            assert len(np.intersect1d(train, test)) == 0
+            assert (y[test] == 1).sum() == (y[test] == 0).sum() == 2
+            assert len(train) == 16
+
+    # Repeats draw different negatives
+    negs = [
+        np.sort(np.concatenate(
+            [folds[i * 5 + j][1] for j in range(5)]))[:10]
+        for i in range(3)]
+    assert not all(np.array_equal(negs[0], x) for x in negs[1:])
+
+    # Same seed, same folds
+    folds2 = list(cv.split(X, y))
+    for (tr1, te1), (tr2, te2) in zip(folds, folds2):
+        assert np.array_equal(tr1, tr2)
+        assert np.array_equal(te1, te2)
+
+
+def test_downsampled_repeated_stratified_kfold_params():
+    X, y = _data()
+    cv = DownsampledRepeatedStratifiedKFold(
+        n_splits=2, n_repeats=2, subsample_size=4,
+        random_state=np.random.default_rng(0), pos_labels=0)
+    folds = list(cv.split(X, y))
+    assert len(folds) == 4
+    for _, test in folds:
+        assert len(test) == 4
+
+    cv = DownsampledRepeatedStratifiedKFold(n_splits=20)
+    with pytest.raises(ValueError, match='Cannot split'):
+        next(cv.split(X, y))
+
+
+def test_repeated_stratified_group_kfold():
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(2, 6, 200)
+    groups = np.repeat([f'g{i}' for i in range(200)], sizes)
+    y = np.repeat(rng.random(200) < 0.2, sizes).astype(int)
+    X = np.zeros((len(y), 1))
+
+    cv = RepeatedStratifiedGroupKFold(
+        n_splits=5, n_repeats=3, random_state=42)
+    assert cv.get_n_splits() == 15
+    folds = list(cv.split(X, y, groups))
+    assert len(folds) == 15
+    for i_repeat in range(3):
+        t_folds = folds[i_repeat * 5:(i_repeat + 1) * 5]
+        tests = np.concatenate([test for _, test in t_folds])
+        assert np.array_equal(np.sort(tests), np.arange(len(y)))
+        for train, test in t_folds:
+            assert len(np.intersect1d(groups[train], groups[test])) == 0
+            assert abs(y[test].mean() - y.mean()) < 0.05
+
+    # Repeats differ, same seed gives the same folds
+    assert not np.array_equal(folds[0][1], folds[5][1])
+    folds2 = list(cv.split(X, y, groups))
+    for (_, te1), (_, te2) in zip(folds, folds2):
+        assert np.array_equal(te1, te2)
+
+    with pytest.raises(ValueError, match='groups are required'):
+        next(cv.split(X, y))
+
+
+def test_cached_split():
+    X = pd.DataFrame(
+        {'a': np.arange(40.)},
+        index=pd.Index([f's{i}' for i in range(40)], name='subject'))
+    y = np.array([0, 1] * 20)
+    groups = np.repeat(np.arange(10), 4)
+    cv = RepeatedStratifiedGroupKFold(
+        n_splits=5, n_repeats=2, random_state=1)
+    expected = list(cv.split(X, y, groups))
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        folds = cached_split(cv, X, y, groups, cache_dir=_tmpdir)
+        assert len(list(Path(_tmpdir).glob('split_*.npz'))) == 1
+        for (tr1, te1), (tr2, te2) in zip(folds, expected):
+            assert np.array_equal(tr1, tr2)
+            assert np.array_equal(te1, te2)
+
+        # Loaded from the cache, one fold at a time
+        cv.split = None
+        train, test = cached_split(cv, X, y, groups, _tmpdir, fold=7)
+        assert np.array_equal(test, expected[7][1])
+        assert len(cached_split(cv, X, y, groups, _tmpdir)) == 10
+        with pytest.raises(ValueError, match='out of range'):
+            cached_split(cv, X, y, groups, _tmpdir, fold=10)
+
+        # Another seed or data is another split
+        cv2 = RepeatedStratifiedGroupKFold(
+            n_splits=5, n_repeats=2, random_state=2)
+        assert split_key(cv2, X, y, groups) != split_key(cv, X, y, groups)
+        assert split_key(cv, X, y[::-1], groups) != split_key(
+            cv, X, y, groups)
+        cached_split(cv2, X, y, groups, cache_dir=_tmpdir, fold=0)
+        assert len(list(Path(_tmpdir).glob('split_*.npz'))) == 2
+
+    # Other features, or downsampling groups beyond the truncated repr
+    X2 = X.rename(columns={'a': 'b'})
+    assert split_key(cv, X2, y, groups) != split_key(cv, X, y, groups)
+    assert split_key(cv, X + 1, y, groups) != split_key(cv, X, y, groups)
+    assert split_key(cv, X.values, y, groups) != split_key(
+        cv, X.values + 1, y, groups)
+    trials = np.arange(2000)
+    other = trials.copy()
+    other[1000] = -1
+    ds1 = DownsampledGroupCV(cv, downsample_groups=trials, random_state=0)
+    ds2 = DownsampledGroupCV(cv, downsample_groups=other, random_state=0)
+    assert repr(ds1) == repr(ds2)
+    assert split_key(ds1, X, y, groups) != split_key(ds2, X, y, groups)
+
+    # Unseeded splitters are not cached
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        for t_cv in [
+                RepeatedStratifiedGroupKFold(n_splits=5, n_repeats=2),
+                DownsampledGroupCV(
+                    RepeatedStratifiedGroupKFold(n_splits=5, n_repeats=2),
+                    random_state=0)]:
+            assert len(cached_split(t_cv, X, y, groups, _tmpdir)) == 10
+        assert len(list(Path(_tmpdir).glob('split_*.npz'))) == 0
+        cached_split(StratifiedGroupKFold(), X, y, groups, _tmpdir)
+        assert len(list(Path(_tmpdir).glob('split_*.npz'))) == 0
+        cached_split(cv2, X, y, groups, _tmpdir)
+        assert len(list(Path(_tmpdir).glob('split_*.npz'))) == 1
+
+
+def test_downsampled_group_cv():
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(2, 6, 300)
+    groups = np.repeat(np.arange(300), sizes)
+    y = np.repeat(rng.random(300) < 0.2, sizes).astype(int)
+    # A few groups with both classes are never dropped
+    y[:2] = [0, 1]
+    X = np.zeros((len(y), 1))
+
+    inner = RepeatedStratifiedGroupKFold(
+        n_splits=5, n_repeats=2, random_state=0)
+    cv = DownsampledGroupCV(inner, random_state=0)
+    assert cv.get_n_splits() == 10
+    folds = list(cv.split(X, y, groups))
+    expected = list(inner.split(X, y, groups))
+    assert len(folds) == 10
+    for (train, test), (e_train, e_test) in zip(folds, expected):
+        assert np.array_equal(test, e_test)
+        assert np.isin(train, e_train).all()
+        # Whole groups are kept or dropped
+        kept = np.unique(groups[train])
+        assert np.isin(e_train, train)[np.isin(groups[e_train], kept)].all()
+        assert (y[train] == 1).sum() == (y[e_train] == 1).sum()
+        n_pos, n_neg = (y[train] == 1).sum(), (y[train] == 0).sum()
+        assert n_pos - 6 <= n_neg <= n_pos
+        assert len(np.intersect1d(groups[train], groups[test])) == 0
+        if 0 in groups[e_train]:
+            assert 0 in groups[train]
+
+    cv = DownsampledGroupCV(inner, ratio=2., random_state=0)
+    train, _ = next(cv.split(X, y, groups))
+    n_pos, n_neg = (y[train] == 1).sum(), (y[train] == 0).sum()
+    assert 2 * n_pos - 6 <= n_neg <= 2 * n_pos
+
+
+def test_downsampled_group_cv_subgroups():
+    # Split by subject, downsample by trial
+    subjects = np.repeat(np.arange(10), 30)
+    trials = np.repeat(np.arange(100), 3)
+    y = np.repeat(np.arange(100) % 4 == 0, 3).astype(int)
+    X = np.zeros((len(y), 1))
+    inner = StratifiedGroupKFold(n_splits=10)
+    cv = DownsampledGroupCV(inner, downsample_groups=trials, random_state=0)
+    for train, test in cv.split(X, y, subjects):
+        assert (y[train] == 0).sum() == (y[train] == 1).sum() > 0
+        assert len(np.intersect1d(subjects[train], subjects[test])) == 0
+        assert len(test) == 30
+
+    cv = DownsampledGroupCV(inner, downsample_groups=trials[:10])
+    with pytest.raises(ValueError, match='downsampling groups'):
+        next(cv.split(X, y, subjects))
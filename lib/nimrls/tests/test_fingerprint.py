@@ -0,0 +1,65 @@
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from nimrls.fingerprint import (
+    fingerprint, hash_file, is_up_to_date, manifest_fname, write_manifest)
+
+
+def test_hash_file():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        fname = Path(_tmpdir) / 'a.txt'
+        fname.write_bytes(b'x' * 1000)
+        assert hash_file(fname) == hash_file(fname, chunksize=7)
+        digest = hash_file(fname)[1]
+        fname.write_bytes(b'x' * 999 + b'y')
+        assert hash_file(fname)[1] != digest
+
+
+def test_fingerprint():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        path = Path(_tmpdir) / 'data.parquet'
+        (path / 'subject=1').mkdir(parents=True)
+        (path / 'subject=1' / 'part-0.parquet').write_bytes(b'abc')
+        (path / 'subject=2').mkdir()
+        (path / 'subject=2' / 'part-0.parquet').write_bytes(b'abcd')
+        fp = fingerprint(path)
+        assert list(fp) == [
+            'subject=1/part-0.parquet', 'subject=2/part-0.parquet']
+        assert fp['subject=2/part-0.parquet']['size'] == 4
+        assert 'mtime_ns' in fingerprint(path / 'subject=1', full=False)[
+            'part-0.parquet']
+        with pytest.raises(ValueError, match='does not exist'):
+            fingerprint(path / 'missing')
+
+
+def test_manifest():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        in1 = Path(_tmpdir) / 'events.csv'
+        in1.write_text('a,b\n1,2\n')
+        in2 = Path(_tmpdir) / 'IPC.hdf5'
+        in2.write_bytes(b'\x00' * 100)
+        output = Path(_tmpdir) / 'IPC.jay'
+        params = {'task': 'ES', 'columns': ('a', 'b')}
+
+        assert not is_up_to_date(output, [in1, in2], params)
+        output.write_bytes(b'out')
+        assert not is_up_to_date(output, [in1, in2], params)
+        fname = write_manifest(output, [in1, in2], params)
+        assert fname == manifest_fname(output)
+        assert fname.name == 'IPC.jay.manifest.json'
+        assert is_up_to_date(output, [in2, in1], params)
+        assert not is_up_to_date(output, [in1], params)
+        assert not is_up_to_date(output, [in1, in2], {'task': 'rest'})
+
+        # Touched but same content: up to date (full hash path)
+        stat = in1.stat()
+        os.utime(in1, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert is_up_to_date(output, [in1, in2], params)
+
+        # Same size, different content
+        in1.write_text('a,b\n3,4\n')
+        os.utime(in1, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+        assert not is_up_to_date(output, [in1, in2], params)
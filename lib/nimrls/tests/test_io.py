@@ -1,8 +1,18 @@
+import numpy as np
 import pandas as pd
+import pytest
 from pandas.testing import assert_frame_equal
 import tempfile
-from sqlalchemy import create_engine
-from nimrls.io import _save_upsert, save_features, read_features
+from pathlib import Path
+from sqlalchemy import create_engine, text
+from nimrls.io import _save_upsert, save_features, read_features_old
+from nimrls.io import _POOL, _junifer_table, _read_csv_cached
+from nimrls.io import read_features, read_apoe, read_snps
+from nimrls.io import read_pheno, read_prs
+from nimrls.io import read_features_parquet, save_features_parquet
+from nimrls.io import read_jay_files, read_catalog, iter_features
+from nimrls.io import get_engine, get_storage, dispose, list_features_old
+from nimrls.io import apply_dtype_policy, list_features, save_features_jay
 
 
 df1 = pd.DataFrame({
@@ -87,15 +97,400 @@ def test_io_features():
         uri = f'sqlite:///{_tmpdir}/test.db'
         save_features(df1, uri, 'vbm', 'schaefer_2010_100', 'mean')
 
-        c_df1 = read_features(uri, 'vbm', 'schaefer_2010_100',
-                              index_col=index_col,
-                              agg_function='mean')
+        c_df1 = read_features_old(uri, 'vbm', 'schaefer_2010_100',
+                                  index_col=index_col,
+                                  agg_function='mean')
 
         assert_frame_equal(df1, c_df1)
 
         save_features(df2, uri, 'vbm', 'schaefer_2010_100', 'mean')
 
-        c_dfupdate = read_features(
+        c_dfupdate = read_features_old(
             uri, 'vbm', 'schaefer_2010_100', index_col=index_col,
             agg_function='mean')
         assert_frame_equal(c_dfupdate, df_update)
+
+
+def test_engine_pool():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        engine = get_engine(uri)
+        assert get_engine(uri) is engine
+        save_features(df1, uri, 'vbm', 'atlas', 'mean')
+        save_features(df1, uri, 'vbm', 'atlas2')
+        assert get_engine(uri) is engine
+        assert len(list_features_old(uri)) == 2
+        c_df1 = read_features_old(
+            uri, 'vbm', 'atlas', index_col=index_col, agg_function='mean')
+        assert_frame_equal(df1, c_df1)
+        assert engine.pool.checkedout() == 0
+
+        dispose(uri)
+        assert get_engine(uri) is not engine
+        with pytest.raises(ValueError, match='Unknown storage kind'):
+            get_storage(f'{_tmpdir}/test.db', kind='csv')
+        dispose()
+
+
+df_events = pd.DataFrame({
+    'subject': ['sub-01'] * 3 + ['sub-02'] * 3,
+    'timepoint': [0, 1, 2, 0, 1, 2],
+    'DEFAULT_a~b': [.1, .2, .3, .4, .5, .6],
+    'VIS_a~b': [1., 2., 3., 4., 5., 6.],
+    'n_trial': [1, 1, 2, 1, 1, 2],
+}).set_index(['subject', 'timepoint'])
+
+
+def test_io_features_parquet():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        path = f'{_tmpdir}/features.parquet'
+        save_features_parquet(df_events, path)
+
+        c_df = read_features_parquet(path)
+        assert_frame_equal(df_events, c_df)
+
+        c_df = read_features_parquet(path, columns=['DEFAULT_.*', 'n_trial'])
+        assert_frame_equal(df_events[['DEFAULT_a~b', 'n_trial']], c_df)
+
+        c_df = read_features_parquet(
+            path, columns='VIS_.*', subjects=['sub-02'], timepoints=[1, 2])
+        assert_frame_equal(df_events[['VIS_a~b']].iloc[4:], c_df)
+
+        # Partial writes keep the other subjects, overwrite does not
+        sub_01 = df_events.xs('sub-01', level='subject', drop_level=False)
+        save_features_parquet(sub_01, path)
+        assert_frame_equal(df_events, read_features_parquet(path))
+        save_features_parquet(sub_01, path, overwrite=True)
+        assert_frame_equal(sub_01, read_features_parquet(path))
+        assert read_catalog(_tmpdir).loc['features.parquet', 'n_rows'] == (
+            sub_01.shape[0])
+
+
+def test_upsert_update():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'sqlite:///{_tmpdir}/test.db'
+        engine = create_engine(uri, echo=False)
+        df1.to_sql(name=table_name, con=engine, if_exists='replace')
+
+        _save_upsert(df2, table_name, engine, upsert='update', chunksize=2)
+
+        c_dfupdate = pd.read_sql(table_name, con=engine, index_col=index_col)
+        assert_frame_equal(c_dfupdate, df_update)
+
+
+def test_read_jay_files():
+    import datatable as dt
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        dt.Frame({
+            'SubjectID': ['sub-3', 'sub-1', 'sub-2', 'sub-4'],
+            'mean(a)': [3., 1., 2., 4.],
+        }).to_jay(f'{_tmpdir}/f1.jay')
+        dt.Frame({
+            'SubjectID': ['sub-1', 'sub-2', 'sub-3', 'sub-5'],
+            'mean(a)': [10., None, 30., 50.],
+        }).to_jay(f'{_tmpdir}/f2.jay')
+
+        c_df = read_jay_files(
+            Path(_tmpdir), {'f1.jay': 'F1', 'f2.jay': 'F2'}, n_jobs=2)
+
+        expected = pd.DataFrame({
+            'SubjectID': ['sub-1', 'sub-3'],
+            'F1_meana': [1., 3.],
+            'F2_meana': [10., 30.],
+        }).set_index('SubjectID')
+        assert_frame_equal(expected, c_df)
+
+        # Same rows, in the same order, as the left join of the files
+        dt.Frame({
+            'SubjectID': ['sub-10', 'sub-9', 'sub-2', 'sub-1', 'sub-3'],
+            'mean(a)': [1., 2., 3., 4., 5.],
+        }).to_jay(f'{_tmpdir}/f1.jay')
+        joined = None
+        for fname in ['f1.jay', 'f2.jay']:
+            t_dt = dt.fread(f'{_tmpdir}/{fname}')
+            t_dt.key = 'SubjectID'
+            t_dt.names = {'mean(a)': f'{fname[:2].upper()}_meana'}
+            joined = t_dt if joined is None else joined[:, :, dt.join(t_dt)]
+        joined = joined[dt.rowall(dt.f[:] != None), :]  # noqa: E711
+        expected = joined.to_pandas().set_index('SubjectID')
+        c_df = read_jay_files(
+            Path(_tmpdir), {'f1.jay': 'F1', 'f2.jay': 'F2'})
+        assert_frame_equal(expected, c_df)
+
+
+def test_read_features_junifer():
+    storage_module = pytest.importorskip('junifer.storage')
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'{_tmpdir}/test.db'
+        storage = storage_module.SQLiteFeatureStorage(uri, single_output=True)
+        for i, subject in enumerate(['1001', '1002', '1003']):
+            element = {'subject': subject}
+            storage.store_metadata(
+                meta_md5='md5', element=element,
+                meta={'name': 'BOLD_fc', 'marker': {}, 'dependencies': []})
+            storage.store_timeseries(
+                meta_md5='md5', element=element,
+                data=np.arange(6.).reshape(2, 3) + i,
+                col_names=['LH_a', 'LH_b', 'RH_a'])
+
+        expected = pd.DataFrame({
+            'SubjectID': ['sub-1001', 'sub-1002', 'sub-1003'],
+            'LH_a': [0., 1., 2.],
+            'LH_b': [1., 2., 3.],
+            'RH_a': [2., 3., 4.],
+        }).set_index('SubjectID')
+
+        c_df = read_features(uri, 'BOLD_fc')
+        assert_frame_equal(expected, c_df)
+
+        c_df = read_features(
+            uri, 'BOLD_fc', columns=['LH_.*'], subjects=['sub-1003', '1001'])
+        assert_frame_equal(expected.iloc[[0, 2], :2], c_df)
+
+        # The storage (and its engine) is reused
+        pooled = get_storage(uri)
+        assert get_storage(uri) is pooled
+        assert pooled.get_engine() is pooled.get_engine()
+        assert list(pooled.list_features()) == list(storage.list_features())
+        dispose()
+
+
+def test_junifer_table_index():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        engine = create_engine(f'sqlite:///{_tmpdir}/test.db')
+        pd.DataFrame({'name': ['"BOLD_fc"'], 'meta_md5': ['md5']}).to_sql(
+            'meta', engine, index=False)
+        df = pd.DataFrame({
+            'subject': ['1001', '1001', '1002'],
+            'timepoint': [0, 1, 0],
+            'LH_a': [0., 1., 2.]}).set_index(['subject', 'timepoint'])
+        # One index per level, as pandas (and junifer) creates them
+        df.to_sql('meta_md5', engine)
+
+        def _index_col():
+            _POOL['tables'].clear()
+            return _junifer_table(engine, 'BOLD_fc')[1]
+
+        assert _index_col() == ['subject', 'timepoint']
+
+        # A composite index is read in its order, not the table order
+        with engine.begin() as con:
+            con.execute(text(
+                'CREATE UNIQUE INDEX ix_keys ON meta_md5 '
+                '(timepoint, subject)'))
+        assert _index_col() == ['timepoint', 'subject']
+
+        with engine.begin() as con:
+            con.execute(text(
+                'CREATE UNIQUE INDEX ix_other ON meta_md5 (LH_a)'))
+        with pytest.raises(ValueError, match='Expected one index'):
+            _index_col()
+        engine.dispose()
+
+
+def test_read_apoe():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        fname = f'{_tmpdir}/apoe.tsv'
+        with open(fname, 'w') as fid:
+            fid.write('SNP\t1001\t1002\t1003\n')
+            fid.write('rs1\tAA\tAG\tGG\n')
+            fid.write('rs429358\tTT\tTC\tTT\n')
+            fid.write('rs2\tCC\tCT\tTT\n')
+            fid.write('rs7412\tCC\tCC\tCT\n')
+            fid.write('rs3\tGG\tGG\tAG\n')
+
+        c_df = read_apoe(fname)
+
+        expected = pd.DataFrame({
+            'SubjectID': ['sub-1001', 'sub-1002', 'sub-1003'],
+            'rs429358': ['TT', 'TC', 'TT'],
+            'rs7412': ['CC', 'CC', 'CT'],
+            'APOE': ['TTCC', 'TCCC', 'TTCT'],
+        }).set_index('SubjectID')
+        assert_frame_equal(expected, c_df)
+
+        with pytest.raises(ValueError, match='rs4'):
+            read_snps(fname, ['rs1', 'rs4'])
+
+
+def test_read_pheno_cache():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        fname = Path(_tmpdir) / 'pheno.csv'
+        with open(fname, 'w') as fid:
+            fid.write('eid,age,sex,site\n1,30,M,a\n2,,F,b\n3,40,F,a\n')
+
+        c_df = read_pheno(
+            fname, columns=['age', 'sex'], dtype={'age': 'float32'},
+            categories=['sex'])
+        assert list(c_df.index) == ['sub-1', 'sub-2', 'sub-3']
+        assert list(c_df.columns) == ['age', 'sex']
+        assert c_df['age'].dtype == np.float32
+        assert c_df['sex'].dtype == 'category'
+        assert len(list(Path(_tmpdir).glob('.pheno.csv.*.pkl'))) == 1
+
+        # Same schema: read from the cache
+        assert_frame_equal(c_df, read_pheno(
+            fname, columns=['age', 'sex'], dtype={'age': 'float32'},
+            categories=['sex']))
+
+        # Modified file: parse again and replace the cache
+        with open(fname, 'a') as fid:
+            fid.write('4,50,M,b\n')
+        c_df = read_pheno(fname)
+        assert list(c_df.index) == ['sub-1', 'sub-2', 'sub-3', 'sub-4']
+        assert list(c_df.columns) == ['age', 'sex', 'site']
+        assert len(list(Path(_tmpdir).glob('.pheno.csv.*.pkl'))) == 1
+
+        # The parser engine is part of the key: a frame parsed by one
+        # engine is not served to the other
+        cached = list(Path(_tmpdir).glob('.pheno.csv.*.pkl'))[0]
+        pd.to_pickle(pd.DataFrame({'x': [0]}), cached)
+        c_df = _read_csv_cached(fname, engine='python')
+        assert list(c_df.columns) == ['eid', 'age', 'sex', 'site']
+        assert list(Path(_tmpdir).glob('.pheno.csv.*.pkl')) != [cached]
+        assert len(list(Path(_tmpdir).glob('.pheno.csv.*'))) == 1
+
+
+def test_read_prs():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        fname = Path(_tmpdir) / 'prs.tsv'
+        with open(fname, 'w') as fid:
+            fid.write('1001\t1002\t1003\n0.5\t\t-0.2\n')
+
+        c_df = read_prs(fname, cache=False)
+        expected = pd.DataFrame({
+            'SubjectID': ['sub-1001', 'sub-1003'],
+            'prs': [0.5, -0.2],
+        }).set_index('SubjectID')
+        assert_frame_equal(expected, c_df)
+        assert len(list(Path(_tmpdir).glob('.prs.tsv.*.pkl'))) == 0
+
+
+def test_catalog():
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        save_features_parquet(df_events, f'{_tmpdir}/IPC.parquet')
+        save_features(df1, f'sqlite:///{_tmpdir}/test.db', 'vbm', 'atlas')
+
+        catalog = read_catalog(_tmpdir)
+        assert list(catalog.index) == ['IPC.parquet', 'test.db/vbm$atlas']
+        entry = catalog.loc['IPC.parquet']
+        assert entry['n_rows'] == 6
+        assert entry['n_columns'] == 3
+        assert entry['subjects'] == ['sub-01', 'sub-02']
+        assert entry['column_groups'] == {'DEFAULT': 1, 'VIS': 1, 'n': 1}
+        assert entry['dtypes'] == {'float64': 2, 'int64': 1}
+        assert catalog.loc['test.db/vbm$atlas', 'n_rows'] == 5
+
+        # Rewriting one partition keeps the other subjects
+        parquet_hash = entry['content_hash']
+        save_features_parquet(
+            df_events.iloc[3:] * 2, f'{_tmpdir}/IPC.parquet')
+        save_features(df2, f'sqlite:///{_tmpdir}/test.db', 'vbm', 'atlas')
+        catalog = read_catalog(f'{_tmpdir}/catalog.json')
+        entry = catalog.loc['IPC.parquet']
+        assert entry['n_rows'] == 6
+        assert entry['subjects'] == ['sub-01', 'sub-02']
+        assert entry['content_hash'] != parquet_hash
+        assert catalog.loc['test.db/vbm$atlas', 'n_rows'] == 6
+
+        # .jay files, hashed on disk
+        save_features_jay(df_events, f'{_tmpdir}/IPC.jay')
+        catalog = list_features(_tmpdir)
+        entry = catalog.loc['IPC.jay']
+        assert entry['n_rows'] == 6
+        assert entry['subjects'] == ['sub-01', 'sub-02']
+        save_features_jay(df_events, f'{_tmpdir}/IPC.jay')
+        assert read_catalog(_tmpdir).loc['IPC.jay', 'content_hash'] == (
+            entry['content_hash'])
+        assert 'files' not in catalog.columns
+
+
+def _update_catalog_job(args):
+    path, i = args
+    df = df_events.rename(columns=lambda x: f'{x}_{i}')
+    save_features_jay(df, f'{path}/f{i}.jay')
+
+
+def test_catalog_concurrent_writers():
+    import multiprocessing
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(4) as pool:
+            pool.map(_update_catalog_job, [(_tmpdir, i) for i in range(16)])
+        catalog = read_catalog(_tmpdir)
+        assert sorted(catalog.index) == sorted(
+            f'f{i}.jay' for i in range(16))
+
+
+def test_iter_features():
+    import datatable as dt
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        save_features_parquet(df_events, f'{_tmpdir}/features.parquet')
+        dt.Frame(df_events.reset_index()).to_jay(f'{_tmpdir}/features.jay')
+        for source in ['features.parquet', 'features.jay']:
+            parts = list(iter_features(
+                f'{_tmpdir}/{source}', by='subject', columns='VIS_.*'))
+            assert len(parts) == 2
+            assert_frame_equal(pd.concat(parts), df_events[['VIS_a~b']])
+
+            parts = list(iter_features(f'{_tmpdir}/{source}', chunksize=2))
+            assert all(x.shape[0] <= 2 for x in parts)
+            assert_frame_equal(pd.concat(parts), df_events)
+
+        with pytest.raises(ValueError, match='Exactly one'):
+            next(iter_features(f'{_tmpdir}/features.jay'))
+
+
+def test_iter_features_hdf5():
+    storage_module = pytest.importorskip('junifer.storage')
+    with tempfile.TemporaryDirectory() as _tmpdir:
+        uri = f'{_tmpdir}/test.hdf5'
+        storage = storage_module.HDF5FeatureStorage(uri, single_output=True)
+        for task in ['ES', 'rest']:
+            for i, subject in enumerate(['1001', '1002']):
+                element = {'subject': subject, 'task': task}
+                storage.store_metadata(
+                    meta_md5='md5', element=element,
+                    meta={'name': 'BOLD_fc', 'marker': {},
+                          'dependencies': []})
+                storage.store_timeseries(
+                    meta_md5='md5', element=element,
+                    data=np.arange(9.).reshape(3, 3) + i,
+                    col_names=['a~b', 'a~c', 'b~c'])
+        expected = storage.read_df('BOLD_fc')
+
+        parts = list(iter_features(uri, by='subject', feature_name='BOLD_fc'))
+        assert len(parts) == 2
+        assert_frame_equal(
+            pd.concat(parts).sort_index(), expected.sort_index(),
+            check_index_type=False)
+
+        parts = list(iter_features(
+            uri, chunksize=2, columns='a~.*', feature_name='BOLD_fc'))
+        assert len(parts) == 8
+        assert_frame_equal(
+            pd.concat(parts), expected[['a~b', 'a~c']],
+            check_index_type=False)
+
+
+def test_apply_dtype_policy():
+    df = df_events.copy()
+    df['event'] = ['probe', 'rest', 'probe', 'rest', 'rest', 'probe']
+    df['seconds_to_probe'] = [-1.5, 0., -1.5, 0., -3., 0.]
+    out = apply_dtype_policy(df)
+    assert out['DEFAULT_a~b'].dtype == np.float32
+    assert out['seconds_to_probe'].dtype == np.float32
+    assert out['n_trial'].dtype == np.int8
+    assert isinstance(out['event'].dtype, pd.CategoricalDtype)
+    t_index = out.reset_index()
+    assert isinstance(t_index['subject'].dtype, pd.CategoricalDtype)
+    assert t_index['timepoint'].dtype == np.int8
+    expected = df.reset_index()
+    assert_frame_equal(
+        t_index.astype(expected.dtypes.to_dict()), expected,
+        check_exact=False)
+    assert df['DEFAULT_a~b'].dtype == np.float64
+
+    out = apply_dtype_policy(df, policy={'float': 'float64'})
+    assert out['DEFAULT_a~b'].dtype == np.float64
+    assert out['n_trial'].dtype == np.int8
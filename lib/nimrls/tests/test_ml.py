@@ -0,0 +1,354 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.datasets import make_classification
+from sklearn.metrics import balanced_accuracy_score
+from sklearn.decomposition import PCA
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.linear_model import LogisticRegression, RidgeClassifier
+from sklearn.exceptions import NotFittedError
+from sklearn.model_selection import (
+    GridSearchCV, GroupKFold, StratifiedKFold)
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import MaxAbsScaler, RobustScaler, StandardScaler
+from sklearn.svm import LinearSVC
+
+from nimrls import ml
+from nimrls.ml import (
+    BatchedLOSO, CompactLinearDecoder, Float32LinearSVC,
+    Float32LinearSVCHeuristicC, Float32LogisticRegressionHeuristicC,
+    Float32StandardScaler,
+    IncrementalDecoder, LinearSVCHeuristicC, RegularizationPathClassifier,
+    SharedPreprocessingGridSearchCV, heuristic_C)
+
+
+class CountingScaler(TransformerMixin, BaseEstimator):
+    n_fits = 0
+
+    def fit(self, X, y=None):
+        CountingScaler.n_fits += 1
+        self.scaler_ = StandardScaler().fit(X)
+        return self
+
+    def transform(self, X):
+        return self.scaler_.transform(X)
+
+
+def test_shared_preprocessing_grid_search():
+    X, y = make_classification(
+        n_samples=200, n_features=20, random_state=0)
+    cv = StratifiedKFold(5, shuffle=True, random_state=0)
+    grid = {'C': [0.001, 0.01, 0.1, 1, 10]}
+
+    CountingScaler.n_fits = 0
+    search = SharedPreprocessingGridSearchCV(
+        Pipeline([('zscore', CountingScaler()), ('pca', PCA(10))]),
+        LinearSVC(), grid, cv=cv)
+    search.fit(X, y)
+    # Once per inner split and once for the refit
+    assert CountingScaler.n_fits == 6
+
+    CountingScaler.n_fits = 0
+    expected = GridSearchCV(
+        Pipeline([
+            ('zscore', CountingScaler()), ('pca', PCA(10)),
+            ('svm', LinearSVC())]),
+        {'svm__C': grid['C']}, cv=cv, scoring='balanced_accuracy')
+    expected.fit(X, y)
+    assert CountingScaler.n_fits == 26
+
+    np.testing.assert_allclose(
+        search.cv_results_['mean_test_score'],
+        expected.cv_results_['mean_test_score'])
+    assert search.best_params_['C'] == expected.best_params_['svm__C']
+    np.testing.assert_array_equal(search.predict(X), expected.predict(X))
+    np.testing.assert_allclose(
+        search.decision_function(X), expected.decision_function(X))
+    np.testing.assert_array_equal(search.classes_, [0, 1])
+
+
+def test_heuristic_C(monkeypatch):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(1000, 30))
+    expected = 1 / np.mean(np.sqrt((X ** 2).sum(axis=1)))
+    assert heuristic_C(X) == pytest.approx(expected)
+    assert heuristic_C(X, chunksize=7) == pytest.approx(expected)
+    assert heuristic_C(X.astype(np.float32)) == pytest.approx(
+        expected, rel=1e-5)
+    assert heuristic_C(pd.DataFrame(X), chunksize=100) == pytest.approx(
+        expected)
+    X_sparse = sparse.random(200, 30, density=0.1, random_state=0)
+    assert heuristic_C(X_sparse.tocsc()) == pytest.approx(
+        heuristic_C(X_sparse.toarray()))
+    assert heuristic_C(np.ones((3, 4), dtype=int)) == pytest.approx(0.5)
+    with pytest.raises(ValueError, match='No data'):
+        heuristic_C(None)
+
+    # Memoised by fingerprint: the same matrix hits, a changed one misses
+    X2 = X.copy()
+    C = heuristic_C(X2)
+    calls = []
+    sum_row_norms = ml._sum_row_norms
+    monkeypatch.setattr(
+        ml, '_sum_row_norms',
+        lambda *args: calls.append(args) or sum_row_norms(*args))
+    assert heuristic_C(X2) == C
+    assert LinearSVCHeuristicC().fit(X2, X2[:, 0] > 0).C == C
+    assert not calls
+    X2 *= 2
+    assert heuristic_C(X2) == pytest.approx(C / 2)
+    assert heuristic_C(X2[:-1]) == pytest.approx(
+        1 / np.mean(np.sqrt((X2[:-1] ** 2).sum(axis=1))))
+    assert heuristic_C(X2, cache=False) == pytest.approx(C / 2)
+    assert len(calls) == 3
+
+
+def test_linear_svc_heuristic_C():
+    X, y = make_classification(n_samples=100, random_state=0)
+    model = LinearSVCHeuristicC().fit(X, y)
+    assert model.C == pytest.approx(heuristic_C(X))
+
+
+def test_regularization_path_classifier():
+    X, y = make_classification(
+        n_samples=300, n_features=30, n_informative=5, random_state=0)
+    X = StandardScaler().fit_transform(X)
+    y = np.where(y == 1, 'MB', 'other')
+    Cs = [1e-3, 1e-2, 1e-1, 1]
+    model = RegularizationPathClassifier(
+        Cs=Cs[::-1], class_weight='balanced').fit(X, y)
+    np.testing.assert_array_equal(model.Cs_, Cs)
+    assert model.cv_scores_.shape == (4, 5)
+    assert model.coefs_path_.shape == (4, 30)
+    assert model.C_ in Cs
+    # Same solutions as LinearSVC without intercept regularisation
+    for i, C in enumerate(Cs):
+        ref = LinearSVC(
+            C=C, class_weight='balanced', intercept_scaling=1000,
+            tol=1e-8, max_iter=10000).fit(X, y)
+        np.testing.assert_allclose(
+            model.coefs_path_[i], ref.coef_[0], atol=1e-3)
+    i_best = Cs.index(model.C_)
+    np.testing.assert_array_equal(model.coef_[0], model.coefs_path_[i_best])
+    assert set(model.predict(X)) == {'MB', 'other'}
+    with pytest.raises(ValueError, match='predict_proba'):
+        model.predict_proba(X)
+
+    model = RegularizationPathClassifier(
+        loss='logistic', Cs=Cs, max_iter=10000).fit(X, y)
+    for i, C in enumerate(Cs):
+        ref = LogisticRegression(C=C, tol=1e-8, max_iter=10000).fit(X, y)
+        np.testing.assert_allclose(
+            model.coefs_path_[i], ref.coef_[0], atol=1e-3)
+    proba = model.predict_proba(X)
+    np.testing.assert_allclose(proba.sum(axis=1), 1)
+
+    with pytest.raises(ValueError, match='not available'):
+        RegularizationPathClassifier(penalty='l1').fit(X, y)
+
+
+class RecordingGroupKFold(GroupKFold):
+    def split(self, X, y=None, groups=None):
+        self.groups_ = groups
+        return super().split(X, y, groups)
+
+
+def test_regularization_path_groups():
+    X, y = make_classification(n_samples=120, n_features=10, random_state=0)
+    groups = np.repeat(np.arange(30), 4)
+    cv = RecordingGroupKFold(n_splits=3)
+    model = RegularizationPathClassifier(Cs=[0.1, 1], cv=cv)
+    with pytest.raises(NotFittedError):
+        model.decision_function(X)
+    model.fit(X, y, groups)
+    np.testing.assert_array_equal(cv.groups_, groups)
+
+    # Groups of the rows looked up by the index of X, rows shuffled
+    order = np.random.default_rng(0).permutation(120)
+    X_df = pd.DataFrame(X).iloc[order]
+    model = RegularizationPathClassifier(
+        Cs=[0.1, 1], cv=cv, row_groups=pd.Series(groups)).fit(X_df, y[order])
+    np.testing.assert_array_equal(cv.groups_, groups[order])
+    with pytest.raises(ValueError, match='requires X with an index'):
+        model.fit(X, y)
+    with pytest.raises(ValueError, match='fitted with 10'):
+        model.decision_function(X[:, :5])
+
+
+@pytest.mark.parametrize('model, reference', [
+    ('ridge', RidgeClassifier(alpha=10.)),
+    ('lda', LinearDiscriminantAnalysis(solver='lsqr')),
+    ('lda', LinearDiscriminantAnalysis(solver='lsqr', shrinkage=0.3)),
+])
+def test_batched_loso(model, reference):
+    X, y = make_classification(
+        n_samples=400, n_features=15, random_state=0)
+    X = 3 * X + 5
+    y = np.where(y == 1, 'MB', 'other')
+    groups = np.repeat([f'sub-{i:02d}' for i in range(8)], 50)
+    loso = BatchedLOSO(
+        model=model, alpha=10., shrinkage=reference.get_params().get(
+            'shrinkage')).fit(X, y, groups)
+    assert loso.coefs_.shape == (8, 15)
+
+    decision = loso.decision_function(X, groups)
+    for i_fold, group in enumerate(loso.groups_):
+        train = groups != group
+        expected = make_pipeline(StandardScaler(), reference).fit(
+            X[train], y[train])
+        fold_model = loso.fold_estimator(i_fold)
+        np.testing.assert_allclose(
+            fold_model.decision_function(X[~train]),
+            expected.decision_function(X[~train]), atol=1e-8)
+        np.testing.assert_allclose(
+            decision[~train], expected.decision_function(X[~train]),
+            atol=1e-8)
+        np.testing.assert_array_equal(
+            fold_model.predict(X[~train]), expected.predict(X[~train]))
+
+
+def test_incremental_decoder():
+    X, y = make_classification(
+        n_samples=3000, n_features=20, weights=[0.85], random_state=0)
+    X = 10 * X + 3
+    X_train, y_train, X_test, y_test = X[:2000], y[:2000], X[2000:], y[2000:]
+
+    model = IncrementalDecoder(random_state=0)
+    with pytest.raises(ValueError, match='first partial_fit'):
+        model.partial_fit(X_train[:10], y_train[:10])
+    with pytest.raises(ValueError, match='z-scorer is not fitted'):
+        model.partial_fit(
+            X_train[:10], y_train[:10], classes=[0, 1], update_scaler=False)
+    assert not hasattr(model, 'classes_')
+    for start in range(0, 2000, 250):
+        model.partial_fit(
+            X_train[start:start + 250], y_train[start:start + 250],
+            classes=[0, 1])
+    np.testing.assert_array_equal(
+        model.class_counts_, np.bincount(y_train))
+    np.testing.assert_allclose(model.scaler_.mean_, X_train.mean(axis=0))
+    assert balanced_accuracy_score(y_test, model.predict(X_test)) > 0.7
+    with pytest.raises(ValueError, match='not in classes'):
+        model.partial_fit(X_train[:2], [0, 2])
+
+    model = IncrementalDecoder(random_state=0).fit(X_train, y_train)
+    assert balanced_accuracy_score(y_test, model.predict(X_test)) > 0.7
+    proba = model.predict_proba(X_test)
+    np.testing.assert_allclose(proba.sum(axis=1), 1)
+    # Refitting starts from scratch
+    model.fit(X_train[:100], y_train[:100])
+    assert model.class_counts_.sum() == 100
+
+    model = IncrementalDecoder(loss='hinge', random_state=0)
+    model.fit(X_train, y_train)
+    with pytest.raises(ValueError, match='predict_proba'):
+        model.predict_proba(X_test)
+
+
+def test_float32_standard_scaler():
+    rng = np.random.default_rng(0)
+    X = 5 * rng.standard_normal((100, 10)) + 2
+    X_32 = X.astype(np.float32)
+    expected = StandardScaler().fit_transform(X)
+
+    for t_X in [X, X_32, pd.DataFrame(X)]:
+        out = Float32StandardScaler().fit_transform(t_X)
+        assert out.dtype == np.float32
+        np.testing.assert_allclose(out, expected, atol=1e-5)
+        # Fitted by chunks of rows
+        scaler = Float32StandardScaler(chunksize=30).fit(t_X)
+        assert scaler.n_samples_seen_ == 100
+        out = scaler.transform(t_X)
+        assert out.dtype == np.float32
+        np.testing.assert_allclose(out, expected, atol=1e-5)
+    # The input is not modified
+    np.testing.assert_array_equal(X_32, X.astype(np.float32))
+
+
+@pytest.mark.parametrize('penalty', ['l2', 'l1'])
+def test_float32_linear_svc(penalty):
+    X, y = make_classification(
+        n_samples=400, n_features=30, n_informative=5, random_state=0)
+    # Large intercept_scaling so liblinear barely regularises it
+    reference = LinearSVC(
+        penalty=penalty, dual=False, C=0.1, tol=1e-8, max_iter=10000,
+        intercept_scaling=100).fit(X, y)
+    model = Float32LinearSVC(
+        penalty=penalty, C=0.1, tol=1e-6, max_iter=10000)
+    model.fit(X.astype(np.float32), y)
+    np.testing.assert_allclose(model.coef_, reference.coef_, atol=1e-3)
+    assert model.decision_function(X.astype(np.float32)).dtype == np.float32
+    assert (model.predict(X) == reference.predict(X)).mean() > 0.99
+    if penalty == 'l1':
+        assert (model.coef_ == 0).sum() > 0
+
+    with pytest.raises(ValueError, match='binary'):
+        model.fit(X, np.arange(len(y)) % 3)
+    with pytest.raises(ValueError, match='Unknown penalty'):
+        Float32LinearSVC(penalty='l0').fit(X, y)
+
+
+def test_float32_heuristic_C():
+    X, y = make_classification(n_samples=200, n_features=20, random_state=0)
+    X = X.astype(np.float32)
+    model = Float32LinearSVCHeuristicC(penalty='l1').fit(X, y)
+    assert model.C == pytest.approx(heuristic_C(X))
+
+    model = Float32LogisticRegressionHeuristicC(l1_ratio=1., solver='saga')
+    model.fit(X.astype(np.float64), y)
+    assert model.coef_.dtype == np.float32
+    assert model.C == pytest.approx(heuristic_C(X), rel=1e-5)
+    with pytest.raises(ValueError, match='liblinear'):
+        Float32LogisticRegressionHeuristicC(solver='liblinear').fit(X, y)
+
+
+def test_compact_linear_decoder(tmp_path):
+    X, y = make_classification(
+        n_samples=300, n_features=40, n_informative=4, random_state=0)
+    df = pd.DataFrame(
+        5 * X + 2, columns=[f'LH_Vis_{i}~RH_Vis_{i}' for i in range(40)])
+    model = make_pipeline(
+        StandardScaler(),
+        LinearSVC(penalty='l1', dual=False, C=0.01)).fit(df, y)
+    decoder = CompactLinearDecoder.from_estimator(model)
+    n_nonzero = (model[-1].coef_ != 0).sum()
+    assert 0 < len(decoder.features) == n_nonzero < 40
+    np.testing.assert_allclose(
+        decoder.decision_function(df), model.decision_function(df))
+    # Arrays with only the features kept
+    np.testing.assert_allclose(
+        decoder.decision_function(df[decoder.features].to_numpy()),
+        model.decision_function(df))
+    np.testing.assert_array_equal(decoder.predict(df), model.predict(df))
+    assert all(pd.Series(df.columns).str.fullmatch(x).sum() == 1
+               for x in decoder.columns)
+
+    fname = tmp_path / 'decoder.npz'
+    decoder.save(fname)
+    loaded = CompactLinearDecoder.load(fname)
+    assert loaded.features == decoder.features
+    np.testing.assert_allclose(
+        loaded.decision_function(df), decoder.decision_function(df))
+
+    # Searches are unwrapped, feature names can be passed
+    search = GridSearchCV(
+        make_pipeline(
+            StandardScaler(),
+            LogisticRegression(l1_ratio=1., solver='saga', max_iter=1000)),
+        {'logisticregression__C': [0.05, 0.1]}, cv=3).fit(X, y)
+    decoder = CompactLinearDecoder.from_estimator(
+        search, feature_names=df.columns)
+    idx = df.columns.get_indexer(decoder.features)
+    np.testing.assert_allclose(
+        decoder.decision_function(X[:, idx]), search.decision_function(X))
+
+    for t_step in [PCA(5), MaxAbsScaler(), RobustScaler()]:
+        with pytest.raises(ValueError, match='Can not compact'):
+            CompactLinearDecoder.from_estimator(
+                make_pipeline(t_step, LinearSVC()).fit(X, y))
+    with pytest.raises(ValueError, match='No feature names'):
+        CompactLinearDecoder.from_estimator(LinearSVC().fit(X, y))
+    with pytest.raises(ValueError, match='Expected'):
+        decoder.decision_function(X)
@@ -3,34 +3,17 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 from junifer.storage import HDF5FeatureStorage
-import re
-import datatable as dt
+import sys
 
+REPO_ROOT = Path(__file__).resolve().parents[3]
+sys.path.insert(0, str(REPO_ROOT / "lib"))
+from nimrls.connectivity import Connectivity
+from nimrls.fingerprint import is_up_to_date, write_manifest
+from nimrls.io import (
+    read_features_parquet, save_features_jay, save_features_parquet)
+from nimrls.logging import configure_logging, logger
 
-def extract_network(region):
-    # Schaefer-style: take only the first segment after hemi prefix as network
-    m = re.match(r"^(LH|RH)_([A-Za-z]+)_", region)
-    if m:
-        return m.group(2)  # e.g. "Default", "DorsAttn", "Vis"
-
-    # Tian-style: HIP-rh, pTHA-lh
-    m = re.match(r"^[A-Za-z]+-(rh|lh)$", region)
-    if m:
-        return "Subcortex"
-
-    raise ValueError(f"Unrecognized region pattern: {region}")
-
-def new_name(col):
-    a, b = col.split("~")
-    net_a = extract_network(a)
-    net_b = extract_network(b)
-
-    if net_a == net_b:
-        label = net_a.upper()
-    else:
-        label = f"INTERNETWORK_{net_a}_{net_b}"
-
-    return f"{label}_{a}~{b}"
+configure_logging()
 
 
 data_path = Path("/data/project/mb_decoder/data/bids/mb_decoder/derivatives")
@@ -40,39 +23,57 @@ out_path_events = data_path / "features"
 out_path_events.mkdir(parents=True, exist_ok=True)
 
 
-# %% Load data
-IPC_file = HDF5FeatureStorage(uri=IPC_path/ "IPC_all.hdf5")
-IPC_all = IPC_file.read_df("BOLD_IPC_Schaefer_fc")
-
-events = pd.read_csv(events_path / "all_events.csv")
-events = events.set_index(['subject', 'timepoint'])
-
-# %% Organize IPC
-
-# Keep only task-ES
-IPC = IPC_all.xs("ES", level="task")
-
-# Keep only triangular matrix
-seen = set()
-keep_cols = []
-for col in IPC.columns:
-    a, b = col.split("~")
-    key = tuple(sorted([a, b]))
-    if key not in seen:
-        seen.add(key)
-        keep_cols.append(col)
-IPC = IPC[keep_cols]
-
-# Rename variables
-IPC.columns = [new_name(c) for c in IPC.columns]
-
-# Join events with IPC
-df = IPC.join(events, how='inner') 
-# Timepoints excluded (outside the inner joint): 
-    # (1) IPC first times from 0 to 8 (until task starts)
-    # (2) Event last timepoints calculated heuristically (stop recording)
-
-# Export to .jay
-df = df.reset_index()
-DT = dt.Frame(df)
-DT.to_jay(str(out_path_events / "IPC.jay"))
+# Skip if all the outputs were already computed from the current inputs
+# (including this script)
+store_path = IPC_path / "IPC_all.parquet"
+inputs = [
+    store_path if store_path.exists() else IPC_path / "IPC_all.hdf5",
+    events_path / "all_events.csv",
+    Path(__file__).resolve(),
+]
+outputs = [out_path_events / x for x in ["IPC.jay", "IPC.parquet"]]
+up_to_date = all(is_up_to_date(x, inputs) for x in outputs)
+if up_to_date:
+    logger.info("IPC features are up to date")
+else:
+    # %% Load data
+    # Keep only task-ES. The Parquet dataset is written by
+    # `python -m nimrls.convert IPC_all.hdf5 BOLD_IPC_Schaefer_fc IPC_all.parquet`
+    # and only the task-ES partitions are read.
+    if store_path.exists():
+        IPC = read_features_parquet(
+            store_path, tasks=["ES"], index_col=["subject", "task", "timepoint"])
+        IPC = IPC.droplevel("task")
+    else:
+        IPC_file = HDF5FeatureStorage(uri=IPC_path/ "IPC_all.hdf5")
+        IPC_all = IPC_file.read_df("BOLD_IPC_Schaefer_fc")
+        IPC = IPC_all.xs("ES", level="task")
+
+    events = pd.read_csv(events_path / "all_events.csv")
+    events = events.set_index(['subject', 'timepoint'])
+
+    # %% Organize IPC
+
+    # Keep only triangular matrix (packed, with ROI table, in the source
+    # dtype) and rename variables to <NETWORK>_a~b or
+    # INTERNETWORK_<netA>_<netB>_a~b
+    IPC = Connectivity.from_frame(IPC).to_frame()
+
+    # Join events with IPC
+    df = IPC.join(events, how='inner') 
+    # Timepoints excluded (outside the inner joint): 
+        # (1) IPC first times from 0 to 8 (until task starts)
+        # (2) Event last timepoints calculated heuristically (stop recording)
+
+    # Export to .jay
+    df = df.reset_index()
+    save_features_jay(df, out_path_events / "IPC.jay")
+
+    # Export to parquet, partitioned by subject (column-projected reads)
+    save_features_parquet(
+        df, out_path_events / "IPC.parquet", overwrite=True
+    )
+
+    # Only once all the outputs are written, so a failed run is redone
+    for x in outputs:
+        write_manifest(x, inputs)
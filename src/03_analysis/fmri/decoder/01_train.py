@@ -16,8 +16,13 @@ from sklearn.model_selection import (
     RepeatedKFold,
     train_test_split,
 )
-from sklearn.svm import LinearSVC
-from sklearn.feature_selection import SelectFromModel
+from sklearn.svm import SVC, LinearSVC
+from sklearn.decomposition import PCA
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.feature_selection import SelectFromModel, SelectKBest
+from sklearn.metrics import get_scorer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 import julearn
 from julearn import run_cross_validation
 from julearn.config import set_config
@@ -25,7 +30,24 @@ from julearn.pipeline import PipelineCreator
 
 REPO_ROOT = Path(__file__).resolve().parents[4]
 sys.path.insert(0, str(REPO_ROOT / "lib"))
-from nimrls.ml import LinearSVCHeuristicC, LogisticRegressionHeuristicC
+from nimrls.cv import (
+    DownsampledGroupCV,
+    RepeatedStratifiedGroupKFold,
+    cached_split,
+)
+from nimrls.io import apply_dtype_policy, read_features_parquet
+from nimrls.ml import (
+    BatchedLOSO,
+    CompactLinearDecoder,
+    Float32LinearSVCHeuristicC,
+    Float32LogisticRegressionHeuristicC,
+    Float32StandardScaler,
+    IncrementalDecoder,
+    LinearSVCHeuristicC,
+    LogisticRegressionHeuristicC,
+    RegularizationPathClassifier,
+    SharedPreprocessingGridSearchCV,
+)
 from nimrls.logging import (
     configure_logging,
     log_versions,
@@ -115,6 +137,23 @@ parser.add_argument(
     default=None,
 )
 
+parser.add_argument(
+    "--shared-prepro",
+    action="store_true",
+    help="Grid searches fit zscore/--dimred once per inner split.",
+)
+parser.add_argument(
+    "--downsample",
+    action="store_true",
+    help="Downsample the majority class by groups in the training folds.",
+)
+parser.add_argument(
+    "--low-memory",
+    action="store_true",
+    help="Load features as float32 and strings as categoricals, and keep "
+    "them float32 in zscore, linearsvchc and logithc.",
+)
+
 parser.add_argument(
     "--debug",
     action="store_true",
@@ -126,6 +165,13 @@ args = parser.parse_args()
 N_REPEATS = 5
 N_SPLITS = 5
 
+C_GRID = [0.0001, 0.001, 0.01, 0.1, 1, 10, 100, 1000, 10000, 1000000]
+TREES_GRID = {
+    "n_estimators": [200, 500],
+    "criterion": ["gini", "entropy", "log_loss"],
+    "max_features": ["sqrt", "log2"],
+}
+
 DEBUG_N_SUBJECTS = 5
 DEBUG_N_OPTUNA_TRIALS = 3
 
@@ -178,6 +224,73 @@ if dimred_method in ["pca", "selectkbest"] and dimred_value is None:
         f"Dimensionality reduction method '{dimred_method}' requires a value (e.g., 'pca95')."
     )
 
+################################################
+# Feature Selection
+################################################
+if features_metric == "IPC":
+    X_types = {
+        "DMN": ["DEFAULT_.*"],
+        "VIS": ["VIS_.*"],
+        "CONT": ["CONT_.*"],
+        "DORSATTN": ["DORSATTN_.*"],
+        "LIMBIC": ["LIMBIC_.*"],
+        "SALVENTATTN": ["SALVENTATTN_.*"],
+        "SOMMOT": ["SOMMOT_.*"],
+        "SUBCORTEX": ["SUBCORTEX_.*"],
+        "INTERNETWORK": ["INTERNETWORK_.*"],
+        "ONLYCORTICALNETWORKS": [
+            "DEFAULT_.*",
+            "VIS_.*",
+            "CONT_.*",
+            "DORSATTN_.*",
+            "LIMBIC_.*",
+            "SALVENTATTN_.*",
+            "SOMMOT_.*",
+        ],
+        "ONLYNETWORKS": [
+            "DEFAULT_.*",
+            "VIS_.*",
+            "CONT_.*",
+            "DORSATTN_.*",
+            "LIMBIC_.*",
+            "SALVENTATTN_.*",
+            "SOMMOT_.*",
+            "SUBCORTEX_.*",
+        ],
+        "ALL": [".+~.+"],
+    }
+elif features_metric == "GS":
+        X_types = {
+        "GS": ["global_signal_raw"],
+        "POWER": ["global_signal_power.*"],
+        "DERIVATIVE": ["global_signal_derivative.*"],
+        "ALL": ["global_signal.*"]
+    }
+elif features_metric == "WM":
+        X_types = {
+        "WM": ["white_matter_raw"],
+        "POWER": ["white_matter_power.*"],
+        "DERIVATIVE": ["white_matter_derivative.*"],
+        "ALL": ["white_matter.*"]
+    }
+elif features_metric == "CSF":
+        X_types = {
+        "CSF": ["csf_raw"],
+        "POWER": ["csf_power.*"],
+        "DERIVATIVE": ["csf_derivative.*"],
+        "ALL": ["csf.*"]
+    }
+else:
+    raise_error(f"Unknown feature: {features_metric}")
+
+if features_xtypes is not None and len(features_xtypes) > 0:
+    X = []
+    for xtype in features_xtypes:
+        X.extend(X_types[xtype])
+else:
+    X = X_types["ALL"]
+
+
 # %%
 ################################################
 # Directories & Data
@@ -195,8 +308,18 @@ out_path = (
 )
 out_path.mkdir(parents=True, exist_ok=True)
 
-df = fread(data_path / f"{features_metric}.jay")
-df = df.to_pandas().set_index(["subject", "timepoint"]).copy()
+# Columns needed besides the features (target, groups)
+meta_columns = ["n_trial", "seconds_to_probe", "response_prompt"]
+store_path = data_path / f"{features_metric}.parquet"
+if store_path.exists():
+    # Only read the columns matching the X_types of this run
+    df = read_features_parquet(store_path, columns=X + meta_columns)
+else:
+    df = fread(data_path / f"{features_metric}.jay")
+    df = df.to_pandas().set_index(["subject", "timepoint"]).copy()
+
+if args.low_memory:
+    df = apply_dtype_policy(df)
 
 logger.info(
     f"Loaded data: {df.shape[0]} rows, {df.shape[1]} columns, "
@@ -225,7 +348,9 @@ window_mask = (df["seconds_to_probe"] >= -target_window) & (
 df["target"] = np.where(window_mask, df["response_prompt"], np.nan)
 df = df[df["target"].notna()]
 
-counts = df.groupby(["subject", "n_trial"]).size()
+# observed=True: with --low-memory, subject is categorical and would
+# otherwise count every (subject, n_trial) combination, filtered out or not
+counts = df.groupby(["subject", "n_trial"], observed=True).size()
 logger.info(
     f"Target Window: {target_window}s | Total Obs: {len(df)} | "
     f"Avg TRs/Trial: {counts.mean():.2f} | {counts.value_counts().to_dict()}"
@@ -245,7 +370,9 @@ else:
     raise_error("Error converting target into binary category variable")
 
 target_subj = (
-    df.groupby(level="subject")["target"].value_counts().unstack(fill_value=0)
+    df.groupby(level="subject", observed=True)["target"]
+    .value_counts()
+    .unstack(fill_value=0)
 )
 no_target_subj = target_subj[(target_subj == 0).any(axis=1)].index.tolist()
 if no_target_subj:
@@ -264,79 +391,17 @@ if IS_DEBUG_TEST and df.index.get_level_values("subject").nunique() < 2:
         "Increase DEBUG_N_SUBJECTS or pick a different random seed."
     )
 
-################################################
-# Feature Selection
-################################################
-if features_metric == "IPC":
-    X_types = {
-        "DMN": ["DEFAULT_.*"],
-        "VIS": ["VIS_.*"],
-        "CONT": ["CONT_.*"],
-        "DORSATTN": ["DORSATTN_.*"],
-        "LIMBIC": ["LIMBIC_.*"],
-        "SALVENTATTN": ["SALVENTATTN_.*"],
-        "SOMMOT": ["SOMMOT_.*"],
-        "SUBCORTEX": ["SUBCORTEX_.*"],
-        "INTERNETWORK": ["INTERNETWORK_.*"],
-        "ONLYCORTICALNETWORKS": [
-            "DEFAULT_.*",
-            "VIS_.*",
-            "CONT_.*",
-            "DORSATTN_.*",
-            "LIMBIC_.*",
-            "SALVENTATTN_.*",
-            "SOMMOT_.*",
-        ],
-        "ONLYNETWORKS": [
-            "DEFAULT_.*",
-            "VIS_.*",
-            "CONT_.*",
-            "DORSATTN_.*",
-            "LIMBIC_.*",
-            "SALVENTATTN_.*",
-            "SOMMOT_.*",
-            "SUBCORTEX_.*",
-        ],
-        "ALL": [".+~.+"],
-    }
-elif features_metric == "GS":
-        X_types = {
-        "GS": ["global_signal_raw"],
-        "POWER": ["global_signal_power.*"],
-        "DERIVATIVE": ["global_signal_derivative.*"],
-        "ALL": ["global_signal.*"]
-    }
-elif features_metric == "WM":
-        X_types = {
-        "WM": ["white_matter_raw"],
-        "POWER": ["white_matter_power.*"],
-        "DERIVATIVE": ["white_matter_derivative.*"],
-        "ALL": ["white_matter.*"]
-    }
-elif features_metric == "CSF":
-        X_types = {
-        "CSF": ["csf_raw"],
-        "POWER": ["csf_power.*"],
-        "DERIVATIVE": ["csf_derivative.*"],
-        "ALL": ["csf.*"]
-    }
-else:
-    raise_error(f"Unknown feature: {features_metric}")
-
-if features_xtypes is not None and len(features_xtypes) > 0:
-    X = []
-    for xtype in features_xtypes:
-        X.extend(X_types[xtype])
-else:
-    X = X_types["ALL"]
-
 
 ################################################
 # General pipeline (applicable to any models)
 ################################################
 
 creator = PipelineCreator(problem_type="classification", apply_to="*")
-creator.add("zscore")
+if args.low_memory:
+    # Cast once to float32 (sklearn models upcast to float64 otherwise)
+    creator.add(Float32StandardScaler(), name="zscore")
+else:
+    creator.add("zscore")
 
 scoring = [
     "balanced_accuracy",
@@ -380,6 +445,7 @@ if dimred_method:
 ################################################
 search_params = None
 predict_proba = "proba"
+batched_loso = None
 
 if model_name in ["rf", "et"]:
     creator.add(model_name, class_weight="balanced")
@@ -390,7 +456,7 @@ elif model_name == "svm":
 elif model_name == "gssvm":
     creator.add(
         "svm",
-        C=[0.0001, 0.001, 0.01, 0.1, 1, 10, 100, 1000, 10000, 1000000],
+        C=C_GRID,
         kernel="linear",
         probability=True,
         class_weight="balanced",
@@ -398,28 +464,18 @@ elif model_name == "gssvm":
     search_params = {"kind": "grid", "scoring": "balanced_accuracy"}
 
 elif model_name == "gsrf":
-    n_estimators = [200, 500]
-    criterion = ["gini", "entropy", "log_loss"]
-    max_features = ["sqrt", "log2"]
     creator.add(
         "rf",
-        n_estimators=n_estimators,
-        criterion=criterion,
-        max_features=max_features,
+        **TREES_GRID,
         n_jobs=1,
         class_weight="balanced",
     )
     search_params = {"kind": "grid", "scoring": "balanced_accuracy"}
 
 elif model_name == "gset":
-    n_estimators = [200, 500]
-    max_features = ["sqrt", "log2"]
-    criterion = ["gini", "entropy", "log_loss"]
     creator.add(
         "et",
-        n_estimators=n_estimators,
-        criterion=criterion,
-        max_features=max_features,
+        **TREES_GRID,
         n_jobs=1,
     )
     search_params = {"kind": "grid", "scoring": "balanced_accuracy"}
@@ -429,7 +485,7 @@ elif model_name == "gslinearsvm":
     creator.add(
         model,
         name="linearsvc",
-        C=[0.0001, 0.001, 0.01, 0.1, 1, 10, 100, 1000, 10000, 1000000],
+        C=C_GRID,
         class_weight="balanced",
     )
     predict_proba = "decision"
@@ -451,25 +507,70 @@ elif model_name == "linearsvm":
     predict_proba = "decision"
 
 elif model_name == "linearsvchc":
-    model = LinearSVCHeuristicC()
-    creator.add(
-        model,
-        name="linearsvcheuristicc",
-        dual=False,
-        penalty="l1",
-    )
+    if args.low_memory:
+        # liblinear copies the data to float64
+        model = Float32LinearSVCHeuristicC()
+        creator.add(model, name="linearsvcheuristicc", penalty="l1")
+    else:
+        model = LinearSVCHeuristicC()
+        creator.add(
+            model,
+            name="linearsvcheuristicc",
+            dual=False,
+            penalty="l1",
+        )
     n_jobs = 1
     predict_proba = "decision"
 
 elif model_name == "logithc":
-    model = LogisticRegressionHeuristicC()
-    creator.add(
-        model,
-        name="logithc",
-        dual=False,
-        penalty="l1",
-        solver="liblinear",
+    if args.low_memory:
+        # saga keeps float32, liblinear copies the data to float64
+        model = Float32LogisticRegressionHeuristicC()
+        creator.add(model, name="logithc", l1_ratio=1.0, solver="saga")
+    else:
+        model = LogisticRegressionHeuristicC()
+        creator.add(
+            model,
+            name="logithc",
+            dual=False,
+            penalty="l1",
+            solver="liblinear",
+        )
+    predict_proba = "decision"
+
+elif model_name == "pathlinearsvm":
+    # Same C grid as gslinearsvm, fitted as one warm-started path per
+    # inner fold
+    model = RegularizationPathClassifier(
+        loss="squared_hinge", Cs=C_GRID, class_weight="balanced"
+    )
+    creator.add(model, name="pathlinearsvm")
+    predict_proba = "decision"
+
+elif model_name == "pathlogit":
+    model = RegularizationPathClassifier(
+        loss="logistic", penalty="l1", Cs=C_GRID, class_weight="balanced"
     )
+    creator.add(model, name="pathlogit")
+    predict_proba = "decision"
+
+elif model_name in ["sgdlogit", "sgdsvm"]:
+    # Trained by chunks with an online zscore, can also be updated with
+    # partial_fit as new subjects are acquired
+    model = IncrementalDecoder(
+        loss="log_loss" if model_name == "sgdlogit" else "hinge",
+        random_state=42,
+    )
+    creator.add(model, name=model_name)
+    predict_proba = "decision"
+
+elif model_name == "ridgeloso":
+    # All the LOSO folds are fitted at once from shared statistics
+    batched_loso = BatchedLOSO(model="ridge", alpha=1.0)
+    predict_proba = "decision"
+
+elif model_name == "ldaloso":
+    batched_loso = BatchedLOSO(model="lda")
     predict_proba = "decision"
 
 elif model_name == "dummy":
@@ -510,6 +611,49 @@ else:
         f"Model '{model_name}' not recognized. Choose a valid model string."
     )
 
+if args.shared_prepro:
+    # Fit zscore (and --dimred) once per inner split and reuse it for all
+    # the candidates, only the final estimator is fitted per candidate
+    shared_models = {
+        "gssvm": (
+            SVC(kernel="linear", probability=True, class_weight="balanced"),
+            {"C": C_GRID},
+        ),
+        "gslinearsvm": (
+            LinearSVC(class_weight="balanced"),
+            {"C": C_GRID},
+        ),
+        "gsrf": (
+            RandomForestClassifier(n_jobs=1, class_weight="balanced"),
+            TREES_GRID,
+        ),
+        "gset": (ExtraTreesClassifier(n_jobs=1), TREES_GRID),
+    }
+    if model_name not in shared_models:
+        raise_error(
+            f"--shared-prepro is only available for {list(shared_models)}"
+        )
+    prepro_steps = [StandardScaler()]
+    if dimred_method:
+        if "pca" in dimred_method:
+            prepro_steps.append(PCA(n_components=dimred_value))
+        elif "selectkbest" in dimred_method:
+            prepro_steps.append(SelectKBest(k=dimred_value))
+        else:
+            raise_error(f"--shared-prepro does not support --dimred {dimred}")
+    estimator, param_grid = shared_models[model_name]
+    creator = PipelineCreator(problem_type="classification", apply_to="*")
+    creator.add(
+        SharedPreprocessingGridSearchCV(
+            preprocessing=make_pipeline(*prepro_steps),
+            estimator=estimator,
+            param_grid=param_grid,
+            scoring=search_params["scoring"],
+        ),
+        name="search",
+    )
+    search_params = None
+
 if (
     IS_DEBUG_TEST
     and search_params is not None
@@ -543,11 +687,31 @@ elif cv == "kfold":
     groups_col = "trial_group"
     df[groups_col] = trial_id
     groups = df[groups_col].values
-    cv_splitter = StratifiedGroupKFold(
-        n_splits=N_SPLITS, shuffle=True, random_state=42
-    )  # no premade function to do REPEATED stratified GROUP k fold
+    cv_splitter = RepeatedStratifiedGroupKFold(
+        n_splits=N_SPLITS, n_repeats=N_REPEATS, random_state=42
+    )
     logger.info(
-        f"kfold: {df['trial_group'].nunique()} trial-groups -> {N_SPLITS} folds"
+        f"kfold: {df['trial_group'].nunique()} trial-groups -> "
+        f"{N_REPEATS}x{N_SPLITS} folds"
+    )
+
+if args.downsample and cv_splitter is not None:
+    # Balance the training folds by dropping whole majority-class trials,
+    # the test folds are not changed
+    trial_id = (
+        df["subject"].astype(str) + "_trial-" + df["n_trial"].astype(str)
+    )
+    cv_splitter = DownsampledGroupCV(
+        cv_splitter, downsample_groups=trial_id.values, random_state=42
+    )
+    logger.info("Downsampling the majority class in the training folds")
+
+if model_name in ["pathlinearsvm", "pathlogit"] and groups is not None:
+    # julearn does not pass the groups to the estimator, the inner splits
+    # look them up by row so the TRs of a trial or subject stay together
+    model.set_params(
+        cv=StratifiedGroupKFold(n_splits=5),
+        row_groups=pd.Series(groups, index=df.index),
     )
 
 ################################################
@@ -557,9 +721,6 @@ return_estimator = "all"
 if fold is not None:
     if cv_splitter is None:
         raise_error("Cannot select a single --fold when --cv is 'nosplit'.")
-    all_folds = list(cv_splitter.split(df, df[y], groups))
-    cv_splitter = [all_folds[fold]]
-    groups_col = None
     out_path = out_path / "folds" / model_name
     out_path.mkdir(parents=True, exist_ok=True)
 
@@ -569,6 +730,13 @@ if fold is not None:
 suffix = f"_{fold}" if fold is not None else ""
 
 filename = f"{model_name}_{dimred_suffix}{suffix}"
+if args.shared_prepro:
+    filename = f"{filename}_sharedprepro"
+if args.downsample:
+    filename = f"{filename}_downsampled"
+if args.low_memory and model_name in ["linearsvchc", "logithc"]:
+    # Different solvers than the float64 runs
+    filename = f"{filename}_float32"
 if IS_DEBUG_TEST:
     filename = f"DEBUG_{filename}"
 
@@ -576,6 +744,59 @@ log_file = out_path / f"{filename}_log.log"
 configure_logging(fname=log_file)
 julearn.utils.configure_logging(level="INFO", fname=log_file, overwrite=False)
 
+if fold is not None:
+    # The folds are computed once and shared by all the fold jobs and
+    # models with the same data, CV and seed (after configuring the logging,
+    # so the cache hits and misses are in the log)
+    split_cache = data_path.parent / "output" / "03_analysis" / "splits"
+    cv_splitter = [
+        cached_split(
+            cv_splitter, df, df[y], groups, cache_dir=split_cache, fold=fold
+        )
+    ]
+    groups_col = None
+
+################################################
+# Batched LOSO (zscore + linear model from shared statistics)
+################################################
+if batched_loso is not None:
+    if cv != "loso" or fold is not None:
+        raise_error(f"Model '{model_name}' requires --cv loso without --fold")
+    X_columns = [
+        x for x in df.columns if any(re.fullmatch(p, x) for p in X)
+    ]
+    logger.info(
+        f"Batched LOSO | model={model_name} | {len(X_columns)} features"
+    )
+    X_data = df[X_columns].to_numpy()
+    batched_loso.fit(X_data, df[y], df[groups_col])
+    scores = []
+    for i_fold, subject in enumerate(batched_loso.groups_):
+        test = (df[groups_col] == subject).to_numpy()
+        fold_model = batched_loso.fold_estimator(i_fold)
+        t_scores = {"fold": i_fold, "subject": subject}
+        for t_name in scoring:
+            t_scores[f"test_{t_name}"] = get_scorer(t_name)(
+                fold_model, X_data[test], df[y].values[test]
+            )
+        scores.append(t_scores)
+    scores = pd.DataFrame(scores)
+    scores.to_csv(out_path / f"{filename}_scores.csv", sep=";")
+    joblib.dump(batched_loso, out_path / f"{filename}.joblib")
+    fold_predictions = df[[groups_col, y]].copy()
+    fold_predictions["decision"] = batched_loso.decision_function(
+        X_data, df[groups_col]
+    )
+    fold_predictions.to_csv(
+        out_path / f"{filename}_fold_predictions.csv", sep=";"
+    )
+    logger.info(
+        f"Mean balanced accuracy: "
+        f"{scores['test_balanced_accuracy'].mean():.3f}"
+    )
+    logger.info("Done!")
+    sys.exit(0)
+
 ################################################
 # Run Model
 ################################################
@@ -607,6 +828,17 @@ logger.info(f"Scores shape: {scores.shape}")
 scores.to_csv(out_path / f"{filename}_scores.csv", sep=";")
 joblib.dump(model, out_path / f"{filename}.joblib")
 
+if model_name in ["linearsvm", "linearsvchc", "logithc"] and model is not None:
+    # L1 models: only the non-zero coefficients and their zscore, to
+    # decode new data reading only those columns. Pipelines that can not be
+    # compacted (e.g. with --dimred) raise a ValueError and are skipped
+    try:
+        compact = CompactLinearDecoder.from_estimator(model)
+    except ValueError as e:
+        logger.warning(f"No compact decoder: {e}")
+    else:
+        compact.save(out_path / f"{filename}_compact.npz")
+
 logger.info("Predicting fold probabilities")
 try:
     if predict_proba == "proba":
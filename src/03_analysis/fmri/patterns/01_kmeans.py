@@ -19,6 +19,7 @@
 
 # %% Initialization
 import csv
+import re
 import matplotlib.pyplot as plt
 import joblib
 from itertools import combinations
@@ -28,6 +29,11 @@ import pandas as pd
 from pathlib import Path
 from sklearn.cluster import KMeans
 from junifer.storage import HDF5FeatureStorage
+import sys
+
+REPO_ROOT = Path(__file__).resolve().parents[4]
+sys.path.insert(0, str(REPO_ROOT / "lib"))
+from nimrls.io import read_features_parquet
 
 # %% Define
 data_path = Path("/data/project/mb_decoder/data/bids/mb_decoder/derivatives/junifer/IPC")
@@ -60,9 +66,6 @@ roi_order = np.array([
 
 # %% Load fc data & Prepro
 print("Loading fc data...")
-IPC_file = HDF5FeatureStorage(IPC_path / f"IPC_task-{task}_all.hdf5")
-IPC_raw = IPC_file.read_df("BOLD_IPC_Schaefer_fc")
-
 with open((Path(__file__).parent / "utils" / "column_headers.csv"), newline='') as f:
     reader = csv.reader(f)
     roi_names = [row for row in reader][0]
@@ -70,7 +73,20 @@ roi_names = np.array(roi_names)[roi_order]
 fc_columns = []
 for a, b in combinations(roi_names, 2):
     fc_columns.append(f"{a}~{b}")
-IPC_raw = IPC_raw[fc_columns]
+
+# Parquet dataset written by nimrls.convert, if available (only the fc
+# columns are read)
+store_path = IPC_path / f"IPC_task-{task}_all.parquet"
+if store_path.exists():
+    IPC_raw = read_features_parquet(
+        store_path, columns=[re.escape(x) for x in fc_columns],
+        tasks=[task], index_col=["subject", "task", "timepoint"])
+else:
+    IPC_file = HDF5FeatureStorage(IPC_path / f"IPC_task-{task}_all.hdf5")
+    IPC_raw = IPC_file.read_df("BOLD_IPC_Schaefer_fc")
+
+# Same rows, order and dtype whichever store was read
+IPC_raw = IPC_raw[fc_columns].astype(np.float64).sort_index()
 
 # Fisher z-transform
 IPC_z = IPC_raw.apply(lambda x: np.arctanh(x.clip(-0.99999, 0.99999)))  